@@ -7,8 +7,6 @@ import pandas as pd
 from tqdm import tqdm
 import random
 from itertools import cycle
-from concurrent.futures import ThreadPoolExecutor
-import concurrent.futures
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -21,11 +19,13 @@ from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from data.function.load_data import load_data_parallel
-from data.function.rolling_window import rolling_window_datasets
-from technical_analysys.add_indicators import add_indicators, add_returns, add_log_returns, add_time_sine_cosine
+from data.function.prefetch import prepare_walk_forward_data
+from technical_analysys.feature_pipeline import FeaturePipeline
 from functions.utilis import save_model
+from models.PPO.rollout_buffer import RolloutBuffer
+from models.PPO.advantages import compute_gae
 import backtest.backtest_functions.functions as BF
-from functions.utilis import prepare_backtest_results, generate_index_labels, get_time
+from functions.utilis import generate_index_labels, get_time
 
 # import environment class
 from trading_environment.environment import Trading_Environment_Basic
@@ -68,60 +68,6 @@ def reward_calculation(previous_close, current_close, previous_position, current
     return final_reward
 
 
-class PPOMemory:
-    def __init__(self, batch_size, device):
-        self.states = None
-        self.probs = None
-        self.actions = None
-        self.vals = None
-        self.rewards = None
-        self.dones = None
-        self.batch_size = batch_size
-
-        self.clear_memory()
-        self.device = device
-
-    # TODO try to implement this function
-    """
-    def generate_batches(self):
-    indices = torch.arange(len(self.states), dtype=torch.int64)
-    batches = torch.split(indices, self.batch_size)
-    return self.states, self.actions, self.probs, self.vals, self.rewards, self.dones, self.static_states, batches
-
-    """
-    def generate_batches(self):
-        n_states = len(self.states)
-        batch_start = torch.arange(0, n_states, self.batch_size)
-        indices = torch.arange(n_states, dtype=torch.int64)
-        batches = [indices[i:i + self.batch_size] for i in batch_start]
-
-        return self.states, self.actions, self.probs, self.vals, self.rewards, self.dones, batches
-
-    def store_memory(self, state, action, probs, vals, reward, done):
-        self.states.append(torch.tensor(state, dtype=torch.float).unsqueeze(0))
-        self.actions.append(torch.tensor(action, dtype=torch.long).unsqueeze(0))
-        self.probs.append(torch.tensor(probs, dtype=torch.float).unsqueeze(0))
-        self.vals.append(torch.tensor(vals, dtype=torch.float).unsqueeze(0))
-        self.rewards.append(torch.tensor(reward, dtype=torch.float).unsqueeze(0))
-        self.dones.append(torch.tensor(done, dtype=torch.bool).unsqueeze(0))
-
-    def clear_memory(self):
-        self.states = []
-        self.probs = []
-        self.actions = []
-        self.vals = []
-        self.rewards = []
-        self.dones = []
-
-    def stack_tensors(self):
-        self.states = torch.cat(self.states, dim=0).to(self.device)
-        self.actions = torch.cat(self.actions, dim=0).to(self.device)
-        self.probs = torch.cat(self.probs, dim=0).to(self.device)
-        self.vals = torch.cat(self.vals, dim=0).to(self.device)
-        self.rewards = torch.cat(self.rewards, dim=0).to(self.device)
-        self.dones = torch.cat(self.dones, dim=0).to(self.device)
-
-
 class BaseNetwork(nn.Module):
     def __init__(self, input_dims, output_dims, dropout_rate=0.2):
         super(BaseNetwork, self).__init__()
@@ -171,7 +117,7 @@ class CriticNetwork(BaseNetwork):
 class PPO_Agent_NN_1D_EURUSD:
     def __init__(self, n_actions, input_dims, gamma=0.95, alpha=0.001, gae_lambda=0.9, policy_clip=0.2, batch_size=1024,
                  n_epochs=20, mini_batch_size=128, entropy_coefficient=0.01, ec_decay_rate=0.999, weight_decay=0.0001, l1_lambda=1e-5,
-                 lr_decay_rate=0.99):
+                 lr_decay_rate=0.99, defer_critic=True, value_batch_size=1024):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu") # Not sure why CPU is faster
         # self.device = torch.device("cpu")
         print(f"Using device: {self.device}")
@@ -185,6 +131,8 @@ class PPO_Agent_NN_1D_EURUSD:
         self.l1_lambda = l1_lambda  # L1 regularization coefficient
         self.lr_decay_rate = lr_decay_rate  # Learning rate decay rate
         self.n_actions = n_actions  # Number of actions
+        self.defer_critic = defer_critic  # Critic values of the rollout computed in learn instead of choose_action
+        self.value_batch_size = value_batch_size  # Batch size of the deferred critic values
 
         # Initialize the actor and critic networks with static input dimensions
         self.actor = ActorNetwork(self.n_actions, input_dims).to(self.device)
@@ -197,7 +145,7 @@ class PPO_Agent_NN_1D_EURUSD:
         self.critic_scheduler = ExponentialLR(self.critic_optimizer, gamma=self.lr_decay_rate)
 
         # Memory for storing experiences
-        self.memory = PPOMemory(batch_size, self.device)
+        self.memory = RolloutBuffer(batch_size, self.device)
 
         # track the generation of the agent
         self.generation = 0
@@ -214,44 +162,27 @@ class PPO_Agent_NN_1D_EURUSD:
         self.actor.train()
         self.critic.train()
 
-        # Stack the tensors in the memory
-        self.memory.stack_tensors()
-
-        # Generating the data for the entire batch, including static states
-        state_arr, action_arr, old_prob_arr, vals_arr, reward_arr, dones_arr, batches = self.memory.generate_batches()
+        # The transitions of the rollout on the device, in the order of the rollout
+        state_arr, action_arr, old_prob_arr, vals_arr, reward_arr, dones_arr, _ = self.memory.tensors()
 
-        # Convert arrays to tensors and move to the device
-        state_arr = state_arr.clone().detach().to(self.device)  # Dynamic states ie time series data
-        action_arr = action_arr.clone().detach().to(self.device)  # Actions
-        old_prob_arr = old_prob_arr.clone().detach().to(self.device)  # Old action probabilities
-        vals_arr = vals_arr.clone().detach().to(self.device)  # State values
-        reward_arr = reward_arr.clone().detach().to(self.device)  # Rewards
-        dones_arr = dones_arr.clone().detach().to(self.device)  # Done flags
+        # Critic values of the rollout in a few large batches, if they were not computed during the collection
+        if self.defer_critic:
+            vals_arr = self.estimate_values(state_arr)
 
         # Compute advantages and discounted rewards
         advantages, discounted_rewards = self.compute_discounted_rewards(reward_arr, vals_arr,
                                                                          dones_arr)
-        advantages = advantages.clone().detach().to(self.device)
-        discounted_rewards = discounted_rewards.clone().detach().to(self.device)
 
         # Loop through the optimization epochs
         for _ in range(self.n_epochs):
 
-            # Creating mini-batches and training
-            num_samples = len(state_arr)
-            indices = np.arange(num_samples)
-            np.random.shuffle(indices)
-
-            # Loop through mini-batches
-            for start_idx in range(0, num_samples, self.mini_batch_size):
-                minibatch_indices = indices[start_idx:start_idx + self.mini_batch_size]
-
-                # Convert arrays to tensors and move to the device
-                batch_states = state_arr[minibatch_indices].clone().detach().to(self.device)
-                batch_actions = action_arr[minibatch_indices].clone().detach().to(self.device)
-                batch_old_probs = old_prob_arr[minibatch_indices].clone().detach().to(self.device)
-                batch_advantages = advantages[minibatch_indices].clone().detach().to(self.device)
-                batch_returns = discounted_rewards[minibatch_indices].clone().detach().to(self.device)
+            # Loop through the shuffled mini-batches
+            for minibatch_indices in self.memory.minibatch_indices(self.mini_batch_size):
+                batch_states = state_arr[minibatch_indices]
+                batch_actions = action_arr[minibatch_indices]
+                batch_old_probs = old_prob_arr[minibatch_indices]
+                batch_advantages = advantages[minibatch_indices]
+                batch_returns = discounted_rewards[minibatch_indices]
 
                 # Zero the gradients before the backward pass
                 self.actor_optimizer.zero_grad()
@@ -312,28 +243,23 @@ class PPO_Agent_NN_1D_EURUSD:
 
         return new_probs, new_dist.entropy(), actor_loss, critic_loss
 
-    def compute_discounted_rewards(self, rewards, values, dones):
-        n = len(rewards)
-        advantages = torch.zeros_like(rewards)
-        discounted_rewards = torch.zeros_like(rewards)
-
-        # Ensure 'dones' is a float tensor for arithmetic operations
-        dones_float = dones.float()
-
-        # Append zero to the end of the values tensor for the terminal value calculation
-        next_values = torch.cat([values[1:], torch.tensor([0.0], device=self.device)])
-
-        # Compute deltas using tensors; all operations should now be valid
-        deltas = rewards + self.gamma * next_values * (1 - dones_float) - values
-
-        lastgaelam = 0
-        for t in reversed(range(n)):
-            lastgaelam = deltas[t] + self.gamma * self.gae_lambda * lastgaelam * (1 - dones_float[t])
-            advantages[t] = lastgaelam
-
-        discounted_rewards = advantages + values
+    @torch.no_grad()
+    def estimate_values(self, states):
+        """
+        Critic values of the stored states in batches of value_batch_size (in eval mode), the values of the rollout
+        when the critic is not run in choose_action (defer_critic).
+        """
+        # in eval mode (no dropout), the mode of the critic is restored afterwards
+        training = self.critic.training
+        self.critic.eval()
+        values = [self.critic(states[start:start + self.value_batch_size]).squeeze(-1)
+                  for start in range(0, len(states), self.value_batch_size)]
+        self.critic.train(training)
+        return torch.cat(values)
 
-        return advantages, discounted_rewards
+    def compute_discounted_rewards(self, rewards, values, dones):
+        # GAE advantages and returns of the rollout in one reverse scan
+        return compute_gae(rewards, values, dones, self.gamma, self.gae_lambda)
 
     @torch.no_grad()
     def choose_action(self, observation, current_position):
@@ -350,6 +276,9 @@ class PPO_Agent_NN_1D_EURUSD:
         dist = torch.distributions.Categorical(probs)
         action = dist.sample()
         log_prob = dist.log_prob(action)
+        if self.defer_critic:
+            return action.item(), log_prob.item(), None  # the state value is estimated in learn
+
         value = self.critic(state)
 
         return action.item(), log_prob.item(), value.item()
@@ -373,6 +302,17 @@ class PPO_Agent_NN_1D_EURUSD:
         # Return the action probabilities as a NumPy array
         return action_probs
 
+    @torch.no_grad()
+    def get_action_probabilities_batch(self, observations, static_inputs):
+        """
+        Action probabilities for a batch of observations, same as get_action_probabilities row by row.
+        """
+        observations = np.column_stack([np.asarray(observations), np.asarray(static_inputs)])
+        state = torch.tensor(observations, dtype=torch.float).to(self.device)
+        action_probs = self.actor(state)
+
+        return action_probs.cpu().numpy()
+
     @torch.no_grad()
     def choose_best_action(self, observation, current_position):
         action_probs = self.get_action_probabilities(observation, current_position)
@@ -389,6 +329,197 @@ class PPO_Agent_NN_1D_EURUSD:
         return self.__class__.__name__
 
 
+def walk_forward_step(move_forward, validation_date, test_date, end_date, look_back, variables, tradable_markets,
+                      provision, leverage, starting_balance, results_store_path, run, step_data):
+    """
+    One walk forward step, run in its own process by BF.WalkForwardOrchestrator: trains a fresh agent, selects the
+    generation with the best validation Sharpe Ratio and returns its test results (with the step's starting balance,
+    the steps are chained by BF.stitch_walk_forward). step_data holds the datasets of the step
+    (prepare_walk_forward_data), prepared in the background while the previous steps trained.
+    """
+    # Set seeds for reproducibility
+    torch.manual_seed(0)
+    np.random.seed(0)
+    random.seed(0)
+
+    results_store = BF.BacktestResultsStore(results_store_path, run=run)
+
+    print("validation_date", validation_date)
+    print("test_date", test_date)
+    print("end_date", end_date)
+
+    # train, validation and test sets of the step and their rolling windows, shared memory views (zero-copy)
+    step_datasets = step_data.load()
+    df_train, df_validation, df_test = step_datasets['train'], step_datasets['validation'], step_datasets['test']
+
+    num_episodes = 5000  # 50
+
+    # Create an instance of the agent
+    agent = PPO_Agent_NN_1D_EURUSD(n_actions=3,  # sell, hold money, buy
+                                   input_dims=len(variables) * look_back + 1,  # input dimensions
+                                   gamma=0.75,  # discount factor of future rewards
+                                   alpha=0.00005,  # learning rate for networks (actor and critic) high as its decaying at least 0.0001
+                                   gae_lambda=0.75,  # lambda for generalized advantage estimation
+                                   policy_clip=0.25,  # clip parameter for PPO
+                                   entropy_coefficient=10,  # higher entropy coefficient encourages exploration
+                                   ec_decay_rate=0.996,  # entropy coefficient decay rate
+                                   batch_size=1024,  # size of the memory
+                                   n_epochs=1,  # number of epochs
+                                   mini_batch_size=128,  # size of the mini-batches
+                                   weight_decay=0.0000005,  # weight decay
+                                   l1_lambda=1e-7,  # L1 regularization lambda
+                                   lr_decay_rate=0.9925,  # learning rate decay rate
+                                   )
+
+    total_rewards, episode_durations, total_balances = [], [], []
+    episode_probabilities = {'train': [], 'validation': [], 'test': []}
+
+    index = pd.MultiIndex.from_product([range(num_episodes), ['validation', 'test']], names=['episode', 'dataset'])
+    columns = ['Final Balance', 'Dataset Index']
+    backtest_results = pd.DataFrame(index=index, columns=columns)
+
+    test_rolling_datasets = step_datasets['test_windows']
+    val_rolling_datasets = step_datasets['validation_windows']
+
+    # Generate index labels for each rolling window dataset
+    val_labels = generate_index_labels(val_rolling_datasets, 'validation')
+    test_labels = generate_index_labels(test_rolling_datasets, 'test')
+    all_labels = val_labels + test_labels
+
+    # worker processes keep the validation and test windows loaded for all generations of this walk forward step
+    backtest_executor = BF.BacktestExecutor(val_rolling_datasets + test_rolling_datasets, all_labels,
+                                            BF.backtest_wrapper, tradable_markets, look_back, variables, provision,
+                                            starting_balance, leverage, Trading_Environment_Basic,
+                                            reward_calculation, workers=4)
+
+    # Rolling DF
+    rolling_datasets = step_datasets['train_windows']
+    dataset_iterator = cycle(rolling_datasets)
+
+    backtest_results = {}
+    # full probabilities and balances only for the top generations by the validation Sharpe Ratio
+    trace_selector = BF.GenerationTraceSelector(backtest_results, top_k=3, metric='Sharpe Ratio',
+                                                label_prefix='validation')
+    probs_dfs, balances_dfs = trace_selector.probabilities, trace_selector.balances
+
+    # Initialize the agent generation
+    generation = 0
+
+    for episode in tqdm(range(num_episodes)):
+        start_time = time.time()
+
+        window_df = next(dataset_iterator)
+        dataset_index = episode % len(rolling_datasets)
+
+        print(f"\nEpisode {episode + 1}: Learning from dataset with Start Date = {window_df.index.min()}, End Date = {window_df.index.max()}, len = {len(window_df)}")
+
+        # Create a new environment with the randomly selected window's data
+        env = Trading_Environment_Basic(window_df, look_back=look_back, variables=variables,
+                                        tradable_markets=tradable_markets, provision=provision,
+                                        initial_balance=starting_balance, leverage=leverage,
+                                        reward_function=reward_calculation)
+
+        observation = env.reset()
+        done = False
+        initial_balance = env.balance
+        observation = np.append(observation, 0)
+
+        while not done:
+            current_position = env.current_position
+            action, prob, val = agent.choose_action(observation, env.current_position)
+            observation_, reward, done, info = env.step(action)
+            observation_ = np.append(observation_, current_position)
+            agent.store_transition(observation, action, prob, val, reward, done)
+            observation = observation_
+
+            # Check if enough data is collected or if the dataset ends
+            if agent.memory.full:
+                agent.learn()
+                agent.memory.clear_memory()
+
+            if generation < agent.generation:
+                # a frozen snapshot of the new generation is evaluated on all windows in the process pool
+                backtest_executor.run(agent, 'PPO', backtest_results, probs_dfs, balances_dfs)
+
+                generation = agent.generation
+                print(f"Backtesting completed for {agent.get_name()} generation {generation}")
+
+        # results
+        end_time = time.time()
+        episode_time = end_time - start_time
+        total_rewards.append(env.reward_sum)
+        episode_durations.append(episode_time)
+        total_balances.append(env.balance)
+
+        print(
+            f"Completed learning from selected window in episode {episode + 1}: Total Reward: {env.reward_sum}, Total Balance: {env.balance:.2f}, Duration: {episode_time:.2f} seconds, current Entropy Coefficient: {agent.entropy_coefficient:.2f}")
+        print(f'Final Balance of Buy and Hold benchmark agent: ', BF.benchmark_backtest(
+            window_df, 1, tradable_markets, look_back, provision, starting_balance, leverage,
+            reward_calculation)[0])
+
+    buy_and_hold_agent = Buy_and_hold_Agent()
+    sell_and_hold_agent = Sell_and_hold_Agent()
+    # TODO
+    # Run backtesting for both agents
+    bah_results, _, benchmark_BAH = BF.run_backtesting(
+        buy_and_hold_agent, 'BAH', val_rolling_datasets + test_rolling_datasets, val_labels + test_labels,
+        BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
+        Trading_Environment_Basic, reward_calculation, workers=4, executor=backtest_executor)
+
+    sah_results, _, benchmark_SAH = BF.run_backtesting(
+        sell_and_hold_agent, 'SAH', val_rolling_datasets + test_rolling_datasets, val_labels + test_labels,
+        BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
+        Trading_Environment_Basic, reward_calculation, workers=4, executor=backtest_executor)
+
+    backtest_executor.shutdown()
+
+    # one indexed store for the agent and benchmark results of all walk forward steps, a resumed step replaces its rows
+    results_store.insert(backtest_results, step=move_forward, replace_step=True)
+    results_store.insert(bah_results, step=move_forward, replace_step=True)
+    results_store.insert(sah_results, step=move_forward, replace_step=True)
+
+    benchmark_balances = results_store.query(step=move_forward, agent_type=['BAH', 'SAH'], label=test_labels[0])
+    benchmark_balances = benchmark_balances.set_index('agent_type')['Final Balance']
+    print('buy and hold final balance', benchmark_balances['BAH'])
+    print('sell and hold final balance', benchmark_balances['SAH'])
+
+    # Find the generation with the maximum Sharpe Ratio in the validation set
+    best_sharpe_index = results_store.best_generation('Sharpe Ratio', step=move_forward, agent_type='PPO',
+                                                      label_prefix='validation')
+
+    # if nan in the sharpe ratios, take the last one
+    if best_sharpe_index is None:
+        best_sharpe_index = trace_selector.best_generation()
+
+    # Extract the test result of the best generation
+    best_result = results_store.query(step=move_forward, agent_type='PPO', generation=best_sharpe_index,
+                                      label=test_labels[0])
+
+    # Extract the corresponding balances for the best result
+    agent_generation = best_sharpe_index
+    balances_key = (agent_generation, test_labels[0])
+    best_balances = balances_dfs.get(balances_key, [])
+
+    probs_key = (agent_generation, test_labels[0])
+    best_probs = probs_dfs.get(probs_key, np.empty((0, 3), dtype=np.float32))
+    best_probs_df = BF.probabilities_to_frame(best_probs, action_column=f'{agent.get_name()}_Action')
+    best_balances_df = pd.DataFrame(best_balances, columns=[f'{agent.get_name()}_Balances'])
+
+    dates = df_test.iloc[look_back:-1].index
+    best_balances_df['Date'] = dates
+    best_probs_df['Date'] = dates
+    close_prices = df_test['Close', tradable_markets].reset_index()
+    close_prices = close_prices.iloc[look_back:-1]
+    close_prices.columns = ['Date', f'Close_{tradable_markets}']
+
+    best_balances_df = pd.merge(best_balances_df, close_prices, on='Date', how='outer')
+    best_balances_df = pd.merge(best_balances_df, best_probs_df, on='Date', how='outer')
+    print(f"Final Balance of the step: {best_balances_df[f'{agent.get_name()}_Balances'].iloc[-1]:.2f}")
+
+    return {'final_test_results': best_balances_df, 'provision_sum': best_result['Provision_sum'].sum(),
+            'starting_balance': starting_balance, 'agent_name': agent.get_name()}
+
+
 if __name__ == '__main__':
     # time the execution
     start_time_X = time.time()
@@ -403,307 +534,85 @@ if __name__ == '__main__':
     end_date = '2020-01-01'
     test_date_2 = test_date
 
-    final_test_results = pd.DataFrame()
     final_balance = 10000
 
     # Example usage
     # Stock market variables
     df = load_data_parallel(['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], '1D')
 
-    indicators = [
-        {"indicator": "RSI", "mkf": "EURUSD", "length": 14},
-        {"indicator": "ATR", "mkf": "EURUSD", "length": 24},
-        {"indicator": "MACD", "mkf": "EURUSD"},
-        {"indicator": "Stochastic", "mkf": "EURUSD"}, ]
-
-    return_indicators = [
-        {"price_type": "Close", "mkf": "EURUSD"},
-        {"price_type": "Close", "mkf": "USDJPY"},
-        {"price_type": "Close", "mkf": "EURJPY"},
-        {"price_type": "Close", "mkf": "GBPUSD"},
+    feature_spec = [
+        {"feature": "RSI", "mkf": "EURUSD", "length": 14},
+        {"feature": "ATR", "mkf": "EURUSD", "length": 24},
+        {"feature": "MACD", "mkf": "EURUSD"},
+        {"feature": "Stochastic", "mkf": "EURUSD"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "EURUSD"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "USDJPY"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "EURJPY"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "GBPUSD"},
+        {"feature": "Time", "timestamp": "1W"},
     ]
-    add_indicators(df, indicators)
-    add_returns(df, return_indicators)
+    feature_pipeline = FeaturePipeline(feature_spec)
+    df = feature_pipeline.transform(df)
 
-    provision_sum_test_final = 0
+    look_back = 20
 
-    add_time_sine_cosine(df, '1W')
+    variables = [
+        {"variable": ("Close", "USDJPY"), "edit": "standardize"},
+        {"variable": ("Close", "EURUSD"), "edit": "standardize"},
+        {"variable": ("Close", "EURJPY"), "edit": "standardize"},
+        {"variable": ("Close", "GBPUSD"), "edit": "standardize"},
+        {"variable": ("RSI_14", "EURUSD"), "edit": "standardize"},
+        {"variable": ("ATR_24", "EURUSD"), "edit": "standardize"},
+        {"variable": ("sin_time_1W", ""), "edit": None},
+        {"variable": ("cos_time_1W", ""), "edit": None},
+        {"variable": ("Returns_Close", "EURUSD"), "edit": None},
+        {"variable": ("Returns_Close", "USDJPY"), "edit": None},
+        {"variable": ("Returns_Close", "EURJPY"), "edit": None},
+        {"variable": ("Returns_Close", "GBPUSD"), "edit": None},
+    ]
 
-    look_back = 20
-    df = df.dropna()
+    tradable_markets = 'EURUSD'
+    # Provision is the cost of trading, it is a percentage of the trade size, current real provision on FOREX is 0.0001
+    provision = 0.0001  # 0.001, cant be too high as it would not learn to trade
+
+    # Environment parameters
+    leverage = 1
 
+    # the walk forward steps only depend on each other through the starting balance (rescaled by stitch_walk_forward),
+    # they run in parallel processes, every finished step is checkpointed and a rerun resumes from the finished steps,
+    # the datasets of the next steps are prepared in the background while the current steps train
+    orchestrator = BF.WalkForwardOrchestrator(walk_forward_step, 'walk_forward_checkpoints/PPO_NN', cores_per_step=5,
+                                              prepare_function=prepare_walk_forward_data)
+    results_store = BF.BacktestResultsStore('backtest_results.sqlite', run=f'PPO_NN_{orchestrator.run_id}')
+
+    steps, prepare_steps = {}, {}
     for move_forward in range(1, 6):
-        print("validation_date", validation_date)
-        print("test_date", test_date)
-        print("end_date", end_date)
-
-        df = load_data_parallel(['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], '1D')
-
-        add_indicators(df, indicators)
-        add_returns(df, return_indicators)
-
-        add_time_sine_cosine(df, '1W')
-
-        df = df.dropna()
-        df_train, df_validation, df_test = df[start_date:validation_date], df[validation_date:test_date], df[test_date:end_date]
-
-        df_validation = pd.concat([df_train.iloc[-look_back:], df_validation])
-        df_test = pd.concat([df_validation.iloc[-look_back:], df_test])
-
-        variables = [
-            {"variable": ("Close", "USDJPY"), "edit": "standardize"},
-            {"variable": ("Close", "EURUSD"), "edit": "standardize"},
-            {"variable": ("Close", "EURJPY"), "edit": "standardize"},
-            {"variable": ("Close", "GBPUSD"), "edit": "standardize"},
-            {"variable": ("RSI_14", "EURUSD"), "edit": "standardize"},
-            {"variable": ("ATR_24", "EURUSD"), "edit": "standardize"},
-            {"variable": ("sin_time_1W", ""), "edit": None},
-            {"variable": ("cos_time_1W", ""), "edit": None},
-            {"variable": ("Returns_Close", "EURUSD"), "edit": None},
-            {"variable": ("Returns_Close", "USDJPY"), "edit": None},
-            {"variable": ("Returns_Close", "EURJPY"), "edit": None},
-            {"variable": ("Returns_Close", "GBPUSD"), "edit": None},
-        ]
-
-        tradable_markets = 'EURUSD'
-        window_size = '1Y'
-        starting_balance = final_balance
-        # Provision is the cost of trading, it is a percentage of the trade size, current real provision on FOREX is 0.0001
-        provision = 0.0001  # 0.001, cant be too high as it would not learn to trade
-
-        # Environment parameters
-        leverage = 1
-        num_episodes = 5000  # 50
-
-        # Create an instance of the agent
-        agent = PPO_Agent_NN_1D_EURUSD(n_actions=3,  # sell, hold money, buy
-                                       input_dims=len(variables) * look_back + 1,  # input dimensions
-                                       gamma=0.75,  # discount factor of future rewards
-                                       alpha=0.00005,  # learning rate for networks (actor and critic) high as its decaying at least 0.0001
-                                       gae_lambda=0.75,  # lambda for generalized advantage estimation
-                                       policy_clip=0.25,  # clip parameter for PPO
-                                       entropy_coefficient=10,  # higher entropy coefficient encourages exploration
-                                       ec_decay_rate=0.996,  # entropy coefficient decay rate
-                                       batch_size=1024,  # size of the memory
-                                       n_epochs=1,  # number of epochs
-                                       mini_batch_size=128,  # size of the mini-batches
-                                       weight_decay=0.0000005,  # weight decay
-                                       l1_lambda=1e-7,  # L1 regularization lambda
-                                       lr_decay_rate=0.9925,  # learning rate decay rate
-                                       )
-
-        total_rewards, episode_durations, total_balances = [], [], []
-        episode_probabilities = {'train': [], 'validation': [], 'test': []}
-
-        index = pd.MultiIndex.from_product([range(num_episodes), ['validation', 'test']], names=['episode', 'dataset'])
-        columns = ['Final Balance', 'Dataset Index']
-        backtest_results = pd.DataFrame(index=index, columns=columns)
-
-        window_size_2 = '2Y'
-        test_rolling_datasets = rolling_window_datasets(df_test, window_size=window_size_2, look_back=look_back)
-        val_rolling_datasets = rolling_window_datasets(df_validation, window_size=window_size_2, look_back=look_back)
-
-        # Generate index labels for each rolling window dataset
-        val_labels = generate_index_labels(val_rolling_datasets, 'validation')
-        test_labels = generate_index_labels(test_rolling_datasets, 'test')
-        all_labels = val_labels + test_labels
-
-        # Rolling DF
-        rolling_datasets = rolling_window_datasets(df_train, window_size=window_size, look_back=look_back)
-        dataset_iterator = cycle(rolling_datasets)
-
-        backtest_results, probs_dfs, balances_dfs = {}, {}, {}
-
-        # Initialize the agent generation
-        generation = 0
-
-        for episode in tqdm(range(num_episodes)):
-            start_time = time.time()
-
-            window_df = next(dataset_iterator)
-            dataset_index = episode % len(rolling_datasets)
-
-            print(f"\nEpisode {episode + 1}: Learning from dataset with Start Date = {window_df.index.min()}, End Date = {window_df.index.max()}, len = {len(window_df)}")
-
-            # Create a new environment with the randomly selected window's data
-            env = Trading_Environment_Basic(window_df, look_back=look_back, variables=variables,
-                                            tradable_markets=tradable_markets, provision=provision,
-                                            initial_balance=starting_balance, leverage=leverage,
-                                            reward_function=reward_calculation)
-
-            observation = env.reset()
-            done = False
-            initial_balance = env.balance
-            observation = np.append(observation, 0)
-
-            while not done:
-                current_position = env.current_position
-                action, prob, val = agent.choose_action(observation, env.current_position)
-                observation_, reward, done, info = env.step(action)
-                observation_ = np.append(observation_, current_position)
-                agent.store_transition(observation, action, prob, val, reward, done)
-                observation = observation_
-
-                # Check if enough data is collected or if the dataset ends
-                if len(agent.memory.states) >= agent.memory.batch_size:
-                    agent.learn()
-                    agent.memory.clear_memory()
-
-                if generation < agent.generation:
-                    with ThreadPoolExecutor(max_workers=4) as executor:
-                        futures = []
-                        # Combine validation and test datasets and labels for processing
-                        for df, label in zip(val_rolling_datasets + test_rolling_datasets, val_labels + test_labels):
-                            future = executor.submit(
-                                BF.backtest_wrapper, 'PPO', df, agent, tradable_markets, look_back,
-                                variables, provision, starting_balance, leverage,
-                                Trading_Environment_Basic, reward_calculation
-                            )
-                            futures.append((future, label))
-
-                        # Process futures as they complete
-                        for future, label in futures:
-                            result = future.result()
-                            # Make sure to update these variables to match the exact structure of the data being returned
-                            balance, total_reward, number_of_trades, probs_df, action_df, sharpe_ratio, max_drawdown, \
-                                sortino_ratio, calmar_ratio, cumulative_returns, balances, provision_sum, max_drawdown_duration, \
-                                average_trade_duration, in_long, in_short, in_out_of_market = result
-
-                            # Populate a dictionary with the results
-                            result_data = {
-                                'Agent generation': agent.generation,
-                                'Label': label,
-                                'Provision_sum': provision_sum,
-                                'Final Balance': balance,
-                                'Total Reward': total_reward,
-                                'Number of Trades': number_of_trades,
-                                'Sharpe Ratio': sharpe_ratio,
-                                'Max Drawdown': max_drawdown,
-                                'Sortino Ratio': sortino_ratio,
-                                'Calmar Ratio': calmar_ratio,
-                                'Max Drawdown Duration': max_drawdown_duration,
-                                'Average Trade Duration': average_trade_duration,
-                                'In Long': in_long,
-                                'In Short': in_short,
-                                'In Out of the Market': in_out_of_market,
-                            }
-
-                            key = (agent.generation, label)
-                            backtest_results.setdefault(key, []).append(result_data)
-                            probs_dfs[key] = probs_df
-                            balances_dfs[key] = balances
-
-                        generation = agent.generation
-                        print(f"Backtesting completed for {agent.get_name()} generation {generation}")
-
-            # results
-            end_time = time.time()
-            episode_time = end_time - start_time
-            total_rewards.append(env.reward_sum)
-            episode_durations.append(episode_time)
-            total_balances.append(env.balance)
-
-            print(
-                f"Completed learning from selected window in episode {episode + 1}: Total Reward: {env.reward_sum}, Total Balance: {env.balance:.2f}, Duration: {episode_time:.2f} seconds, current Entropy Coefficient: {agent.entropy_coefficient:.2f}")
-            print(f'Final Balance of Buy and Hold benchmark agent: ', starting_balance * (1 + (
-                        window_df[('Close', tradable_markets)].iloc[-1] - window_df[('Close', tradable_markets)].iloc[
-                    look_back]) / window_df[('Close', tradable_markets)].iloc[look_back] * leverage))
-            # TODO do this as cached function with benchmark agents and df as input
-
-        buy_and_hold_agent = Buy_and_hold_Agent()
-        sell_and_hold_agent = Sell_and_hold_Agent()
-        # TODO
-        # Run backtesting for both agents
-        bah_results, _, benchmark_BAH = BF.run_backtesting(
-            buy_and_hold_agent, 'BAH', val_rolling_datasets + test_rolling_datasets, val_labels + test_labels,
-            BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
-            Trading_Environment_Basic, reward_calculation, workers=4)
-
-        sah_results, _, benchmark_SAH = BF.run_backtesting(
-            sell_and_hold_agent, 'SAH', val_rolling_datasets + test_rolling_datasets, val_labels + test_labels,
-            BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
-            Trading_Environment_Basic, reward_calculation, workers=4)
-
-        bah_results_prepared = prepare_backtest_results(bah_results, 'BAH')
-        sah_results_prepared = prepare_backtest_results(sah_results, 'SAH')
-
-        sah_results_prepared = sah_results_prepared.drop(('', 'Agent Generation'),
-                                                         axis=1)  # drop the agent generation column
-        bah_results_prepared = bah_results_prepared.drop(('', 'Agent Generation'),
-                                                         axis=1)  # drop the agent generation column
-
-        print('buy and hold final balance', bah_results_prepared[('BAH', 'Final Balance')][1])
-        print('sell and hold final balance', sah_results_prepared[('SAH', 'Final Balance')][1])
-
-        # Merge BAH and SAH results on 'Label'
-        new_backtest_results = pd.merge(bah_results_prepared, sah_results_prepared, on=[('', 'Label')], how='outer')
-
-        backtest_results = prepare_backtest_results(backtest_results, agent.get_name())
-        backtest_results = pd.merge(backtest_results, new_backtest_results, on=[('', 'Label')], how='outer')
-        backtest_results = backtest_results.set_index([('', 'Agent Generation')])
-
-        label_series = backtest_results[('', 'Label')]
-        backtest_results = backtest_results.drop(('', 'Label'), axis=1)
-        backtest_results['Label'] = label_series
-
-        sharpe_ratios = backtest_results[(agent.get_name(), 'Sharpe Ratio')]
-
-        # Find the index of the maximum Sharpe Ratio in the validation set
-        best_sharpe_index = sharpe_ratios.idxmax()
-
-        # if nan in the sharpe ratios, take the last one
-        if pd.isna(best_sharpe_index):
-            best_sharpe_index = agent.generation - 1
-
-        # Extract the best result row
-        best_result = backtest_results.loc[best_sharpe_index]
-
-        # Convert the result to a dictionary
-        best_result_dict = best_result.to_dict()
-
-        # Extract the corresponding balances for the best result
-        agent_generation = best_sharpe_index
-        balances_key = (agent_generation, test_labels[0])
-        best_balances = balances_dfs.get(balances_key, [])
-
-        probs_key = (agent_generation, test_labels[0])
-        best_probs_df = probs_dfs.get(probs_key, pd.DataFrame())
-        best_probs_df[f'{agent.get_name()}_Action'] = best_probs_df.idxmax(axis=1)
-        best_balances_df = pd.DataFrame(best_balances, columns=[f'{agent.get_name()}_Balances'])
-
-        dates = df_test.iloc[look_back:-1].index
-        best_balances_df['Date'] = dates
-        best_probs_df['Date'] = dates
-        close_prices = df_test['Close', tradable_markets].reset_index()
-        close_prices = close_prices.iloc[look_back:-1]
-        close_prices.columns = ['Date', f'Close_{tradable_markets}']
-
-        best_balances_df = pd.merge(best_balances_df, close_prices, on='Date', how='outer')
-        best_balances_df = pd.merge(best_balances_df, best_probs_df, on='Date', how='outer')
-        final_test_results = pd.concat([final_test_results, best_balances_df])
-
-        final_balance = final_test_results[f'{agent.get_name()}_Balances'].iloc[-1]
-        print(f"Final Balance: {final_balance:.2f}")
-
-        # save also number of trades and provision sum
-        provision_sum_test_final = provision_sum_test_final + \
-                                   best_result_dict.get((agent.get_name(), 'Provision Sum'), 0)[agent_generation]
+        steps[move_forward] = {'move_forward': move_forward, 'validation_date': validation_date,
+                               'test_date': test_date, 'end_date': end_date, 'look_back': look_back,
+                               'variables': variables, 'tradable_markets': tradable_markets, 'provision': provision,
+                               'leverage': leverage, 'starting_balance': 10000,
+                               'results_store_path': results_store.path, 'run': results_store.run}
+        prepare_steps[move_forward] = {'tickers': ['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], 'timestamp': '1D',
+                                       'feature_spec': feature_spec, 'start_date': start_date,
+                                       'validation_date': validation_date, 'test_date': test_date,
+                                       'end_date': end_date, 'look_back': look_back, 'window_size': '1Y',
+                                       'evaluation_window_size': '2Y'}
 
         # add year to the dates
         validation_date = (datetime.strptime(validation_date, '%Y-%m-%d') + relativedelta(years=1)).strftime('%Y-%m-%d')
         test_date = (datetime.strptime(test_date, '%Y-%m-%d') + relativedelta(years=1)).strftime('%Y-%m-%d')
         end_date = (datetime.strptime(end_date, '%Y-%m-%d') + relativedelta(years=1)).strftime('%Y-%m-%d')
 
-        # final results for the agent
-
-    df = load_data_parallel(['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], '1D')
-
-    add_indicators(df, indicators)
-    add_returns(df, return_indicators)
+    step_results = orchestrator.run(steps, prepare_steps)
+    agent_name = step_results[1]['agent_name']
+    final_test_results, provision_sum_test_final, final_balance = BF.stitch_walk_forward(
+        step_results, f'{agent_name}_Balances', starting_balance=final_balance)
+    print(f"Final Balance: {final_balance:.2f}")
 
-    add_time_sine_cosine(df, '1W')
+    # final results for the agent
 
-    df = df.dropna()
+    df = load_data_parallel(['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], '1D')
+    df = feature_pipeline.transform(df)
     df = df[test_date_2:end_date]
 
     buy_and_hold_agent = Buy_and_hold_Agent()
@@ -720,31 +629,36 @@ if __name__ == '__main__':
         BF.backtest_wrapper, tradable_markets, look_back, variables, provision, 10000, leverage,
         Trading_Environment_Basic, reward_calculation, workers=4)
 
-    bah_results_prepared = prepare_backtest_results(bah_results, 'BAH')
-    sah_results_prepared = prepare_backtest_results(sah_results, 'SAH')
+    bah_final = bah_results[(buy_and_hold_agent.generation, 'final_test')][0]
+    sah_final = sah_results[(sell_and_hold_agent.generation, 'final_test')][0]
 
-    sah_results_prepared = sah_results_prepared.drop(('', 'Agent Generation'),
-                                                     axis=1)  # drop the agent generation column
-    bah_results_prepared = bah_results_prepared.drop(('', 'Agent Generation'),
-                                                     axis=1)  # drop the agent generation column
+    results_store.to_parquet(f'backtest_results_{results_store.run}.parquet')
 
     # Generate statistics for the final test results
-    statistic_report = BF.generate_result_statistics(final_test_results, f'{agent.get_name()}_Action',
-                                                     f'{agent.get_name()}_Balances', provision_sum_test_final,
+    statistic_report = BF.generate_result_statistics(final_test_results, f'{agent_name}_Action',
+                                                     f'{agent_name}_Balances', provision_sum_test_final,
                                                      look_back=look_back)
-    statistic_report.update({'sell and hold final balance': sah_results_prepared[('SAH', 'Final Balance')][0],
-                             'buy and hold final balance': bah_results_prepared[('BAH', 'Final Balance')][0],
-                             'sell and hold sharpe ratio': sah_results_prepared[('SAH', 'Sharpe Ratio')][0],
-                             'buy and hold sharpe ratio': bah_results_prepared[('BAH', 'Sharpe Ratio')][0]})
+    statistic_report.update({'sell and hold final balance': sah_final['Final Balance'],
+                             'buy and hold final balance': bah_final['Final Balance'],
+                             'sell and hold sharpe ratio': sah_final['Sharpe Ratio'],
+                             'buy and hold sharpe ratio': bah_final['Sharpe Ratio']})
+
+    # bootstrap confidence intervals of the final test metrics and p-values against the benchmarks
+    benchmark_index = df.index[look_back:-1]
+    significance_report = BF.bootstrap_significance(
+        final_test_results.set_index('Date')[f'{agent_name}_Balances'],
+        {'BAH': pd.Series(benchmark_BAH[('Buy and Hold', 'final_test')], index=benchmark_index),
+         'SAH': pd.Series(benchmark_SAH[('Sell and Hold', 'final_test')], index=benchmark_index)})
+    print(significance_report)
 
     print(f"Final Balance: {final_balance:.2f}")
     # 12605 PogChamp benchmark add sharpe of this strategy # sharpe 1.55
     # 12100 good one
     print(statistic_report)
     statistic_report = pd.DataFrame([statistic_report])
-    #statistic_report.to_csv(fr'C:\Users\jmask\OneDrive\Pulpit\RL_magisterka\{tradable_markets}\statistic_report_{agent.get_name()}.csv', index=False)
+    #statistic_report.to_csv(fr'C:\Users\jmask\OneDrive\Pulpit\RL_magisterka\{tradable_markets}\statistic_report_{agent_name}.csv', index=False)
 
     # Save final_test_results to a CSV file
-    #final_test_results.to_csv(fr'C:\Users\jmask\OneDrive\Pulpit\RL_magisterka\{tradable_markets}\final_test_results_{agent.get_name()}.csv', index=False)
+    #final_test_results.to_csv(fr'C:\Users\jmask\OneDrive\Pulpit\RL_magisterka\{tradable_markets}\final_test_results_{agent_name}.csv', index=False)
 
     print('end')
\ No newline at end of file
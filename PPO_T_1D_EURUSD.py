@@ -24,8 +24,6 @@ import pandas as pd
 from tqdm import tqdm
 import random
 from itertools import cycle
-from concurrent.futures import ThreadPoolExecutor
-import concurrent.futures
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -38,11 +36,13 @@ from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from data.function.load_data import load_data_parallel
-from data.function.rolling_window import rolling_window_datasets
-from technical_analysys.add_indicators import add_indicators, add_returns, add_log_returns, add_time_sine_cosine
+from data.function.prefetch import prepare_walk_forward_data
+from technical_analysys.feature_pipeline import FeaturePipeline
 from functions.utilis import save_model
+from models.PPO.rollout_buffer import RolloutBuffer
+from models.PPO.advantages import compute_gae
 import backtest.backtest_functions.functions as BF
-from functions.utilis import prepare_backtest_results, generate_index_labels, get_time
+from functions.utilis import generate_index_labels, get_time
 
 # import environment class
 from trading_environment.environment import Trading_Environment_Basic
@@ -84,58 +84,45 @@ def reward_calculation(previous_close, current_close, previous_position, current
 
     return final_reward
 
-class PPOMemory:
-    def __init__(self, batch_size, device):
-        self.states = None
-        self.probs = None
-        self.actions = None
-        self.vals = None
-        self.rewards = None
-        self.dones = None
-        self.static_states = None
-        self.batch_size = batch_size
-
-        self.clear_memory()
-        self.device = device
-
-    def generate_batches(self):
-        n_states = len(self.states)
-        batch_start = torch.arange(0, n_states, self.batch_size)
-        indices = torch.arange(n_states, dtype=torch.int64)
-        batches = [indices[i:i + self.batch_size] for i in batch_start]
-
-        return self.states, self.actions, self.probs, self.vals, self.rewards, self.dones, self.static_states, batches
-
-    def store_memory(self, state, action, probs, vals, reward, done, static_state):
-        self.states.append(torch.tensor(state, dtype=torch.float).unsqueeze(0))
-        self.actions.append(torch.tensor(action, dtype=torch.long).unsqueeze(0))
-        self.probs.append(torch.tensor(probs, dtype=torch.float).unsqueeze(0))
-        self.vals.append(torch.tensor(vals, dtype=torch.float).unsqueeze(0))
-        self.rewards.append(torch.tensor(reward, dtype=torch.float).unsqueeze(0))
-        self.dones.append(torch.tensor(done, dtype=torch.bool).unsqueeze(0))
-        self.static_states.append(torch.tensor(static_state, dtype=torch.float).unsqueeze(0))
-
-    def clear_memory(self):
-        self.states = []
-        self.probs = []
-        self.actions = []
-        self.vals = []
-        self.rewards = []
-        self.dones = []
-        self.static_states = []
-
-    def stack_tensors(self):
-        self.states = torch.cat(self.states, dim=0).to(self.device)
-        self.actions = torch.cat(self.actions, dim=0).to(self.device)
-        self.probs = torch.cat(self.probs, dim=0).to(self.device)
-        self.vals = torch.cat(self.vals, dim=0).to(self.device)
-        self.rewards = torch.cat(self.rewards, dim=0).to(self.device)
-        self.dones = torch.cat(self.dones, dim=0).to(self.device)
-        self.static_states = torch.cat(self.static_states, dim=0).to(self.device)
+class SequenceInput(nn.Module):
+    """
+    Projects the flat observation (the look_back values of every variable one after the other, as built by the
+    environment) to a sequence of look_back / patch_size tokens of input_dims features, every token holds patch_size
+    bars of all variables. The encoder then attends over time instead of seeing a single token of
+    variables * look_back features, and patches shorten long look-backs.
+    """
+    def __init__(self, input_dims, n_variables, look_back, patch_size=1):
+        super(SequenceInput, self).__init__()
+        if look_back % patch_size:
+            raise ValueError(f'look_back {look_back} is not a multiple of patch_size {patch_size}')
+        self.n_variables = n_variables
+        self.look_back = look_back
+        self.patch_size = patch_size
+        self.seq_length = look_back // patch_size
+        self.projection = nn.Linear(n_variables * patch_size, input_dims)
+
+    def forward(self, dynamic_state):
+        batch_size = dynamic_state.size(0)
+        # (batch, variables, look_back) -> (batch, look_back, variables) -> (batch, tokens, patch_size * variables)
+        x = dynamic_state.reshape(batch_size, self.n_variables, self.look_back).transpose(1, 2)
+        x = x.reshape(batch_size, self.seq_length, self.patch_size * self.n_variables)
+        return self.projection(x)
+
+
+def sequence_input_layer(input_dims, sequence_input):
+    """
+    The SequenceInput of a network (None for the flat layout), its maximal sequence length and the feedforward size
+    of the encoder layers (4 x d_model for the small tokens of the sequence layout).
+    """
+    if sequence_input is None:
+        return None, 128, 2048
+    layer = SequenceInput(input_dims, **sequence_input)
+    return layer, max(128, layer.seq_length), 4 * input_dims
 
 
 class ActorNetwork(nn.Module):
-    def __init__(self, n_actions, input_dims, n_heads=4, n_layers=2, dropout_rate=1/4, static_input_dims=1):
+    def __init__(self, n_actions, input_dims, n_heads=4, n_layers=2, dropout_rate=1/4, static_input_dims=1,
+                 sequence_input=None):
         super(ActorNetwork, self).__init__()
         self.input_dims = input_dims
         self.static_input_dims = static_input_dims
@@ -143,10 +130,13 @@ class ActorNetwork(nn.Module):
         self.n_layers = n_layers
         self.dropout_rate = dropout_rate
 
-        encoder_layers = TransformerEncoderLayer(d_model=input_dims, nhead=n_heads, dropout=dropout_rate, batch_first=True)
-        self.transformer_encoder = TransformerEncoder(encoder_layer=encoder_layers, num_layers=n_layers)
+        # flat layout: one token of input_dims features, sequence layout: (look_back, variables) projected to input_dims
+        self.sequence_input, self.max_position_embeddings, dim_feedforward = sequence_input_layer(input_dims,
+                                                                                                  sequence_input)
 
-        self.max_position_embeddings = 128
+        encoder_layers = TransformerEncoderLayer(d_model=input_dims, nhead=n_heads, dim_feedforward=dim_feedforward,
+                                                 dropout=dropout_rate, batch_first=True)
+        self.transformer_encoder = TransformerEncoder(encoder_layer=encoder_layers, num_layers=n_layers)
         self.positional_encoding = nn.Parameter(torch.zeros(1, self.max_position_embeddings, input_dims))
         self.fc_static = nn.Linear(static_input_dims, input_dims)
 
@@ -160,6 +150,8 @@ class ActorNetwork(nn.Module):
         self.softmax = nn.Softmax(dim=-1)
 
     def forward(self, dynamic_state, static_state):
+        if self.sequence_input is not None:
+            dynamic_state = self.sequence_input(dynamic_state)
         batch_size, seq_length, _ = dynamic_state.size()
         positional_encoding = self.positional_encoding[:, :seq_length, :].expand(batch_size, -1, -1)
 
@@ -177,7 +169,8 @@ class ActorNetwork(nn.Module):
 
 
 class CriticNetwork(nn.Module):
-    def __init__(self, input_dims, n_heads=4, n_layers=2, dropout_rate=1 / 4, static_input_dims=1):
+    def __init__(self, input_dims, n_heads=4, n_layers=2, dropout_rate=1 / 4, static_input_dims=1,
+                 sequence_input=None):
         super(CriticNetwork, self).__init__()
         self.input_dims = input_dims
         self.static_input_dims = static_input_dims
@@ -185,10 +178,13 @@ class CriticNetwork(nn.Module):
         self.n_layers = n_layers
         self.dropout_rate = dropout_rate
 
-        encoder_layers = TransformerEncoderLayer(d_model=input_dims, nhead=n_heads, dropout=dropout_rate, batch_first=True)
-        self.transformer_encoder = TransformerEncoder(encoder_layer=encoder_layers, num_layers=n_layers)
+        # flat layout: one token of input_dims features, sequence layout: (look_back, variables) projected to input_dims
+        self.sequence_input, self.max_position_embeddings, dim_feedforward = sequence_input_layer(input_dims,
+                                                                                                  sequence_input)
 
-        self.max_position_embeddings = 128
+        encoder_layers = TransformerEncoderLayer(d_model=input_dims, nhead=n_heads, dim_feedforward=dim_feedforward,
+                                                 dropout=dropout_rate, batch_first=True)
+        self.transformer_encoder = TransformerEncoder(encoder_layer=encoder_layers, num_layers=n_layers)
         self.positional_encoding = nn.Parameter(torch.zeros(1, self.max_position_embeddings, input_dims))
         self.fc_static = nn.Linear(static_input_dims, input_dims)
 
@@ -200,6 +196,8 @@ class CriticNetwork(nn.Module):
         self.relu = nn.LeakyReLU()
 
     def forward(self, dynamic_state, static_state):
+        if self.sequence_input is not None:
+            dynamic_state = self.sequence_input(dynamic_state)
         batch_size, seq_length, _ = dynamic_state.size()
         positional_encoding = self.positional_encoding[:, :seq_length, :].expand(batch_size, -1, -1)
 
@@ -216,10 +214,92 @@ class CriticNetwork(nn.Module):
         return x
 
 
+class ScaleGradient(torch.autograd.Function):
+    """
+    Identity in the forward pass, scales the gradient in the backward pass.
+    """
+    @staticmethod
+    def forward(ctx, x, scale):
+        ctx.scale = scale
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output * ctx.scale, None
+
+
+class ActorCriticNetwork(nn.Module):
+    """
+    Actor and critic heads on one shared transformer encoder.
+
+    Called like ActorNetwork it returns the action probabilities, value returns the state value and evaluate both
+    from a single encoder pass. The gradient of the critic loss reaching the encoder is scaled by
+    critic_gradient_scale, the critic head itself gets the full gradient.
+    """
+    def __init__(self, n_actions, input_dims, n_heads=4, n_layers=2, dropout_rate=1/4, static_input_dims=1,
+                 critic_gradient_scale=0.5, sequence_input=None):
+        super(ActorCriticNetwork, self).__init__()
+        self.input_dims = input_dims
+        self.static_input_dims = static_input_dims
+        self.n_heads = n_heads
+        self.n_layers = n_layers
+        self.dropout_rate = dropout_rate
+        self.critic_gradient_scale = critic_gradient_scale
+
+        # flat layout: one token of input_dims features, sequence layout: (look_back, variables) projected to input_dims
+        self.sequence_input, self.max_position_embeddings, dim_feedforward = sequence_input_layer(input_dims,
+                                                                                                  sequence_input)
+
+        encoder_layers = TransformerEncoderLayer(d_model=input_dims, nhead=n_heads, dim_feedforward=dim_feedforward,
+                                                 dropout=dropout_rate, batch_first=True)
+        self.transformer_encoder = TransformerEncoder(encoder_layer=encoder_layers, num_layers=n_layers)
+        self.positional_encoding = nn.Parameter(torch.zeros(1, self.max_position_embeddings, input_dims))
+        self.fc_static = nn.Linear(static_input_dims, input_dims)
+
+        self.actor_head = nn.Sequential(nn.Linear(input_dims * 2, 512), nn.LeakyReLU(), nn.Linear(512, 256),
+                                        nn.LeakyReLU(), nn.Linear(256, n_actions), nn.Softmax(dim=-1))
+        self.critic_head = nn.Sequential(nn.Linear(input_dims * 2, 512), nn.LeakyReLU(), nn.Linear(512, 256),
+                                         nn.LeakyReLU(), nn.Linear(256, 1))
+
+    def encode(self, dynamic_state, static_state):
+        if self.sequence_input is not None:
+            dynamic_state = self.sequence_input(dynamic_state)
+        batch_size, seq_length, _ = dynamic_state.size()
+        positional_encoding = self.positional_encoding[:, :seq_length, :].expand(batch_size, -1, -1)
+
+        transformer_out = self.transformer_encoder(dynamic_state + positional_encoding)
+
+        static_state_encoded = self.fc_static(static_state.unsqueeze(1))
+        return torch.cat((transformer_out[:, -1, :], static_state_encoded.squeeze(1)), dim=1)
+
+    def forward(self, dynamic_state, static_state):
+        return self.actor_head(self.encode(dynamic_state, static_state))
+
+    def value(self, dynamic_state, static_state):
+        return self.critic_head(self.encode(dynamic_state, static_state))
+
+    def evaluate(self, dynamic_state, static_state):
+        features = self.encode(dynamic_state, static_state)
+        return self.actor_head(features), self.critic_head(ScaleGradient.apply(features, self.critic_gradient_scale))
+
+
+class SharedEncoderCritic(nn.Module):
+    """
+    The critic of an ActorCriticNetwork, called like CriticNetwork.
+    """
+    def __init__(self, actor_critic):
+        super(SharedEncoderCritic, self).__init__()
+        self.actor_critic = actor_critic
+
+    def forward(self, dynamic_state, static_state):
+        return self.actor_critic.value(dynamic_state, static_state)
+
+
 class PPO_Agent_T_1D_EURUSD:
     def __init__(self, n_actions, input_dims, gamma=0.95, alpha=0.001, gae_lambda=0.9, policy_clip=0.2, batch_size=1024,
                  n_epochs=20, mini_batch_size=128, entropy_coefficient=0.01, ec_decay_rate=0.999, weight_decay=0.0001, l1_lambda=1e-5,
-                 static_input_dims=1, lr_decay_rate=0.99):
+                 static_input_dims=1, lr_decay_rate=0.99, defer_critic=True, value_batch_size=1024, shared_encoder=False,
+                 critic_gradient_scale=0.5, input_layout='flat', n_variables=None, d_model=64, patch_size=1):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu") # Not sure why CPU is faster
         # self.device = torch.device("cpu")
         print(f"Using device: {self.device}")
@@ -233,19 +313,45 @@ class PPO_Agent_T_1D_EURUSD:
         self.l1_lambda = l1_lambda  # L1 regularization coefficient
         self.lr_decay_rate = lr_decay_rate  # Learning rate decay rate
         self.n_actions = n_actions  # Number of actions
-
-        # Initialize the actor and critic networks with static input dimensions
-        self.actor = ActorNetwork(self.n_actions, input_dims, static_input_dims=static_input_dims).to(self.device)
-        self.critic = CriticNetwork(input_dims, static_input_dims=static_input_dims).to(self.device)
-        self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=alpha, weight_decay=weight_decay)
-        self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=alpha, weight_decay=weight_decay)
+        self.defer_critic = defer_critic  # Critic values of the rollout computed in learn instead of choose_action
+        self.value_batch_size = value_batch_size  # Batch size of the deferred critic values
+        self.shared_encoder = shared_encoder  # One transformer encoder for the actor and the critic
+        self.input_layout = input_layout  # 'flat' (one token of variables * look_back) or 'sequence' (look_back tokens)
+
+        # The sequence layout feeds (look_back, n_variables) through an input projection to d_model features
+        sequence_input = None
+        if input_layout == 'sequence':
+            if not n_variables or input_dims % n_variables:
+                raise ValueError(f'input_dims {input_dims} is not a multiple of n_variables {n_variables}')
+            sequence_input = {'n_variables': n_variables, 'look_back': input_dims // n_variables,
+                              'patch_size': patch_size}
+            input_dims = d_model
+        elif input_layout != 'flat':
+            raise ValueError(f"Unknown input layout {input_layout}, use 'flat' or 'sequence'")
+
+        if shared_encoder:
+            # Actor and critic heads on one encoder, trained with one optimizer on the sum of the losses
+            self.actor = ActorCriticNetwork(self.n_actions, input_dims, static_input_dims=static_input_dims,
+                                            critic_gradient_scale=critic_gradient_scale,
+                                            sequence_input=sequence_input).to(self.device)
+            self.critic = SharedEncoderCritic(self.actor)
+            self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=alpha, weight_decay=weight_decay)
+            self.critic_optimizer = None
+        else:
+            # Initialize the actor and critic networks with static input dimensions
+            self.actor = ActorNetwork(self.n_actions, input_dims, static_input_dims=static_input_dims,
+                                      sequence_input=sequence_input).to(self.device)
+            self.critic = CriticNetwork(input_dims, static_input_dims=static_input_dims,
+                                        sequence_input=sequence_input).to(self.device)
+            self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=alpha, weight_decay=weight_decay)
+            self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=alpha, weight_decay=weight_decay)
 
         # Learning rate schedulers
         self.actor_scheduler = ExponentialLR(self.actor_optimizer, gamma=self.lr_decay_rate)
-        self.critic_scheduler = ExponentialLR(self.critic_optimizer, gamma=self.lr_decay_rate)
+        self.critic_scheduler = None if shared_encoder else ExponentialLR(self.critic_optimizer, gamma=self.lr_decay_rate)
 
         # Memory for storing experiences
-        self.memory = PPOMemory(batch_size, self.device)
+        self.memory = RolloutBuffer(batch_size, self.device)
 
         # track the generation of the agent
         self.generation = 0
@@ -262,50 +368,33 @@ class PPO_Agent_T_1D_EURUSD:
         self.actor.train()
         self.critic.train()
 
-        # Stack the tensors in the memory
-        self.memory.stack_tensors()
-
-        # Generating the data for the entire batch, including static states
-        state_arr, action_arr, old_prob_arr, vals_arr, reward_arr, dones_arr, static_states_arr, batches = self.memory.generate_batches()
+        # The transitions of the rollout on the device, in the order of the rollout
+        state_arr, action_arr, old_prob_arr, vals_arr, reward_arr, dones_arr, static_states_arr = self.memory.tensors()
 
-        # Convert arrays to tensors and move to the device
-        state_arr = state_arr.clone().detach().to(self.device)  # Dynamic states ie time series data
-        action_arr = action_arr.clone().detach().to(self.device)  # Actions
-        old_prob_arr = old_prob_arr.clone().detach().to(self.device)  # Old action probabilities
-        vals_arr = vals_arr.clone().detach().to(self.device)  # State values
-        reward_arr = reward_arr.clone().detach().to(self.device)  # Rewards
-        dones_arr = dones_arr.clone().detach().to(self.device)  # Done flags
-        static_states_arr = static_states_arr.clone().detach().to(self.device)  # Static states
+        # Critic values of the rollout in a few large batches, if they were not computed during the collection
+        if self.defer_critic:
+            vals_arr = self.estimate_values(state_arr, static_states_arr)
 
         # Compute advantages and discounted rewards
         advantages, discounted_rewards = self.compute_discounted_rewards(reward_arr, vals_arr,
                                                                          dones_arr)
-        advantages = advantages.clone().detach().to(self.device)
-        discounted_rewards = discounted_rewards.clone().detach().to(self.device)
 
         # Loop through the optimization epochs
         for _ in range(self.n_epochs):
 
-            # Creating mini-batches and training
-            num_samples = len(state_arr)
-            indices = np.arange(num_samples)
-            np.random.shuffle(indices)
-
-            # Loop through mini-batches
-            for start_idx in range(0, num_samples, self.mini_batch_size):
-                minibatch_indices = indices[start_idx:start_idx + self.mini_batch_size]
-
-                # Convert arrays to tensors and move to the device
-                batch_states = state_arr[minibatch_indices].clone().detach().to(self.device)
-                batch_actions = action_arr[minibatch_indices].clone().detach().to(self.device)
-                batch_old_probs = old_prob_arr[minibatch_indices].clone().detach().to(self.device)
-                batch_advantages = advantages[minibatch_indices].clone().detach().to(self.device)
-                batch_returns = discounted_rewards[minibatch_indices].clone().detach().to(self.device)
-                batch_static_states = static_states_arr[minibatch_indices].clone().detach().to(self.device)
+            # Loop through the shuffled mini-batches
+            for minibatch_indices in self.memory.minibatch_indices(self.mini_batch_size):
+                batch_states = state_arr[minibatch_indices]
+                batch_actions = action_arr[minibatch_indices]
+                batch_old_probs = old_prob_arr[minibatch_indices]
+                batch_advantages = advantages[minibatch_indices]
+                batch_returns = discounted_rewards[minibatch_indices]
+                batch_static_states = static_states_arr[minibatch_indices]
 
                 # Zero the gradients before the backward pass
                 self.actor_optimizer.zero_grad()
-                self.critic_optimizer.zero_grad()
+                if not self.shared_encoder:
+                    self.critic_optimizer.zero_grad()
 
                 # Calculate actor and critic losses, include static states in forward passes
                 new_probs, dist_entropy, actor_loss, critic_loss = self.calculate_loss(batch_states,
@@ -316,14 +405,19 @@ class PPO_Agent_T_1D_EURUSD:
                                                                                        batch_static_states)
 
                 # Perform backpropagation and optimization steps for both actor and critic networks
-                actor_loss.backward()
-                self.actor_optimizer.step()
-                critic_loss.backward()
-                self.critic_optimizer.step()
+                if self.shared_encoder:
+                    (actor_loss + critic_loss).backward()
+                    self.actor_optimizer.step()
+                else:
+                    actor_loss.backward()
+                    self.actor_optimizer.step()
+                    critic_loss.backward()
+                    self.critic_optimizer.step()
 
             # Decay learning rate
             self.actor_scheduler.step()
-            self.critic_scheduler.step()
+            if not self.shared_encoder:
+                self.critic_scheduler.step()
 
         # Clear memory after learning
         self.memory.clear_memory()
@@ -348,8 +442,12 @@ class PPO_Agent_T_1D_EURUSD:
         if batch_states.dim() == 2:
             batch_states = batch_states.unsqueeze(1)
 
-        # Actor loss calculations
-        new_probs = self.actor(batch_states, batch_static_states)
+        # Actor loss calculations, with the critic values of the same encoder pass for a shared encoder
+        if self.shared_encoder:
+            new_probs, critic_values = self.actor.evaluate(batch_states, batch_static_states)
+        else:
+            new_probs = self.actor(batch_states, batch_static_states)
+            critic_values = self.critic(batch_states, batch_static_states)
 
         # Calculate the probability ratio and the surrogate loss
         dist = torch.distributions.Categorical(new_probs)
@@ -370,33 +468,29 @@ class PPO_Agent_T_1D_EURUSD:
         actor_loss = -torch.min(surr1, surr2).mean() - self.entropy_coefficient * dist.entropy().mean()
 
         # Critic loss calculations
-        critic_values = self.critic(batch_states, batch_static_states).squeeze(-1)
+        critic_values = critic_values.squeeze(-1)
         critic_loss = (batch_returns - critic_values).pow(2).mean()
 
         return new_probs, dist.entropy(), actor_loss, critic_loss
 
-    def compute_discounted_rewards(self, rewards, values, dones):
-        n = len(rewards)
-        advantages = torch.zeros_like(rewards)
-        discounted_rewards = torch.zeros_like(rewards)
-
-        # Ensure 'dones' is a float tensor for arithmetic operations
-        dones_float = dones.float()
-
-        # Append zero to the end of the values tensor for the terminal value calculation
-        next_values = torch.cat([values[1:], torch.tensor([0.0], device=self.device)])
-
-        # Compute deltas using tensors; all operations should now be valid
-        deltas = rewards + self.gamma * next_values * (1 - dones_float) - values
-
-        lastgaelam = 0
-        for t in reversed(range(n)):
-            lastgaelam = deltas[t] + self.gamma * self.gae_lambda * lastgaelam * (1 - dones_float[t])
-            advantages[t] = lastgaelam
-
-        discounted_rewards = advantages + values
+    @torch.no_grad()
+    def estimate_values(self, states, static_states):
+        """
+        Critic values of the stored states in batches of value_batch_size (in eval mode), the values of the rollout
+        when the critic is not run in choose_action (defer_critic).
+        """
+        # in eval mode (no dropout), the mode of the critic is restored afterwards
+        training = self.critic.training
+        self.critic.eval()
+        values = [self.critic(states[start:start + self.value_batch_size].unsqueeze(1),
+                              static_states[start:start + self.value_batch_size]).squeeze(-1)
+                  for start in range(0, len(states), self.value_batch_size)]
+        self.critic.train(training)
+        return torch.cat(values)
 
-        return advantages, discounted_rewards
+    def compute_discounted_rewards(self, rewards, values, dones):
+        # GAE advantages and returns of the rollout in one reverse scan
+        return compute_gae(rewards, values, dones, self.gamma, self.gae_lambda)
 
     @torch.no_grad()
     def choose_action(self, observation, static_input):
@@ -416,7 +510,11 @@ class PPO_Agent_T_1D_EURUSD:
             state = state.view(1, -1, state.size(-1))
 
         # Pass the state and static_input_tensor through the actor network to get the action probabilities
-        probs = self.actor(state, static_input_tensor)
+        # (and the state value with the shared encoder, one encoder pass for both)
+        if self.shared_encoder and not self.defer_critic:
+            probs, value = self.actor.evaluate(state, static_input_tensor)
+        else:
+            probs, value = self.actor(state, static_input_tensor), None
 
         # Create a categorical distribution over the list of probabilities of actions
         dist = torch.distributions.Categorical(probs)
@@ -427,8 +525,13 @@ class PPO_Agent_T_1D_EURUSD:
         # Calculate the log probability of the action in the distribution
         log_prob = dist.log_prob(action)
 
+        # The state value is estimated in learn for the whole rollout
+        if self.defer_critic:
+            return action.item(), log_prob.item(), None
+
         # Pass the state and static_input_tensor through the critic network to get the state value
-        value = self.critic(state, static_input_tensor)
+        if value is None:
+            value = self.critic(state, static_input_tensor)
 
         # Return the sampled action, its log probability, and the state value
         # Convert tensors to Python numbers using .item()
@@ -463,6 +566,19 @@ class PPO_Agent_T_1D_EURUSD:
         # Return the action probabilities as a NumPy array
         return action_probs
 
+    @torch.no_grad()
+    def get_action_probabilities_batch(self, observations, static_inputs):
+        """
+        Action probabilities for a batch of observations, same as get_action_probabilities row by row.
+        """
+        # Reshape observations to [batch size, sequence length, feature dimension]
+        state = torch.tensor(np.asarray(observations), dtype=torch.float).to(self.device).unsqueeze(1)
+        static_input_tensor = torch.tensor(np.asarray(static_inputs), dtype=torch.float).to(self.device)
+
+        action_probs = self.actor(state, static_input_tensor)
+
+        return action_probs.cpu().numpy()
+
     @torch.no_grad()
     def choose_best_action(self, observation, static_input):
         # Use the get_action_probabilities method to get the action probabilities for the given observation and static input
@@ -480,6 +596,202 @@ class PPO_Agent_T_1D_EURUSD:
         return self.__class__.__name__
 
 
+def walk_forward_step(move_forward, validation_date, test_date, end_date, look_back, variables, tradable_markets,
+                      provision, leverage, starting_balance, results_store_path, run, step_data):
+    """
+    One walk forward step, run in its own process by BF.WalkForwardOrchestrator: trains a fresh agent, selects the
+    generation with the best validation Sharpe Ratio and returns its test results (with the step's starting balance,
+    the steps are chained by BF.stitch_walk_forward). step_data holds the datasets of the step
+    (prepare_walk_forward_data), prepared in the background while the previous steps trained.
+    """
+    # Set seeds for reproducibility
+    torch.manual_seed(0)
+    np.random.seed(0)
+    random.seed(0)
+
+    results_store = BF.BacktestResultsStore(results_store_path, run=run)
+
+    print("validation_date", validation_date)
+    print("test_date", test_date)
+    print("end_date", end_date)
+
+    # train, validation and test sets of the step and their rolling windows, shared memory views (zero-copy)
+    step_datasets = step_data.load()
+    df_train, df_validation, df_test = step_datasets['train'], step_datasets['validation'], step_datasets['test']
+
+    num_episodes = 5  # 50
+
+    # Create an instance of the agent
+    agent = PPO_Agent_T_1D_EURUSD(n_actions=3,  # sell, hold money, buy
+                                  input_dims=len(variables) * look_back,  # input dimensions
+                                  gamma=0.75,  # discount factor of future rewards
+                                  alpha=0.0005,  # learning rate for networks (actor and critic) high as its decaying at least 0.0001
+                                  gae_lambda=0.75,  # lambda for generalized advantage estimation
+                                  policy_clip=0.25,  # clip parameter for PPO
+                                  entropy_coefficient=10,  # higher entropy coefficient encourages exploration
+                                  ec_decay_rate=0.99,  # entropy coefficient decay rate
+                                  batch_size=1024,  # size of the memory
+                                  n_epochs=1,  # number of epochs
+                                  mini_batch_size=128,  # size of the mini-batches
+                                  weight_decay=0.0000005,  # weight decay
+                                  l1_lambda=1e-7,  # L1 regularization lambda
+                                  static_input_dims=1,  # static input dimensions (current position)
+                                  lr_decay_rate=0.995,  # learning rate decay rate
+                                  shared_encoder=False,  # one transformer encoder for the actor and the critic
+                                  critic_gradient_scale=0.5,  # scale of the critic gradient in the shared encoder
+                                  input_layout='flat',  # 'sequence' feeds (look_back, variables) to the encoder
+                                  n_variables=len(variables),  # variables of the sequence layout
+                                  d_model=64,  # features of the tokens of the sequence layout
+                                  patch_size=1,  # bars per token of the sequence layout (for long look-backs)
+                                  )
+    total_rewards, episode_durations, total_balances = [], [], []
+    episode_probabilities = {'train': [], 'validation': [], 'test': []}
+
+    index = pd.MultiIndex.from_product([range(num_episodes), ['validation', 'test']], names=['episode', 'dataset'])
+    columns = ['Final Balance', 'Dataset Index']
+    backtest_results = pd.DataFrame(index=index, columns=columns)
+
+    test_rolling_datasets = step_datasets['test_windows']
+    val_rolling_datasets = step_datasets['validation_windows']
+
+    # Generate index labels for each rolling window dataset
+    val_labels = generate_index_labels(val_rolling_datasets, 'validation')
+    test_labels = generate_index_labels(test_rolling_datasets, 'test')
+    all_labels = val_labels + test_labels
+
+    # worker processes keep the validation and test windows loaded for all generations of this walk forward step
+    backtest_executor = BF.BacktestExecutor(val_rolling_datasets + test_rolling_datasets, all_labels,
+                                            BF.backtest_wrapper, tradable_markets, look_back, variables, provision,
+                                            starting_balance, leverage, Trading_Environment_Basic,
+                                            reward_calculation, workers=4)
+
+    # Rolling DF
+    rolling_datasets = step_datasets['train_windows']
+    dataset_iterator = cycle(rolling_datasets)
+
+    backtest_results = {}
+    # full probabilities and balances only for the top generations by the validation Sharpe Ratio
+    trace_selector = BF.GenerationTraceSelector(backtest_results, top_k=3, metric='Sharpe Ratio',
+                                                label_prefix='validation')
+    probs_dfs, balances_dfs = trace_selector.probabilities, trace_selector.balances
+    evaluation_service = BF.EvaluationService(backtest_executor, 'PPO', backtest_results, probs_dfs,
+                                              balances_dfs, max_in_flight=2)
+    generation = 0
+
+    for episode in tqdm(range(num_episodes)):
+        start_time = time.time()
+
+        window_df = next(dataset_iterator)
+        dataset_index = episode % len(rolling_datasets)
+
+        print(f"\nEpisode {episode + 1}: Learning from dataset with Start Date = {window_df.index.min()}, End Date = {window_df.index.max()}, len = {len(window_df)}")
+
+        # Create a new environment with the randomly selected window's data
+        env = Trading_Environment_Basic(window_df, look_back=look_back, variables=variables,
+                                        tradable_markets=tradable_markets, provision=provision,
+                                        initial_balance=starting_balance, leverage=leverage,
+                                        reward_function=reward_calculation)
+
+        observation = env.reset()
+        done = False
+        initial_balance = env.balance
+
+        while not done:
+            current_position = env.current_position
+            action, prob, val = agent.choose_action(observation, env.current_position)
+            observation_, reward, done, info = env.step(action)
+            agent.store_transition(observation, action, prob, val, reward, done, current_position)
+            observation = observation_
+
+            # Check if enough data is collected or if the dataset ends
+            if agent.memory.full:
+                agent.learn()
+                agent.memory.clear_memory()
+
+            if generation < agent.generation:
+                # the new generation is evaluated in the background, the training continues
+                evaluation_service.submit(agent)
+                generation = agent.generation
+
+        # results
+        end_time = time.time()
+        episode_time = end_time - start_time
+        total_rewards.append(env.reward_sum)
+        episode_durations.append(episode_time)
+        total_balances.append(env.balance)
+
+        print(
+            f"Completed learning from selected window in episode {episode + 1}: Total Reward: {env.reward_sum}, Total Balance: {env.balance:.2f}, Duration: {episode_time:.2f} seconds, current Entropy Coefficient: {agent.entropy_coefficient:.2f}")
+        print(f'Final Balance of Buy and Hold benchmark agent: ', BF.benchmark_backtest(
+            window_df, 1, tradable_markets, look_back, provision, starting_balance, leverage,
+            reward_calculation)[0])
+
+    # wait for the evaluation of the last generations
+    evaluation_service.drain()
+
+    buy_and_hold_agent = Buy_and_hold_Agent()
+    sell_and_hold_agent = Sell_and_hold_Agent()
+    # TODO
+    # Run backtesting for both agents
+    bah_results, _, benchmark_BAH = BF.run_backtesting(
+        buy_and_hold_agent, 'BAH', val_rolling_datasets + test_rolling_datasets, val_labels + test_labels,
+        BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
+        Trading_Environment_Basic, reward_calculation, workers=4, executor=backtest_executor)
+
+    sah_results, _, benchmark_SAH = BF.run_backtesting(
+        sell_and_hold_agent, 'SAH', val_rolling_datasets + test_rolling_datasets, val_labels + test_labels,
+        BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
+        Trading_Environment_Basic, reward_calculation, workers=4, executor=backtest_executor)
+
+    backtest_executor.shutdown()
+
+    # one indexed store for the agent and benchmark results of all walk forward steps, a resumed step replaces its rows
+    results_store.insert(backtest_results, step=move_forward, replace_step=True)
+    results_store.insert(bah_results, step=move_forward, replace_step=True)
+    results_store.insert(sah_results, step=move_forward, replace_step=True)
+
+    benchmark_balances = results_store.query(step=move_forward, agent_type=['BAH', 'SAH'], label=test_labels[0])
+    benchmark_balances = benchmark_balances.set_index('agent_type')['Final Balance']
+    print('buy and hold final balance', benchmark_balances['BAH'])
+    print('sell and hold final balance', benchmark_balances['SAH'])
+
+    # Find the generation with the maximum Sharpe Ratio in the validation set
+    best_sharpe_index = results_store.best_generation('Sharpe Ratio', step=move_forward, agent_type='PPO',
+                                                      label_prefix='validation')
+
+    # if nan in the sharpe ratios, take the last one
+    if best_sharpe_index is None:
+        best_sharpe_index = trace_selector.best_generation()
+
+    # Extract the test result of the best generation
+    best_result = results_store.query(step=move_forward, agent_type='PPO', generation=best_sharpe_index,
+                                      label=test_labels[0])
+
+    # Extract the corresponding balances for the best result
+    agent_generation = best_sharpe_index
+    balances_key = (agent_generation, test_labels[0])
+    best_balances = balances_dfs.get(balances_key, [])
+
+    probs_key = (agent_generation, test_labels[0])
+    best_probs = probs_dfs.get(probs_key, np.empty((0, 3), dtype=np.float32))
+    best_probs_df = BF.probabilities_to_frame(best_probs, action_column=f'{agent.get_name()}_Action')
+    best_balances_df = pd.DataFrame(best_balances, columns=[f'{agent.get_name()}_Balances'])
+
+    dates = df_test.iloc[look_back:-1].index
+    best_balances_df['Date'] = dates
+    best_probs_df['Date'] = dates
+    close_prices = df_test['Close', tradable_markets].reset_index()
+    close_prices = close_prices.iloc[look_back:-1]
+    close_prices.columns = ['Date', f'Close_{tradable_markets}']
+
+    best_balances_df = pd.merge(best_balances_df, close_prices, on='Date', how='outer')
+    best_balances_df = pd.merge(best_balances_df, best_probs_df, on='Date', how='outer')
+    print(f"Final Balance of the step: {best_balances_df[f'{agent.get_name()}_Balances'].iloc[-1]:.2f}")
+
+    return {'final_test_results': best_balances_df, 'provision_sum': best_result['Provision_sum'].sum(),
+            'starting_balance': starting_balance, 'agent_name': agent.get_name()}
+
+
 if __name__ == '__main__':
     # time the execution
     start_time_X = time.time()
@@ -494,322 +806,88 @@ if __name__ == '__main__':
     end_date = '2020-01-01'
     test_date_2 = test_date
 
-    final_test_results = pd.DataFrame()
     final_balance = 10000
 
     # Example usage
     # Stock market variables
     df = load_data_parallel(['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], '1D')
 
-    indicators = [
-        {"indicator": "RSI", "mkf": "EURUSD", "length": 14},
-        {"indicator": "ATR", "mkf": "EURUSD", "length": 36},
-        {"indicator": "MACD", "mkf": "EURUSD"},
-        {"indicator": "Stochastic", "mkf": "EURUSD"}, ]
-
-    return_indicators = [
-        {"price_type": "Close", "mkf": "EURUSD"},
-        {"price_type": "Close", "mkf": "USDJPY"},
-        {"price_type": "Close", "mkf": "EURJPY"},
-        {"price_type": "Close", "mkf": "GBPUSD"},
+    feature_spec = [
+        {"feature": "RSI", "mkf": "EURUSD", "length": 14, "scale": 1 / 100},
+        {"feature": "ATR", "mkf": "EURUSD", "length": 36},
+        {"feature": "MACD", "mkf": "EURUSD"},
+        {"feature": "Stochastic", "mkf": "EURUSD"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "EURUSD"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "USDJPY"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "EURJPY"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "GBPUSD"},
+        {"feature": "Time", "timestamp": "1W", "scale": 1 / 2, "shift": 0.5},
     ]
-    add_indicators(df, indicators)
-    add_returns(df, return_indicators)
-
-    add_time_sine_cosine(df, '1W')
-    df[("sin_time_1W", "")] = df[("sin_time_1W", "")] / 2 + 0.5
-    df[("cos_time_1W", "")] = df[("cos_time_1W", "")] / 2 + 0.5
-    df[("RSI_14", "EURUSD")] = df[("RSI_14", "EURUSD")] / 100
+    feature_pipeline = FeaturePipeline(feature_spec)
+    df = feature_pipeline.transform(df)
 
     look_back = 20
-    df = df.dropna()
 
-    # tracking
-    provision_sum_test_final = 0
+    variables = [
+        {"variable": ("Close", "USDJPY"), "edit": "normalize"},
+        {"variable": ("Close", "EURUSD"), "edit": "normalize"},
+        {"variable": ("Close", "EURJPY"), "edit": "normalize"},
+        {"variable": ("Close", "GBPUSD"), "edit": "normalize"},
+        {"variable": ("RSI_14", "EURUSD"), "edit": "standardize"},
+        {"variable": ("ATR_36", "EURUSD"), "edit": "standardize"},
+        {"variable": ("K%", "EURUSD"), "edit": "standardize"},
+        {"variable": ("D%", "EURUSD"), "edit": "standardize"},
+        {"variable": ("MACD_Line", "EURUSD"), "edit": "standardize"},
+        {"variable": ("Signal_Line", "EURUSD"), "edit": "standardize"},
+        {"variable": ("cos_time_1W", ""), "edit": None},
+        {"variable": ("Returns_Close", "EURUSD"), "edit": None},
+        {"variable": ("Returns_Close", "USDJPY"), "edit": None},
+        {"variable": ("Returns_Close", "EURJPY"), "edit": None},
+        {"variable": ("Returns_Close", "GBPUSD"), "edit": None},
+    ]
+
+    tradable_markets = 'EURUSD'
+    # Provision is the cost of trading, it is a percentage of the trade size, current real provision on FOREX is 0.0001
+    provision = 0.0001  # 0.001, cant be too high as it would not learn to trade
+
+    # Environment parameters
+    leverage = 1
+
+    # the walk forward steps only depend on each other through the starting balance (rescaled by stitch_walk_forward),
+    # they run in parallel processes, every finished step is checkpointed and a rerun resumes from the finished steps,
+    # the datasets of the next steps are prepared in the background while the current steps train
+    orchestrator = BF.WalkForwardOrchestrator(walk_forward_step, 'walk_forward_checkpoints/PPO_T', cores_per_step=5,
+                                              prepare_function=prepare_walk_forward_data)
+    results_store = BF.BacktestResultsStore('backtest_results.sqlite', run=f'PPO_T_{orchestrator.run_id}')
 
+    steps, prepare_steps = {}, {}
     for move_forward in range(1, 6):
-        print("validation_date", validation_date)
-        print("test_date", test_date)
-        print("end_date", end_date)
-
-        # Example usage
-        # Stock market variables
-        df = load_data_parallel(['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], '1D')
-
-        add_indicators(df, indicators)
-        add_returns(df, return_indicators)
-
-        add_time_sine_cosine(df, '1W')
-        df[("sin_time_1W", "")] = df[("sin_time_1W", "")] / 2 + 0.5
-        df[("cos_time_1W", "")] = df[("cos_time_1W", "")] / 2 + 0.5
-        df[("RSI_14", "EURUSD")] = df[("RSI_14", "EURUSD")] / 100
-
-        df = df.dropna()
-
-        # data before 2006 has some missing values ie gaps in the data, also in march, april 2023 there are some gaps
-        df_train, df_validation, df_test = df[start_date:validation_date], df[validation_date:test_date], df[
-                                                                                                          test_date:end_date]
-        df_validation = pd.concat([df_train.iloc[-look_back:], df_validation])
-        df_test = pd.concat([df_validation.iloc[-look_back:], df_test])
-
-        variables = [
-            {"variable": ("Close", "USDJPY"), "edit": "normalize"},
-            {"variable": ("Close", "EURUSD"), "edit": "normalize"},
-            {"variable": ("Close", "EURJPY"), "edit": "normalize"},
-            {"variable": ("Close", "GBPUSD"), "edit": "normalize"},
-            {"variable": ("RSI_14", "EURUSD"), "edit": "standardize"},
-            {"variable": ("ATR_36", "EURUSD"), "edit": "standardize"},
-            {"variable": ("K%", "EURUSD"), "edit": "standardize"},
-            {"variable": ("D%", "EURUSD"), "edit": "standardize"},
-            {"variable": ("MACD_Line", "EURUSD"), "edit": "standardize"},
-            {"variable": ("Signal_Line", "EURUSD"), "edit": "standardize"},
-            {"variable": ("cos_time_1W", ""), "edit": None},
-            {"variable": ("Returns_Close", "EURUSD"), "edit": None},
-            {"variable": ("Returns_Close", "USDJPY"), "edit": None},
-            {"variable": ("Returns_Close", "EURJPY"), "edit": None},
-            {"variable": ("Returns_Close", "GBPUSD"), "edit": None},
-        ]
-
-        tradable_markets = 'EURUSD'
-        window_size = '1Y'
-        starting_balance = final_balance
-        # Provision is the cost of trading, it is a percentage of the trade size, current real provision on FOREX is 0.0001
-        provision = 0.0001  # 0.001, cant be too high as it would not learn to trade
-
-        # Environment parameters
-        leverage = 1
-        num_episodes = 5  # 50
-
-        # Create an instance of the agent
-        agent = PPO_Agent_T_1D_EURUSD(n_actions=3,  # sell, hold money, buy
-                                      input_dims=len(variables) * look_back,  # input dimensions
-                                      gamma=0.75,  # discount factor of future rewards
-                                      alpha=0.0005,  # learning rate for networks (actor and critic) high as its decaying at least 0.0001
-                                      gae_lambda=0.75,  # lambda for generalized advantage estimation
-                                      policy_clip=0.25,  # clip parameter for PPO
-                                      entropy_coefficient=10,  # higher entropy coefficient encourages exploration
-                                      ec_decay_rate=0.99,  # entropy coefficient decay rate
-                                      batch_size=1024,  # size of the memory
-                                      n_epochs=1,  # number of epochs
-                                      mini_batch_size=128,  # size of the mini-batches
-                                      weight_decay=0.0000005,  # weight decay
-                                      l1_lambda=1e-7,  # L1 regularization lambda
-                                      static_input_dims=1,  # static input dimensions (current position)
-                                      lr_decay_rate=0.995,  # learning rate decay rate
-                                      )
-        total_rewards, episode_durations, total_balances = [], [], []
-        episode_probabilities = {'train': [], 'validation': [], 'test': []}
-
-        index = pd.MultiIndex.from_product([range(num_episodes), ['validation', 'test']], names=['episode', 'dataset'])
-        columns = ['Final Balance', 'Dataset Index']
-        backtest_results = pd.DataFrame(index=index, columns=columns)
-
-        window_size_2 = '2Y'
-        test_rolling_datasets = rolling_window_datasets(df_test, window_size=window_size_2, look_back=look_back)
-        val_rolling_datasets = rolling_window_datasets(df_validation, window_size=window_size_2, look_back=look_back)
-
-        # Generate index labels for each rolling window dataset
-        val_labels = generate_index_labels(val_rolling_datasets, 'validation')
-        test_labels = generate_index_labels(test_rolling_datasets, 'test')
-        all_labels = val_labels + test_labels
-
-        # Rolling DF
-        rolling_datasets = rolling_window_datasets(df_train, window_size=window_size, look_back=look_back)
-        dataset_iterator = cycle(rolling_datasets)
-
-        backtest_results, probs_dfs, balances_dfs = {}, {}, {}
-        generation = 0
-
-        for episode in tqdm(range(num_episodes)):
-            start_time = time.time()
-
-            window_df = next(dataset_iterator)
-            dataset_index = episode % len(rolling_datasets)
-
-            print(f"\nEpisode {episode + 1}: Learning from dataset with Start Date = {window_df.index.min()}, End Date = {window_df.index.max()}, len = {len(window_df)}")
-
-            # Create a new environment with the randomly selected window's data
-            env = Trading_Environment_Basic(window_df, look_back=look_back, variables=variables,
-                                            tradable_markets=tradable_markets, provision=provision,
-                                            initial_balance=starting_balance, leverage=leverage,
-                                            reward_function=reward_calculation)
-
-            observation = env.reset()
-            done = False
-            initial_balance = env.balance
-
-            while not done:
-                current_position = env.current_position
-                action, prob, val = agent.choose_action(observation, env.current_position)
-                observation_, reward, done, info = env.step(action)
-                agent.store_transition(observation, action, prob, val, reward, done, current_position)
-                observation = observation_
-
-                # Check if enough data is collected or if the dataset ends
-                if len(agent.memory.states) >= agent.memory.batch_size:
-                    agent.learn()
-                    agent.memory.clear_memory()
-
-                if generation < agent.generation:
-                    with ThreadPoolExecutor(max_workers=4) as executor:
-                        futures = []
-                        # Combine validation and test datasets and labels for processing
-                        for df, label in zip(val_rolling_datasets + test_rolling_datasets, val_labels + test_labels):
-                            future = executor.submit(
-                                BF.backtest_wrapper, 'PPO', df, agent, tradable_markets, look_back,
-                                variables, provision, starting_balance, leverage,
-                                Trading_Environment_Basic, reward_calculation
-                            )
-                            futures.append((future, label))
-
-                        # Process futures as they complete
-                        for future, label in futures:
-                            result = future.result()
-                            # Make sure to update these variables to match the exact structure of the data being returned
-                            balance, total_reward, number_of_trades, probs_df, action_df, sharpe_ratio, max_drawdown, \
-                                sortino_ratio, calmar_ratio, cumulative_returns, balances, provision_sum, max_drawdown_duration, \
-                                average_trade_duration, in_long, in_short, in_out_of_market = result
-
-                            # Populate a dictionary with the results
-                            result_data = {
-                                'Agent generation': agent.generation,
-                                'Label': label,
-                                'Provision_sum': provision_sum,
-                                'Final Balance': balance,
-                                'Total Reward': total_reward,
-                                'Number of Trades': number_of_trades,
-                                'Sharpe Ratio': sharpe_ratio,
-                                'Max Drawdown': max_drawdown,
-                                'Sortino Ratio': sortino_ratio,
-                                'Calmar Ratio': calmar_ratio,
-                                'Max Drawdown Duration': max_drawdown_duration,
-                                'Average Trade Duration': average_trade_duration,
-                                'In Long': in_long,
-                                'In Short': in_short,
-                                'In Out of the Market': in_out_of_market,
-                            }
-
-                            key = (agent.generation, label)
-                            backtest_results.setdefault(key, []).append(result_data)
-                            probs_dfs[key] = probs_df
-                            balances_dfs[key] = balances
-
-                        generation = agent.generation
-                        print(f"Backtesting completed for {agent.get_name()} generation {generation}")
-
-            # results
-            end_time = time.time()
-            episode_time = end_time - start_time
-            total_rewards.append(env.reward_sum)
-            episode_durations.append(episode_time)
-            total_balances.append(env.balance)
-
-            print(
-                f"Completed learning from selected window in episode {episode + 1}: Total Reward: {env.reward_sum}, Total Balance: {env.balance:.2f}, Duration: {episode_time:.2f} seconds, current Entropy Coefficient: {agent.entropy_coefficient:.2f}")
-            print(f'Final Balance of Buy and Hold benchmark agent: ', starting_balance * (1 + (
-                        window_df[('Close', tradable_markets)].iloc[-1] - window_df[('Close', tradable_markets)].iloc[
-                    look_back]) / window_df[('Close', tradable_markets)].iloc[look_back] * leverage))
-            # TODO do this as cached function with benchmark agents and df as input
-
-        buy_and_hold_agent = Buy_and_hold_Agent()
-        sell_and_hold_agent = Sell_and_hold_Agent()
-        # TODO
-        # Run backtesting for both agents
-        bah_results, _, benchmark_BAH = BF.run_backtesting(
-            buy_and_hold_agent, 'BAH', val_rolling_datasets + test_rolling_datasets, val_labels + test_labels,
-            BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
-            Trading_Environment_Basic, reward_calculation, workers=4)
-
-        sah_results, _, benchmark_SAH = BF.run_backtesting(
-            sell_and_hold_agent, 'SAH', val_rolling_datasets + test_rolling_datasets, val_labels + test_labels,
-            BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
-            Trading_Environment_Basic, reward_calculation, workers=4)
-
-        bah_results_prepared = prepare_backtest_results(bah_results, 'BAH')
-        sah_results_prepared = prepare_backtest_results(sah_results, 'SAH')
-
-        sah_results_prepared = sah_results_prepared.drop(('', 'Agent Generation'),
-                                                         axis=1)  # drop the agent generation column
-        bah_results_prepared = bah_results_prepared.drop(('', 'Agent Generation'),
-                                                         axis=1)  # drop the agent generation column
-
-        print('buy and hold final balance', bah_results_prepared[('BAH', 'Final Balance')][1])
-        print('sell and hold final balance', sah_results_prepared[('SAH', 'Final Balance')][1])
-
-        # Merge BAH and SAH results on 'Label'
-        new_backtest_results = pd.merge(bah_results_prepared, sah_results_prepared, on=[('', 'Label')], how='outer')
-
-        backtest_results = prepare_backtest_results(backtest_results, agent.get_name())
-        backtest_results = pd.merge(backtest_results, new_backtest_results, on=[('', 'Label')], how='outer')
-        backtest_results = backtest_results.set_index([('', 'Agent Generation')])
-
-        label_series = backtest_results[('', 'Label')]
-        backtest_results = backtest_results.drop(('', 'Label'), axis=1)
-        backtest_results['Label'] = label_series
-
-        sharpe_ratios = backtest_results[(agent.get_name(), 'Sharpe Ratio')]
-
-        # Find the index of the maximum Sharpe Ratio in the validation set
-        best_sharpe_index = sharpe_ratios.idxmax()
-
-        # if nan in the sharpe ratios, take the last one
-        if pd.isna(best_sharpe_index):
-            best_sharpe_index = agent.generation - 1
-
-        # Extract the best result row
-        best_result = backtest_results.loc[best_sharpe_index]
-
-        # Convert the result to a dictionary
-        best_result_dict = best_result.to_dict()
-
-        # Extract the corresponding balances for the best result
-        agent_generation = best_sharpe_index
-        balances_key = (agent_generation, test_labels[0])
-        best_balances = balances_dfs.get(balances_key, [])
-
-        probs_key = (agent_generation, test_labels[0])
-        best_probs_df = probs_dfs.get(probs_key, pd.DataFrame())
-        best_probs_df[f'{agent.get_name()}_Action'] = best_probs_df.idxmax(axis=1)
-        best_balances_df = pd.DataFrame(best_balances, columns=[f'{agent.get_name()}_Balances'])
-
-        dates = df_test.iloc[look_back:-1].index
-        best_balances_df['Date'] = dates
-        best_probs_df['Date'] = dates
-        close_prices = df_test['Close', tradable_markets].reset_index()
-        close_prices = close_prices.iloc[look_back:-1]
-        close_prices.columns = ['Date', f'Close_{tradable_markets}']
-
-        best_balances_df = pd.merge(best_balances_df, close_prices, on='Date', how='outer')
-        best_balances_df = pd.merge(best_balances_df, best_probs_df, on='Date', how='outer')
-        final_test_results = pd.concat([final_test_results, best_balances_df])
-
-        final_balance = final_test_results[f'{agent.get_name()}_Balances'].iloc[-1]
-        print(f"Final Balance: {final_balance:.2f}")
-
-        # save also number of trades and provision sum
-        provision_sum_test_final = provision_sum_test_final + \
-                                   best_result_dict.get((agent.get_name(), 'Provision Sum'), 0)[agent_generation]
+        steps[move_forward] = {'move_forward': move_forward, 'validation_date': validation_date,
+                               'test_date': test_date, 'end_date': end_date, 'look_back': look_back,
+                               'variables': variables, 'tradable_markets': tradable_markets, 'provision': provision,
+                               'leverage': leverage, 'starting_balance': 10000,
+                               'results_store_path': results_store.path, 'run': results_store.run}
+        prepare_steps[move_forward] = {'tickers': ['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], 'timestamp': '1D',
+                                       'feature_spec': feature_spec, 'start_date': start_date,
+                                       'validation_date': validation_date, 'test_date': test_date,
+                                       'end_date': end_date, 'look_back': look_back, 'window_size': '1Y',
+                                       'evaluation_window_size': '2Y'}
 
         # add year to the dates
         validation_date = (datetime.strptime(validation_date, '%Y-%m-%d') + relativedelta(years=1)).strftime('%Y-%m-%d')
         test_date = (datetime.strptime(test_date, '%Y-%m-%d') + relativedelta(years=1)).strftime('%Y-%m-%d')
         end_date = (datetime.strptime(end_date, '%Y-%m-%d') + relativedelta(years=1)).strftime('%Y-%m-%d')
 
-        # final results for the agent
-
-    df = load_data_parallel(['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], '1D')
-
-    add_indicators(df, indicators)
-    add_returns(df, return_indicators)
-
-    add_time_sine_cosine(df, '1W')
-    df[("sin_time_1W", "")] = df[("sin_time_1W", "")] / 2 + 0.5
-    df[("cos_time_1W", "")] = df[("cos_time_1W", "")] / 2 + 0.5
-    df[("RSI_14", "EURUSD")] = df[("RSI_14", "EURUSD")] / 100
+    step_results = orchestrator.run(steps, prepare_steps)
+    agent_name = step_results[1]['agent_name']
+    final_test_results, provision_sum_test_final, final_balance = BF.stitch_walk_forward(
+        step_results, f'{agent_name}_Balances', starting_balance=final_balance)
+    print(f"Final Balance: {final_balance:.2f}")
 
-    add_time_sine_cosine(df, '1W')
+    # final results for the agent
 
-    df = df.dropna()
+    df = load_data_parallel(['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'], '1D')
+    df = feature_pipeline.transform(df)
     df = df[test_date_2:end_date]
 
     buy_and_hold_agent = Buy_and_hold_Agent()
@@ -826,28 +904,33 @@ if __name__ == '__main__':
         BF.backtest_wrapper, tradable_markets, look_back, variables, provision, 10000, leverage,
         Trading_Environment_Basic, reward_calculation, workers=4)
 
-    bah_results_prepared = prepare_backtest_results(bah_results, 'BAH')
-    sah_results_prepared = prepare_backtest_results(sah_results, 'SAH')
+    bah_final = bah_results[(buy_and_hold_agent.generation, 'final_test')][0]
+    sah_final = sah_results[(sell_and_hold_agent.generation, 'final_test')][0]
 
-    sah_results_prepared = sah_results_prepared.drop(('', 'Agent Generation'),
-                                                     axis=1)  # drop the agent generation column
-    bah_results_prepared = bah_results_prepared.drop(('', 'Agent Generation'),
-                                                     axis=1)  # drop the agent generation column
+    results_store.to_parquet(f'backtest_results_{results_store.run}.parquet')
 
     # Generate statistics for the final test results
-    statistic_report = BF.generate_result_statistics(final_test_results, f'{agent.get_name()}_Action',
-                                                     f'{agent.get_name()}_Balances', provision_sum_test_final,
+    statistic_report = BF.generate_result_statistics(final_test_results, f'{agent_name}_Action',
+                                                     f'{agent_name}_Balances', provision_sum_test_final,
                                                      look_back=look_back)
-    statistic_report.update({'sell and hold final balance': sah_results_prepared[('SAH', 'Final Balance')][0],
-                             'buy and hold final balance': bah_results_prepared[('BAH', 'Final Balance')][0],
-                             'sell and hold sharpe ratio': sah_results_prepared[('SAH', 'Sharpe Ratio')][0],
-                             'buy and hold sharpe ratio': bah_results_prepared[('BAH', 'Sharpe Ratio')][0]})
+    statistic_report.update({'sell and hold final balance': sah_final['Final Balance'],
+                             'buy and hold final balance': bah_final['Final Balance'],
+                             'sell and hold sharpe ratio': sah_final['Sharpe Ratio'],
+                             'buy and hold sharpe ratio': bah_final['Sharpe Ratio']})
+
+    # bootstrap confidence intervals of the final test metrics and p-values against the benchmarks
+    benchmark_index = df.index[look_back:-1]
+    significance_report = BF.bootstrap_significance(
+        final_test_results.set_index('Date')[f'{agent_name}_Balances'],
+        {'BAH': pd.Series(benchmark_BAH[('Buy and Hold', 'final_test')], index=benchmark_index),
+         'SAH': pd.Series(benchmark_SAH[('Sell and Hold', 'final_test')], index=benchmark_index)})
+    print(significance_report)
 
     statistic_report = pd.DataFrame([statistic_report])
-    #statistic_report.to_csv(fr'C:\Users\jmask\OneDrive\Pulpit\RL_magisterka\{tradable_markets}\statistic_report_{agent.get_name()}.csv', index=False)
+    #statistic_report.to_csv(fr'C:\Users\jmask\OneDrive\Pulpit\RL_magisterka\{tradable_markets}\statistic_report_{agent_name}.csv', index=False)
 
     # Save final_test_results to a CSV file
-    #final_test_results.to_csv(fr'C:\Users\jmask\OneDrive\Pulpit\RL_magisterka\{tradable_markets}\final_test_results_{agent.get_name()}.csv', index=False)
+    #final_test_results.to_csv(fr'C:\Users\jmask\OneDrive\Pulpit\RL_magisterka\{tradable_markets}\final_test_results_{agent_name}.csv', index=False)
 
     print(f"Final Balance: {final_balance:.2f}")
     # 12605 PogChamp benchmark add sharpe of this strategy # sharpe 1.55
@@ -0,0 +1,238 @@
+"""
+Process pool backtest executor
+
+- the datasets are written once to a temporary file as MarketFrames, every worker loads them when it starts and keeps
+  them for all generations (starting a worker does not block the training process while it pickles the data)
+- the policy is frozen once per generation (snapshot_policy), pickled once and evaluated on all windows in parallel
+- the workers return compact results: the metrics and the float32 probabilities, int8 actions, float64 balances
+- the numba kernels of the backtests (batched_backtest.py, kpi.py) are cached on disk, a spawned worker loads them
+  instead of compiling them again
+The backtests neither hold the GIL of the training process nor switch the live agent between eval() and train().
+EvaluationService runs the backtests of every generation in the background while the training continues.
+"""
+import copy
+import itertools
+import multiprocessing
+import os
+import pickle
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from data.function.market_frame import MarketFrame
+
+SNAPSHOT_NETWORKS = ('actor', 'q_policy')  # the network used for the evaluation, PPO and DQN agents
+
+
+def snapshot_policy(agent):
+    """
+    Frozen copy of the agent for the evaluation.
+
+    Agents with a policy network get a copy of the same class holding only that network on the CPU (no critic,
+    optimizers or memory), other agents (e.g. benchmark agents) are deep copied.
+    """
+    network_name = next((name for name in SNAPSHOT_NETWORKS if hasattr(agent, name)), None)
+    if network_name is None:
+        return copy.deepcopy(agent)
+
+    network = copy.deepcopy(getattr(agent, network_name)).to('cpu').eval()
+    network.requires_grad_(False)
+
+    snapshot = object.__new__(type(agent))
+    snapshot.__dict__.update({network_name: network, 'device': torch.device('cpu'), 'generation': agent.generation,
+                              'n_actions': getattr(agent, 'n_actions', 3), 'frozen': True})
+    return snapshot
+
+
+def backtest_result_data(generation, agent_type, label, result):
+    """
+    Metrics of one backtest (the tuple returned by backtest_wrapper) as stored in backtest_results.
+    """
+    balance, total_reward, number_of_trades, probabilities, actions, sharpe_ratio, max_drawdown, \
+        sortino_ratio, calmar_ratio, cumulative_returns, balances, provision_sum, max_drawdown_duration, \
+        average_trade_duration, in_long, in_short, in_out_of_market, win_rate, annualised_returns, \
+        annualised_std = result
+
+    return {
+        'Agent generation': generation,
+        'Agent Type': agent_type,
+        'Label': label,
+        'Provision_sum': provision_sum,
+        'Final Balance': balance,
+        'Total Reward': total_reward,
+        'Number of Trades': number_of_trades,
+        'Sharpe Ratio': sharpe_ratio,
+        'Max Drawdown': max_drawdown,
+        'Sortino Ratio': sortino_ratio,
+        'Calmar Ratio': calmar_ratio,
+        'Max Drawdown Duration': max_drawdown_duration,
+        'Average Trade Duration': average_trade_duration,
+        'In Long': in_long,
+        'In Short': in_short,
+        'In Out of the Market': in_out_of_market,
+        'Win Rate': win_rate,
+        'Average Yearly Return': annualised_returns,
+        'Average Yearly std': annualised_std,
+    }
+
+
+# state of a worker process, set once by the pool initializer
+_worker_state = {}
+
+
+def _initialize_worker(datasets_path, settings):
+    torch.set_num_threads(1)  # one backtest per process, no oversubscription of the cores
+    with open(datasets_path, 'rb') as file:
+        _worker_state['datasets'] = pickle.load(file)
+    _worker_state['settings'] = settings
+    _worker_state['snapshot'] = (None, None)
+
+
+def _worker_ready():
+    return True
+
+
+def _backtest_window(snapshot_id, payload, agent_type, dataset_index, label):
+    # the snapshot is unpickled once per generation in every worker
+    cached_id, agent = _worker_state['snapshot']
+    if cached_id != snapshot_id:
+        agent = pickle.loads(payload)
+        _worker_state['snapshot'] = (snapshot_id, agent)
+
+    settings = _worker_state['settings']
+    result = settings['backtest_wrapper'](agent_type, _worker_state['datasets'][dataset_index], agent,
+                                          settings['currency_pair'], settings['look_back'], settings['variables'],
+                                          settings['provision'], settings['starting_balance'], settings['leverage'],
+                                          settings['Trading_Environment_Class'], settings['reward_function'])
+
+    # compact result, cumulative returns can be recovered from the balances
+    return backtest_result_data(agent.generation, agent_type, label, result), result[3], result[4], result[10]
+
+
+class BacktestExecutor:
+    """
+    Persistent process pool evaluating agents on a fixed list of datasets.
+
+    Usage:
+        with BacktestExecutor(datasets, labels, BF.backtest_wrapper, ...) as executor:
+            backtest_results, probs_dfs, balances_dfs = executor.run(agent, 'PPO')
+    """
+    def __init__(self, datasets, labels, backtest_wrapper, currency_pair, look_back, variables, provision,
+                 starting_balance, leverage, Trading_Environment_Class, reward_function, workers=4, mp_context=None):
+        self.labels = list(labels)
+        settings = {
+            'backtest_wrapper': backtest_wrapper,
+            'currency_pair': currency_pair,
+            'look_back': look_back,
+            'variables': variables,
+            'provision': provision,
+            'starting_balance': starting_balance,
+            'leverage': leverage,
+            'Trading_Environment_Class': Trading_Environment_Class,
+            'reward_function': reward_function,
+        }
+        self.snapshot_ids = itertools.count()
+
+        market_frames = [df if isinstance(df, MarketFrame) else MarketFrame.from_dataframe(df) for df in datasets]
+        with tempfile.NamedTemporaryFile(suffix='.pkl', delete=False) as file:
+            pickle.dump(market_frames, file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.datasets_path = file.name
+
+        # spawn by default, forking a process that already runs torch / numba threads can deadlock the workers
+        mp_context = mp_context or multiprocessing.get_context('spawn')
+        workers = min(workers, max(len(self.labels), 1))
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_initialize_worker,
+                                        initargs=(self.datasets_path, settings))
+
+        # start the workers now, not on the first submit from the training loop
+        for _ in range(workers):
+            self.pool.submit(_worker_ready)
+
+    def submit(self, agent, agent_type):
+        """
+        Freezes the agent and submits the backtests of all datasets.
+
+        Returns:
+            list: (future, label) pairs, the futures return (result_data, probabilities, actions, balances).
+        """
+        snapshot_id = next(self.snapshot_ids)
+        payload = pickle.dumps(snapshot_policy(agent), protocol=pickle.HIGHEST_PROTOCOL)
+        return [(self.pool.submit(_backtest_window, snapshot_id, payload, agent_type, dataset_index, label), label)
+                for dataset_index, label in enumerate(self.labels)]
+
+    @staticmethod
+    def collect(futures, backtest_results=None, probs_dfs=None, balances_dfs=None):
+        """
+        Waits for the submitted backtests and stores the results by (generation, label), like run_backtesting.
+        """
+        backtest_results = {} if backtest_results is None else backtest_results
+        probs_dfs = {} if probs_dfs is None else probs_dfs
+        balances_dfs = {} if balances_dfs is None else balances_dfs
+
+        for future, label in futures:
+            result_data, probabilities, actions, balances = future.result()
+            key = (result_data['Agent generation'], label)
+            backtest_results.setdefault(key, []).append(result_data)
+            probs_dfs[key] = probabilities
+            balances_dfs[key] = balances
+
+        return backtest_results, probs_dfs, balances_dfs
+
+    def run(self, agent, agent_type, backtest_results=None, probs_dfs=None, balances_dfs=None):
+        return self.collect(self.submit(agent, agent_type), backtest_results, probs_dfs, balances_dfs)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+        if os.path.exists(self.datasets_path):
+            os.remove(self.datasets_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+
+class EvaluationService:
+    """
+    Non-blocking evaluation of the generations of a training run.
+
+    submit(agent) freezes the current generation and returns immediately, the results of the finished
+    generations are stored in backtest_results, probs_dfs and balances_dfs by poll() (called on every submit)
+    and by drain(). With max_in_flight generations still running, submit waits for the oldest one (backpressure),
+    so the training never gets more than max_in_flight generations ahead of the evaluation.
+    """
+    def __init__(self, executor, agent_type, backtest_results, probs_dfs, balances_dfs, max_in_flight=2):
+        self.executor = executor
+        self.agent_type = agent_type
+        self.backtest_results = backtest_results
+        self.probs_dfs = probs_dfs
+        self.balances_dfs = balances_dfs
+        self.max_in_flight = max_in_flight
+        self.in_flight = deque()  # (generation, name, futures) in the order of submission
+
+    def submit(self, agent):
+        self.poll()
+        while len(self.in_flight) >= self.max_in_flight:
+            self._store(*self.in_flight.popleft())
+        self.in_flight.append((agent.generation, agent.get_name(), self.executor.submit(agent, self.agent_type)))
+
+    def poll(self):
+        """
+        Stores the results of the finished generations without waiting.
+        """
+        while self.in_flight and all(future.done() for future, _ in self.in_flight[0][2]):
+            self._store(*self.in_flight.popleft())
+
+    def drain(self):
+        """
+        Waits for all submitted generations.
+        """
+        while self.in_flight:
+            self._store(*self.in_flight.popleft())
+
+    def _store(self, generation, name, futures):
+        self.executor.collect(futures, self.backtest_results, self.probs_dfs, self.balances_dfs)
+        print(f"Backtesting completed for {name} generation {generation}")
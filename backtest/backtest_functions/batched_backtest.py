@@ -0,0 +1,212 @@
+"""
+Position-enumerated batched backtest engine
+
+The only sequential input of the policy during a backtest is the static input current_position, which can take only
+three values (-1, 0, 1). The backtest is therefore split into two stages:
+1. the actor is evaluated for all observations x all 3 positions in a few large batched forward passes,
+2. the greedy position walk and the balance accounting (same as Trading_Environment_Basic.step, walk_positions) run
+   in numba.
+"""
+import numpy as np
+from numba import jit
+from numba.core.registry import CPUDispatcher
+
+from data.function.edit import normalize_data, standardize_data
+from data.function.market_frame import MarketFrame
+
+POSITIONS = np.array([-1, 0, 1])  # position i of the enumeration is POSITIONS[i], ie position + 1
+EDIT_CODES = {'normalize': 1, 'standardize': 2}
+
+
+@jit(nopython=True, cache=True)
+def build_observations(values, edit_codes, look_back, n_steps):
+    """
+    Observations of every step of the environment, identical to Trading_Environment_Basic._next_observation.
+
+    values: 2D array (time, variables), edit_codes: 0 - raw, 1 - normalize, 2 - standardize
+    """
+    n_variables = values.shape[1]
+    observations = np.empty((n_steps, n_variables * look_back))
+    for step in range(n_steps):
+        end = step + look_back
+        start = max(end - look_back, 0)
+        for i in range(n_variables):
+            data = values[start:end, i]
+            if edit_codes[i] == 1:
+                data = normalize_data(data)
+            elif edit_codes[i] == 2:
+                data = standardize_data(data)
+            observations[step, i * look_back:(i + 1) * look_back] = data
+    return observations
+
+
+@jit(nopython=True, cache=True)
+def walk_positions(close_prices, positions, look_back, provision, initial_balance, leverage):
+    """
+    Balance accounting of Trading_Environment_Basic.step over a position trace, the single numba implementation of
+    the environment accounting (greedy_position_walk, sensitivity.walk_position_grid).
+
+    positions: 1D array of the positions (-1, 0, 1) of every step, starting at look_back
+
+    Returns:
+        balances after every step, balance, num_trades, profitable_trades, provision_sum, negative_balances (steps
+        whose negative balance was set to 0, reported once by the caller, see report_negative_balances)
+    """
+    n_steps = len(positions)
+    balances = np.empty(n_steps)
+    negative_balances = 0
+
+    balance = initial_balance
+    capital_investment = 0.0
+    open_price = 1.0
+    current_price = 0.0
+    current_position = 0
+    provision_sum = 0.0
+    num_trades = 0
+    profitable_trades = 0
+
+    for step in range(n_steps):
+        current_step = step + look_back
+        action = positions[step]
+
+        current_price = close_prices[current_step]
+        next_price = close_prices[current_step + 1]
+
+        provision_cost = 0.0
+        if action != current_position:
+            if action != 0:
+                num_trades += 1
+
+            if (1 - provision) * current_position * (next_price - open_price) > 0:
+                profitable_trades += 1
+
+            capital_investment = balance
+            trade = 1.0 if abs(action) == 1 else 0.0
+            provision_cost -= provision * trade * capital_investment * leverage
+            provision_sum -= provision * trade * capital_investment * leverage
+            open_price = current_price
+
+        market_return = (next_price - current_price) * action / open_price if open_price != 0 else 0.0
+        balance += market_return * capital_investment * leverage + provision_cost
+
+        if balance < 0:
+            balance = 0.0
+            capital_investment = 0.0
+            negative_balances += 1
+
+        current_position = action
+        balances[step] = balance
+
+    # close the open position at the end of the episode
+    if (1 - provision) * current_position * (current_price - open_price) > 0:
+        profitable_trades += 1
+
+    return balances, balance, num_trades, profitable_trades, provision_sum, negative_balances
+
+
+def report_negative_balances(negative_balances):
+    # once per backtest instead of the per step message of the environment
+    if negative_balances:
+        print(f'Negative balance, set to 0 in {negative_balances} steps')
+
+
+@jit(nopython=True, cache=True)
+def greedy_position_walk(probabilities, close_prices, look_back, provision, initial_balance, leverage):
+    """
+    Greedy walk over the precomputed action probabilities of every position, the position of a step only depends on
+    the previous one, the balances are accounted by walk_positions.
+
+    probabilities: 3D array (3 positions, steps, actions)
+
+    Returns:
+        actions (-1, 0, 1), balances after every step, balance, num_trades, profitable_trades, provision_sum,
+        negative_balances
+    """
+    n_steps = probabilities.shape[1]
+    actions = np.empty(n_steps, dtype=np.int64)
+    current_position = 0
+    for step in range(n_steps):
+        current_position = np.argmax(probabilities[current_position + 1, step]) - 1
+        actions[step] = current_position
+
+    balances, balance, num_trades, profitable_trades, provision_sum, negative_balances = walk_positions(
+        close_prices, actions, look_back, provision, initial_balance, leverage)
+    return actions, balances, balance, num_trades, profitable_trades, provision_sum, negative_balances
+
+
+@jit(nopython=True, cache=True)
+def _reward_sum_jit(reward_function, close_prices, actions, look_back, leverage, provision):
+    reward_sum = 0.0
+    previous_position = 0
+    for step in range(len(actions)):
+        current_step = step + look_back
+        reward_sum += reward_function(close_prices[current_step], close_prices[current_step + 1], previous_position,
+                                      actions[step], leverage, provision)
+        previous_position = actions[step]
+    return reward_sum
+
+
+def reward_sum(reward_function, close_prices, actions, look_back, leverage, provision):
+    """
+    Sum of the rewards of the position path, the reward function only depends on prices and positions.
+    """
+    if isinstance(reward_function, CPUDispatcher):
+        return _reward_sum_jit(reward_function, close_prices, actions, look_back, leverage, provision)
+
+    total, previous_position = 0, 0
+    for step, action in enumerate(actions):
+        total += reward_function(close_prices[step + look_back], close_prices[step + look_back + 1],
+                                 previous_position, int(action), leverage, provision)
+        previous_position = int(action)
+    return total
+
+
+def supports_batched_backtest(agent):
+    return hasattr(agent, 'get_action_probabilities_batch')
+
+
+def enumerate_position_probabilities(agent, observations, batch_size=4096):
+    """
+    Action probabilities of every observation for each of the 3 possible positions, shape (3, steps, actions).
+    """
+    probabilities = []
+    for position in POSITIONS:
+        position_probabilities = [agent.get_action_probabilities_batch(observations[start:start + batch_size],
+                                                                        np.full(len(observations[start:start + batch_size]), position))
+                                  for start in range(0, len(observations), batch_size)]
+        probabilities.append(np.concatenate(position_probabilities, axis=0))
+    return np.stack(probabilities)
+
+
+def run_batched_backtest(agent, df, mkf, look_back, variables, provision, starting_balance, leverage,
+                         reward_function, batch_size=4096):
+    """
+    Runs both stages of the engine.
+
+    Returns:
+        actions (-1, 0, 1), action probabilities of the walked path, balances, balance, reward_sum, num_trades,
+        profitable_trades, provision_sum
+    """
+    market_frame = df if isinstance(df, MarketFrame) else MarketFrame.from_dataframe(df)
+    close_prices = np.ascontiguousarray(market_frame[('Close', mkf)], dtype=np.float64)
+    values = np.asfortranarray(
+        market_frame.values[:, market_frame.column_numbers([variable['variable'] for variable in variables])],
+        dtype=np.float64)
+    edit_codes = np.array([EDIT_CODES.get(variable['edit'], 0) for variable in variables], dtype=np.int64)
+
+    n_steps = len(market_frame) - look_back - 1
+    observations = build_observations(values, edit_codes, look_back, n_steps)
+
+    # stage 1 - batched forward passes for every position
+    probabilities = enumerate_position_probabilities(agent, observations, batch_size)
+
+    # stage 2 - greedy walk and balance accounting
+    walk = greedy_position_walk(probabilities, close_prices, look_back, provision, float(starting_balance), leverage)
+    actions, balances, balance, num_trades, profitable_trades, provision_sum, negative_balances = walk
+    report_negative_balances(negative_balances)
+
+    previous_positions = np.concatenate(([0], actions[:-1]))
+    path_probabilities = probabilities[previous_positions + 1, np.arange(n_steps)]
+    total_reward = reward_sum(reward_function, close_prices, actions, look_back, leverage, provision)
+
+    return actions, path_probabilities, balances, balance, total_reward, num_trades, profitable_trades, provision_sum
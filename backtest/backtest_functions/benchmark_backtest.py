@@ -0,0 +1,182 @@
+"""
+Closed-form and memoized backtests of the benchmark agents (Buy and Hold, Sell and Hold, Perfect Foresight)
+
+A benchmark holding the same position in every step opens it once in the first step and never trades again, so the
+balance accounting of Trading_Environment_Basic.step reduces to
+    balance_t = starting_balance * (1 - provision * leverage + position * leverage * (P_t+1 - P_0) / P_0)
+with P_0 the close price at look_back (balance floored at 0 for good once it gets negative).
+The results only depend on the close prices of the window and the settings, they are cached by
+(close prices hash, position, provision, leverage, look_back, starting balance, reward function), so evaluating the
+benchmarks again on the same windows (every walk-forward step, every script run in the same process) is free.
+Oracle benchmarks (oracle_positions) plan their position path from the close prices of every window, the path is
+walked with the accounting of the batched engine and cached the same way.
+"""
+import hashlib
+
+import numpy as np
+
+from backtest.backtest_functions.backtest_executor import backtest_result_data
+from backtest.backtest_functions.batched_backtest import reward_sum, walk_positions, report_negative_balances
+from backtest.backtest_functions.kpi import ACTION_LABELS
+
+_benchmark_cache = {}
+
+
+def constant_position(agent):
+    """
+    Position (-1, 0, 1) held by a benchmark agent in every step, None for other agents.
+    """
+    return getattr(agent, 'constant_position', None)
+
+
+def is_benchmark_agent(agent):
+    """
+    Agents backtested from the close prices alone (constant position or oracle benchmarks).
+    """
+    return constant_position(agent) is not None or hasattr(agent, 'oracle_positions')
+
+
+def close_prices_hash(close_prices):
+    """
+    Content hash of the close prices of a window, the only data the benchmark results depend on.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(close_prices, dtype=np.float64).tobytes(), digest_size=16).hexdigest()
+
+
+def constant_position_balances(close_prices, position, look_back, provision, starting_balance, leverage):
+    """
+    Balances after every step of a constant position, identical to the greedy walk of the batched engine.
+
+    Returns:
+        balances, num_trades, profitable_trades, provision_sum
+    """
+    n_steps = len(close_prices) - look_back - 1
+    if position == 0 or n_steps <= 0:
+        return np.full(max(n_steps, 0), float(starting_balance)), 0, 0, 0.0
+
+    open_price = close_prices[look_back]
+    provision_sum = -provision * starting_balance * leverage
+    price_change = close_prices[look_back + 1:look_back + 1 + n_steps] - open_price
+    balances = starting_balance + provision_sum + position * price_change / open_price * starting_balance * leverage
+
+    # a negative balance closes the account, the balance stays at 0 afterwards
+    bankrupt = np.logical_or.accumulate(balances < 0)
+    balances[bankrupt] = 0.0
+
+    # the position is closed at the close price of the last step
+    profitable_trades = int(position * (close_prices[look_back + n_steps - 1] - open_price) > 0)
+    return balances, 1, profitable_trades, provision_sum
+
+
+def benchmark_backtest(df, position, mkf, look_back, provision, starting_balance, leverage, reward_function,
+                       annualization_factor=365):
+    """
+    Backtest of a constant position benchmark on one dataset.
+
+    Parameters:
+        df (pd.DataFrame or MarketFrame): The dataframe containing market data.
+        position (int): Position held in every step, 1 - Buy and Hold, -1 - Sell and Hold.
+        mkf (str): The traded market.
+        look_back (int): The look-back period for the environment.
+        provision (float): The trading provision or fee.
+        starting_balance (float): The starting balance for the backtest.
+        leverage (float): The leverage for the backtest.
+        reward_function (function): The reward function for the environment.
+        annualization_factor (int): The factor for annualizing metrics.
+
+    Returns:
+        tuple: The same tuple as backtest_wrapper. Cached, the arrays of the result are read-only.
+    """
+    from backtest.backtest_functions.functions import summarize_backtest  # functions.py imports this module
+
+    close_prices = np.ascontiguousarray(df[('Close', mkf)], dtype=np.float64)
+
+    key = (close_prices_hash(close_prices), position, provision, leverage, look_back,
+           starting_balance, reward_function, annualization_factor)
+    if key in _benchmark_cache:
+        return _benchmark_cache[key]
+
+    balances, num_trades, profitable_trades, provision_sum = constant_position_balances(
+        close_prices, position, look_back, provision, float(starting_balance), leverage)
+    actions = np.full(len(balances), position, dtype=np.int64)
+    probabilities = np.zeros((len(balances), len(ACTION_LABELS)))
+    probabilities[:, position + 1] = 1.0
+
+    total_reward = reward_sum(reward_function, close_prices, actions, look_back, leverage, provision)
+    balance = balances[-1] if len(balances) else float(starting_balance)
+
+    result = summarize_backtest(balances, probabilities, actions, balance, total_reward, num_trades,
+                                profitable_trades, provision_sum, starting_balance, annualization_factor)
+    for value in result:
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+
+    _benchmark_cache[key] = result
+    return result
+
+
+def oracle_backtest(df, agent, mkf, look_back, provision, starting_balance, leverage, reward_function,
+                    annualization_factor=365):
+    """
+    Backtest of an oracle benchmark (e.g. Perfect_Foresight_Agent) on one dataset, parameters as in benchmark_backtest.
+
+    Returns:
+        tuple: The same tuple as backtest_wrapper. Cached, the arrays of the result are read-only.
+    """
+    from backtest.backtest_functions.functions import summarize_backtest  # functions.py imports this module
+
+    close_prices = np.ascontiguousarray(df[('Close', mkf)], dtype=np.float64)
+
+    key = (close_prices_hash(close_prices), type(agent).__name__, provision, leverage, look_back,
+           starting_balance, reward_function, annualization_factor)
+    if key in _benchmark_cache:
+        return _benchmark_cache[key]
+
+    positions = np.asarray(agent.oracle_positions(close_prices, look_back, provision, leverage), dtype=np.int64)
+    probabilities = np.zeros((len(positions), len(ACTION_LABELS)))
+    probabilities[np.arange(len(positions)), positions + 1] = 1.0
+
+    # the path does not depend on the current position, the trace is walked directly
+    actions = positions
+    balances, balance, num_trades, profitable_trades, provision_sum, negative_balances = walk_positions(
+        close_prices, actions, look_back, provision, float(starting_balance), leverage)
+    report_negative_balances(negative_balances)
+    total_reward = reward_sum(reward_function, close_prices, actions, look_back, leverage, provision)
+
+    result = summarize_backtest(balances, probabilities, actions, balance, total_reward, num_trades,
+                                profitable_trades, provision_sum, starting_balance, annualization_factor)
+    for value in result:
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+
+    _benchmark_cache[key] = result
+    return result
+
+
+def run_benchmark_backtesting(agent, agent_type, datasets, labels, currency_pair, look_back, provision,
+                              starting_balance, leverage, reward_calculation):
+    """
+    Counterpart of run_backtesting for the benchmark agents (is_benchmark_agent).
+
+    Returns:
+        tuple: backtest_results, probabilities and balances, all keyed by (generation, label).
+    """
+    position = constant_position(agent)
+    backtest_results, probs_dfs, balances_dfs = {}, {}, {}
+    for df, label in zip(datasets, labels):
+        if position is not None:
+            result = benchmark_backtest(df, position, currency_pair, look_back, provision, starting_balance, leverage,
+                                        reward_calculation)
+        else:
+            result = oracle_backtest(df, agent, currency_pair, look_back, provision, starting_balance, leverage,
+                                     reward_calculation)
+        key = (agent.generation, label)
+        backtest_results.setdefault(key, []).append(backtest_result_data(agent.generation, agent_type, label, result))
+        probs_dfs[key] = result[3]
+        balances_dfs[key] = result[10]
+
+    return backtest_results, probs_dfs, balances_dfs
+
+
+def clear_benchmark_cache():
+    _benchmark_cache.clear()
@@ -0,0 +1,141 @@
+"""
+Bootstrap significance of backtest metrics
+
+The return series of the strategy and of the benchmarks are resampled with the same block indices (paired
+resampling keeps the dependence between the strategy and the market), the resampled balances of a whole chunk of
+resamples are evaluated at once by the KPI engine (kpi.py, parallel over the series).
+- block bootstrap: circular blocks of a fixed length
+- stationary bootstrap (Politis & Romano): blocks of geometrically distributed length with the given mean
+Reports the point estimates, percentile confidence intervals and one-sided p-values of the hypothesis that the
+strategy is not better than the benchmark.
+"""
+import numpy as np
+import pandas as pd
+
+from backtest.backtest_functions.kpi import calculate_kpis, KPI_INDEX
+
+SIGNIFICANCE_METRICS = ('Sharpe Ratio', 'Sortino Ratio', 'Calmar Ratio', 'Annual Return', 'Max Drawdown')
+
+
+def balances_to_returns(balances, starting_balance=10000):
+    """
+    Returns of every step of a balance series, 0 after the balance reached 0.
+    """
+    balances = np.asarray(balances, dtype=np.float64)
+    previous = np.concatenate(([starting_balance], balances[:-1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = balances / previous - 1
+    return np.where(np.isfinite(returns), returns, 0.0)
+
+
+def block_bootstrap_indices(n, n_resamples, block_length, rng):
+    """
+    Indices of circular block bootstrap resamples, shape (n_resamples, n).
+    """
+    n_blocks = -(-n // block_length)
+    starts = rng.integers(0, n, size=(n_resamples, n_blocks))
+    indices = (starts[:, :, None] + np.arange(block_length)) % n
+    return indices.reshape(n_resamples, n_blocks * block_length)[:, :n]
+
+
+def stationary_bootstrap_indices(n, n_resamples, block_length, rng):
+    """
+    Indices of stationary bootstrap resamples, shape (n_resamples, n), the mean length of the blocks is block_length.
+    """
+    steps = np.arange(n)
+    new_block = rng.random((n_resamples, n)) < 1.0 / block_length
+    new_block[:, 0] = True
+    block_start = np.maximum.accumulate(np.where(new_block, steps, 0), axis=1)  # step at which the block started
+    starts = rng.integers(0, n, size=(n_resamples, n))
+    return (np.take_along_axis(starts, block_start, axis=1) + steps - block_start) % n
+
+
+BOOTSTRAP_METHODS = {'block': block_bootstrap_indices, 'stationary': stationary_bootstrap_indices}
+
+
+def resampled_kpis(returns, n_resamples=5000, method='stationary', block_length=20, starting_balance=10000,
+                   annualization_factor=365, seed=0, chunk_size=1000):
+    """
+    KPIs of bootstrap resamples of one or many aligned return series.
+
+    Parameters:
+        returns (array): Returns, shape (steps,) or (n_series, steps), all series are resampled with the same indices.
+        n_resamples (int): Number of resamples.
+        method (str): 'stationary' or 'block'.
+        block_length (int): (Mean) length of the blocks.
+        chunk_size (int): Resamples evaluated at once, limits the memory.
+
+    Returns:
+        np.ndarray: (n_series, n_resamples, n_metrics) array, columns as in KPI_NAMES.
+    """
+    returns = np.atleast_2d(np.asarray(returns, dtype=np.float64))
+    n_series, n = returns.shape
+    sample_indices = BOOTSTRAP_METHODS[method]
+    rng = np.random.default_rng(seed)
+
+    kpis = np.empty((n_series, n_resamples, len(KPI_INDEX)))
+    for start in range(0, n_resamples, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+        indices = sample_indices(n, size, min(block_length, n), rng)
+        for series in range(n_series):
+            balances = starting_balance * np.cumprod(1 + returns[series][indices], axis=1)
+            kpis[series, start:start + size] = calculate_kpis(balances, None, starting_balance, annualization_factor)
+    return kpis
+
+
+def bootstrap_significance(balances, benchmarks=None, starting_balance=10000, metrics=SIGNIFICANCE_METRICS,
+                           n_resamples=5000, method='stationary', block_length=20, confidence=0.95,
+                           annualization_factor=365, seed=0, chunk_size=1000):
+    """
+    Confidence intervals of the metrics of a backtest and p-values against benchmarks.
+
+    Parameters:
+        balances (array or pd.Series): Balances of the strategy after every step.
+        benchmarks (dict): Benchmark name -> balances (e.g. {'BAH': ..., 'SAH': ...}) of the same steps. Series with a
+            (date) index are aligned with the strategy on the common index, the returns are taken before aligning.
+        starting_balance (float): Balance before the first step.
+        metrics (tuple): Metrics of KPI_NAMES to report, all of them "higher is better".
+        confidence (float): Level of the percentile confidence intervals.
+
+    Returns:
+        pd.DataFrame: One row per metric - estimate, confidence interval and standard error of the strategy and, for
+        every benchmark, its estimate, the difference and the p-value of the hypothesis that the strategy is not
+        better (bootstrap distribution of the difference centered at zero).
+    """
+    benchmarks = benchmarks or {}
+    series = {'Strategy': balances, **benchmarks}
+    returns = {}
+    for name, values in series.items():
+        if isinstance(values, pd.Series):
+            values = values.dropna()
+            values = values[~values.index.duplicated()]
+            returns[name] = pd.Series(balances_to_returns(values.to_numpy(), starting_balance), index=values.index)
+        else:
+            returns[name] = pd.Series(balances_to_returns(values, starting_balance))
+    aligned = pd.concat(returns, axis=1, join='inner')
+    aligned_returns = aligned.to_numpy().T
+
+    metric_columns = [KPI_INDEX[metric] for metric in metrics]
+    estimates = calculate_kpis(starting_balance * np.cumprod(1 + aligned_returns, axis=1), None, starting_balance,
+                               annualization_factor)[:, metric_columns]
+    samples = resampled_kpis(aligned_returns, n_resamples, method, block_length, starting_balance,
+                             annualization_factor, seed, chunk_size)[:, :, metric_columns]
+
+    alpha = (1 - confidence) / 2
+    report = pd.DataFrame(index=pd.Index(metrics, name='Metric'))
+    report['Estimate'] = estimates[0]
+    report['CI Lower'] = np.nanquantile(samples[0], alpha, axis=0)
+    report['CI Upper'] = np.nanquantile(samples[0], 1 - alpha, axis=0)
+    report['Std Error'] = np.nanstd(samples[0], axis=0, ddof=1)
+
+    for i, name in enumerate(benchmarks, start=1):
+        difference = estimates[0] - estimates[i]
+        resampled_difference = samples[0] - samples[i]
+        valid = np.isfinite(resampled_difference)
+        exceedances = ((resampled_difference - difference >= difference) & valid).sum(axis=0)
+        report[f'{name} Estimate'] = estimates[i]
+        report[f'Difference vs {name}'] = difference
+        report[f'p-value vs {name}'] = (exceedances + 1) / (valid.sum(axis=0) + 1)
+
+    report.attrs['steps'] = aligned_returns.shape[1]
+    return report
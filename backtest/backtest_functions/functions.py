@@ -6,81 +6,62 @@ import pandas as pd
 import numpy as np
 import torch
 import math
-from concurrent.futures import ThreadPoolExecutor
+
+from backtest.backtest_functions.backtest_executor import BacktestExecutor, EvaluationService
+from backtest.backtest_functions.benchmark_backtest import benchmark_backtest, oracle_backtest, \
+    run_benchmark_backtesting, is_benchmark_agent
+from backtest.backtest_functions.bootstrap import bootstrap_significance, balances_to_returns
+from backtest.backtest_functions.sensitivity import sensitivity_grid
+from backtest.backtest_functions.results_store import BacktestResultsStore
+from backtest.backtest_functions.generation_selection import GenerationTraceSelector
+from backtest.backtest_functions.walk_forward_orchestrator import WalkForwardOrchestrator, stitch_walk_forward
+from backtest.backtest_functions.purged_cv import purged_kfold_plan, combinatorial_purged_plan, cpcv_paths, \
+    stitch_cv_path, run_purged_cv
+from backtest.backtest_functions.batched_backtest import run_batched_backtest, supports_batched_backtest
+from backtest.backtest_functions.kpi import calculate_kpis, kpis_to_dict, longest_run, as_positions, \
+    positions_to_labels, ACTION_LABELS
 
 #from functions.utilis import prepare_backtest_results, generate_index_labels, get_time
 
 def calculate_drawdown_duration(drawdown):
-    # Identifying the drawdown periods
-    is_drawdown = drawdown < 0
+    # The longest run of consecutive periods in drawdown (NaN if there was no drawdown)
+    is_drawdown = np.asarray(drawdown) < 0
+    return longest_run(is_drawdown)
 
-    # Start a new group every time there is a change from drawdown to non-drawdown
-    drawdown_groups = is_drawdown.ne(is_drawdown.shift()).cumsum()
+#@get_time
+def run_backtesting(agent, agent_type, datasets, labels, backtest_wrapper, currency_pair, look_back,
+                    variables, provision, starting_balance, leverage, Trading_Environment_Class, reward_calculation,
+                    workers=4, executor=None):
+    """
+    Backtests of a frozen snapshot of the agent on all datasets in a process pool (backtest_executor.py).
+    A persistent BacktestExecutor created for the same datasets can be passed to reuse its workers.
+    Benchmark agents (Buy and Hold, Sell and Hold, Perfect Foresight) are computed from the close prices and cached
+    (benchmark_backtest.py), without the pool.
 
-    # Filter out only the drawdown periods
-    drawdown_periods = drawdown_groups[is_drawdown]
+    Returns:
+        tuple: backtest_results, probabilities and balances, all keyed by (generation, label).
+    """
+    if is_benchmark_agent(agent):
+        return run_benchmark_backtesting(agent, agent_type, datasets, labels, currency_pair, look_back, provision,
+                                         starting_balance, leverage, reward_calculation)
 
-    # Count consecutive indexes in each drawdown period
-    drawdown_durations = drawdown_periods.groupby(drawdown_periods).transform('count')
+    if executor is not None:
+        return executor.run(agent, agent_type)
 
-    # The longest duration of drawdown
-    max_drawdown_duration = drawdown_durations.max()
+    with BacktestExecutor(datasets, labels, backtest_wrapper, currency_pair, look_back, variables, provision,
+                          starting_balance, leverage, Trading_Environment_Class, reward_calculation,
+                          workers=workers) as executor:
+        return executor.run(agent, agent_type)
 
-    return max_drawdown_duration
 
-#@get_time
-def run_backtesting(agent, agent_type, datasets, labels, backtest_wrapper, currency_pair, look_back,
-                    variables, provision, starting_balance, leverage, Trading_Environment_Class, reward_calculation,
-                    workers=4):
-    backtest_results = {}
-    probs_dfs = {}
-    balances_dfs = {}
-
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = []
-        for df, label in zip(datasets, labels):
-            # Pass parameters properly to the backtest_wrapper function.
-            future = executor.submit(backtest_wrapper, agent_type, df, agent, currency_pair, look_back,
-                                     variables, provision, starting_balance, leverage,
-                                     Trading_Environment_Class, reward_calculation)
-            futures.append((future, label))
-
-        for future, label in futures:
-            result = future.result()
-            balance, total_reward, number_of_trades, probabilities_df, action_df, sharpe_ratio, max_drawdown, \
-            sortino_ratio, calmar_ratio, cumulative_returns, balances, provision_sum, max_drawdown_duration, \
-            average_trade_duration, in_long, in_short, in_out_of_market, win_rate, annualised_returns, \
-            annualised_std = result
-
-            # Update result_data with all required metrics
-            result_data = {
-                'Agent generation': agent.generation,
-                'Agent Type': agent_type,
-                'Label': label,
-                'Provision_sum': provision_sum,
-                'Final Balance': balance,
-                'Total Reward': total_reward,
-                'Number of Trades': number_of_trades,
-                'Sharpe Ratio': sharpe_ratio,
-                'Max Drawdown': max_drawdown,
-                'Sortino Ratio': sortino_ratio,
-                'Calmar Ratio': calmar_ratio,
-                'Max Drawdown Duration': max_drawdown_duration,
-                'Average Trade Duration': average_trade_duration,
-                'In Long': in_long,
-                'In Short': in_short,
-                'In Out of the Market': in_out_of_market,
-                'Win Rate': win_rate,
-                'Average Yearly Return': annualised_returns,
-                'Average Yearly std': annualised_std,
-            }
-
-            key = (agent.generation, label)
-            backtest_results.setdefault(key, []).append(result_data)
-            probs_dfs[key] = probabilities_df
-            balances_dfs[key] = balances
-
-    return backtest_results, probs_dfs, balances_dfs
+def set_training_mode(agent, training):
+    # frozen snapshots (backtest_executor.py) stay in eval mode
+    if getattr(agent, 'frozen', False):
+        return
+    for name in ('actor', 'critic', 'q_policy'):
+        network = getattr(agent, name, None)
+        if network is not None:
+            network.train(training)
 
 
 def generate_predictions_and_backtest(agent_type, df, agent, mkf, look_back, variables, provision=0.001,
@@ -104,18 +85,15 @@ def generate_predictions_and_backtest(agent_type, df, agent, mkf, look_back, var
         annualization_factor (int): The factor for annualizing metrics.
 
     Returns:
-        tuple: A tuple containing various backtest results and statistics.
+        tuple: A tuple containing various backtest results and statistics, the action probabilities as a float32
+        (steps, 3) array, the actions as int8 positions (-1, 0, 1) and the balances as a float64 array.
     """
     action_probabilities_list = []
     best_action_list = []
     balances = []
 
     # Preparing the environment
-    if agent_type == 'PPO':
-        agent.actor.eval()
-        agent.critic.eval()
-    elif agent_type == 'DQN':
-        agent.q_policy.eval()
+    set_training_mode(agent, False)
 
     with torch.no_grad():
         # Create a backtesting environment
@@ -134,180 +112,138 @@ def generate_predictions_and_backtest(agent_type, df, agent, mkf, look_back, var
             observation = observation_
 
             balances.append(env.balance)  # Update balances
-            action_probabilities_list.append(action_probs.tolist())
+            action_probabilities_list.append(action_probs)
             best_action_list.append(best_action-1)
 
-    # KPI Calculations
-    returns = pd.Series([starting_balance] + balances).pct_change().dropna()
-    annual_return = (pd.Series(balances).iloc[-1] / starting_balance) ** (annualization_factor / len(returns)) - 1
-    annual_std = returns.std() * np.sqrt(annualization_factor)
-    sharpe_ratio = annual_return / annual_std if returns.std() > 1e-6 else float('nan')
-
-    cumulative_returns = (1 + returns).cumprod()
-    peak = cumulative_returns.expanding(min_periods=1).max()
-    drawdown = (cumulative_returns - peak) / peak
-    max_drawdown = drawdown.min()
-    max_drawdown_duration = calculate_drawdown_duration(drawdown)
-
-    negative_volatility = returns[returns < 0].std() * np.sqrt(annualization_factor)
-    sortino_ratio = annual_return / negative_volatility if negative_volatility > 1e-6 else float('nan')
+    # Ensure the agent's networks are reverted back to training mode
+    set_training_mode(agent, True)
 
-    calmar_ratio = annual_return / abs(max_drawdown) if abs(max_drawdown) > 1e-6 else float('nan')
+    return summarize_backtest(balances, action_probabilities_list, best_action_list, env.balance, env.reward_sum,
+                              env.num_trades, env.profitable_trades, env.provision_sum, starting_balance,
+                              annualization_factor)
 
-    # Convert the list of action probabilities to a DataFrame
-    probabilities_df = pd.DataFrame(action_probabilities_list, columns=['Short', 'Neutral', 'Long'])
-    action_df = pd.DataFrame(best_action_list, columns=['Action'])
 
-    action_df['Action'] = action_df['Action'].map({-1: 'Short', 0: 'Neutral', 1: 'Long'})
+def generate_predictions_and_backtest_batched(agent_type, df, agent, mkf, look_back, variables, provision=0.001,
+                                              starting_balance=10000, leverage=1, Trading_Environment_Basic=None,
+                                              reward_function=None, annualization_factor=365, risk_free_rate=0.0):
+    """
+    Same as generate_predictions_and_backtest but with the position-enumerated batched engine (batched_backtest.py),
+    the agent has to implement get_action_probabilities_batch(observations, static_inputs).
+    Trading_Environment_Basic is not used, the engine reproduces its step accounting.
 
-    # Pass the 'Action' column Series directly
-    num_trades, average_trade_duration = calculate_number_of_trades_and_duration(action_df['Action'])
+    Returns:
+        tuple: The same tuple as generate_predictions_and_backtest.
+    """
+    # Preparing the environment
+    set_training_mode(agent, False)
 
-    # Calculate the number of times the agent was in long, short, or out of the market
-    in_long = action_df[action_df['Action'] == 'Long'].shape[0] / (len(df) - env.look_back - 1)
-    in_short = action_df[action_df['Action'] == 'Short'].shape[0] / (len(df) - env.look_back - 1)
-    in_out_of_market = action_df[action_df['Action'] == 'Neutral'].shape[0] / (len(df) - env.look_back - 1)
+    with torch.no_grad():
+        actions, probabilities, balances, balance, reward_sum, num_trades, profitable_trades, provision_sum = \
+            run_batched_backtest(agent, df, mkf, look_back, variables, provision, starting_balance, leverage,
+                                 reward_function)
 
     # Ensure the agent's networks are reverted back to training mode
-    if agent_type == 'PPO':
-        agent.actor.train()
-        agent.critic.train()
-    elif agent_type == 'DQN':
-        agent.q_policy.train()
+    set_training_mode(agent, True)
 
-    win_rate = env.profitable_trades / env.num_trades if env.num_trades > 0 else 0
+    return summarize_backtest(balances, probabilities, actions, balance, reward_sum,
+                              num_trades, profitable_trades, provision_sum, starting_balance, annualization_factor)
 
-    return (env.balance, env.reward_sum, env.num_trades, probabilities_df, action_df, sharpe_ratio, max_drawdown,  # 7
-            sortino_ratio, calmar_ratio, cumulative_returns, balances, env.provision_sum, max_drawdown_duration,  # 7
-            average_trade_duration, in_long, in_short, in_out_of_market, win_rate, annual_return, annual_std)  # 5
 
-def backtest_wrapper(agent_type, df, agent, mkf, look_back, variables, provision, initial_balance, leverage, Trading_Environment_Basic=None, reward_function=None):
+def summarize_backtest(balances, action_probabilities_list, best_action_list, balance, reward_sum, num_trades,
+                       profitable_trades, provision_sum, starting_balance=10000, annualization_factor=365):
     """
-    # TODO add description
+    KPI calculations of a backtest, shared by the environment loop and the batched engine.
     """
-    return generate_predictions_and_backtest(agent_type, df, agent, mkf, look_back, variables, provision, initial_balance, leverage, Trading_Environment_Basic, reward_function)
-
-
-def calculate_number_of_trades_and_duration(actions):
-    # Identify trade transitions
-    transitions = (actions.shift(1) != actions) & (actions != 'Neutral')
-    num_trades = transitions.sum()
-
-    # Calculate durations
-    durations = []
-    current_duration = 0
-    current_action = 'Neutral'
-
-    # Iterate through the actions to count the consecutive non-neutral actions
-    for action in actions:
-        if action != 'Neutral':
-            if action == current_action:
-                current_duration += 1
-            else:
-                if current_duration > 0:
-                    durations.append(current_duration)
-                current_action = action
-                current_duration = 1
-        else:
-            if current_duration > 0:
-                durations.append(current_duration)
-                current_duration = 0
-                current_action = 'Neutral'
+    # compact result arrays, labels are only created for presentation (probabilities_to_frame)
+    balances = np.asarray(balances, dtype=np.float64)
+    probabilities = np.asarray(action_probabilities_list, dtype=np.float32).reshape(-1, len(ACTION_LABELS))
+    actions = np.asarray(best_action_list, dtype=np.int8)
 
-    # Append the last duration if the series ended with a trade still active
-    if current_duration > 0:
-        durations.append(current_duration)
-
-    # Calculate the average duration, handle cases where durations list might be empty
-    avg_duration = np.mean(durations) if durations else 0
-
-    return num_trades, avg_duration
-
-def generate_result_statistics(df, strategy_column=None, balance_column=None, provision_sum=0, look_back=1, annualization_factor=365, starting_balance=10000):
-    df = df.reset_index(drop=True)
+    # KPI Calculations
+    kpis = kpis_to_dict(calculate_kpis(balances, actions, starting_balance, annualization_factor))
 
-    # Calculate returns
-    returns = pd.Series([starting_balance] + df[balance_column].tolist()).pct_change().dropna()
+    balances_with_start = np.concatenate(([starting_balance], balances))
+    returns = balances_with_start[1:] / balances_with_start[:-1] - 1
+    cumulative_returns = pd.Series(np.cumprod(1 + returns), index=range(1, len(returns) + 1))
 
-    # Calculate final balance
-    final_balance = df[balance_column].iloc[-1]
-    annual_return = (final_balance / starting_balance) ** (annualization_factor / len(returns)) - 1
+    # the number of trades reported is the one counted by the environment
+    win_rate = profitable_trades / num_trades if num_trades > 0 else 0
 
-    # Calculate Annual Standard Deviation
-    annual_std = returns.std() * np.sqrt(annualization_factor)
+    return (balance, reward_sum, num_trades, probabilities, actions, kpis['Sharpe Ratio'],  # 6
+            kpis['Max Drawdown'], kpis['Sortino Ratio'], kpis['Calmar Ratio'], cumulative_returns, balances,  # 5
+            provision_sum, kpis['Max Drawdown Duration'], kpis['Average Trade Duration'], kpis['In Long'],  # 4
+            kpis['In Short'], kpis['In Out of the Market'], win_rate, kpis['Annual Return'], kpis['Annual Std'])  # 5
 
-    # Calculate Sharpe Ratio
-    sharpe_ratio = annual_return / annual_std if returns.std() > 1e-6 else float('nan')
+def backtest_wrapper(agent_type, df, agent, mkf, look_back, variables, provision, initial_balance, leverage, Trading_Environment_Basic=None, reward_function=None):
+    """
+    Backtest of one dataset, agents implementing get_action_probabilities_batch use the batched engine, the other
+    ones (e.g. stateful benchmark agents) step through the environment.
+    """
+    if supports_batched_backtest(agent):
+        return generate_predictions_and_backtest_batched(agent_type, df, agent, mkf, look_back, variables, provision, initial_balance, leverage, Trading_Environment_Basic, reward_function)
+    return generate_predictions_and_backtest(agent_type, df, agent, mkf, look_back, variables, provision, initial_balance, leverage, Trading_Environment_Basic, reward_function)
 
-    # Calculate Cumulative Returns
-    cumulative_returns = (1 + returns).cumprod()
-    peak = cumulative_returns.expanding(min_periods=1).max()
-    drawdown = (cumulative_returns - peak) / peak
-    max_drawdown = drawdown.min()
 
-    max_drawdown_duration = calculate_drawdown_duration(drawdown)
+def probabilities_to_frame(probabilities, actions=None, action_column='Action', labels=False):
+    """
+    Presentation DataFrame of an action trace.
 
-    # Calculate Sortino Ratio
-    negative_volatility = returns[returns < 0].std() * np.sqrt(annualization_factor)
-    sortino_ratio = annual_return / negative_volatility if negative_volatility > 1e-6 else float('nan')
+    Parameters:
+        probabilities (array): (steps, 3) action probabilities.
+        actions (array): Positions (-1, 0, 1) taken, by default the most probable action of every step.
+        action_column (str): Name of the action column.
+        labels (bool): Actions as 'Short' / 'Neutral' / 'Long' labels instead of int8 position codes.
 
-    # Calculate Calmar Ratio
-    calmar_ratio = annual_return / abs(max_drawdown) if abs(max_drawdown) > 1e-6 else float('nan')
+    Returns:
+        pd.DataFrame: 'Short', 'Neutral', 'Long' probabilities and the action column.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float32).reshape(-1, len(ACTION_LABELS))
+    if actions is None:
+        actions = np.argmax(probabilities, axis=1) - 1
+    frame = pd.DataFrame(probabilities, columns=ACTION_LABELS)
+    actions = np.asarray(actions, dtype=np.int8)
+    frame[action_column] = positions_to_labels(actions) if labels else actions
+    return frame
 
-    # Calculate the number of times the agent was in long, short, or out of the market
-    if strategy_column is None:
-        in_long = 0
-        in_short = 0
-        out_of_market = 0
-        num_trades = 0
-        avg_duration = 0
-        win_rate = 0
 
-    else:
-        # Calculate Number of Trades and Average Duration
-        num_trades, avg_duration = calculate_number_of_trades_and_duration(df[strategy_column])
+def calculate_number_of_trades_and_duration(actions):
+    # actions are positions or 'Short' / 'Neutral' / 'Long' labels, trades are counted with run-length encoding in kpi.py
+    positions = as_positions(actions)
+    kpis = kpis_to_dict(calculate_kpis(np.ones(len(positions)), positions, 1))
+    return int(kpis['Number of Trades']), kpis['Average Trade Duration']
 
-        # calculate profitable trades
-        profitable_trades = calculate_profitable_trades(df, strategy_column, balance_column)
-        win_rate = profitable_trades / num_trades if num_trades > 0 else float('nan')
+def generate_result_statistics(df, strategy_column=None, balance_column=None, provision_sum=0, look_back=1, annualization_factor=365, starting_balance=10000):
+    df = df.reset_index(drop=True)
 
-        in_long = df[df[strategy_column] == 'Long'].shape[0]
-        in_short = df[df[strategy_column] == 'Short'].shape[0]
-        out_of_market = df[df[strategy_column] == 'Neutral'].shape[0]
+    positions = as_positions(df[strategy_column]) if strategy_column is not None else None
+    kpis = kpis_to_dict(calculate_kpis(df[balance_column].values, positions, starting_balance, annualization_factor))
 
     # Compile metrics
     metrics = {
-        'Final Balance': df[balance_column].iloc[-1],
+        'Final Balance': kpis['Final Balance'],
         'Provision Sum': provision_sum,
-        'Sharpe Ratio': sharpe_ratio,
-        'Sortino Ratio': sortino_ratio,
-        'Max Drawdown': max_drawdown,
-        'Max Drawdown Duration': max_drawdown_duration,
-        'Calmar Ratio': calmar_ratio,
-        'Number of Trades': num_trades,
-        'Average trade duration': avg_duration,
-        'In long': in_long / len(df),
-        'In short': in_short / len(df),
-        'In out of the market': out_of_market / len(df),
-        'Win Rate': win_rate,
-        'Annual Return': annual_return,
-        'Annual Std': returns.std() * np.sqrt(annualization_factor),
+        'Sharpe Ratio': kpis['Sharpe Ratio'],
+        'Sortino Ratio': kpis['Sortino Ratio'],
+        'Max Drawdown': kpis['Max Drawdown'],
+        'Max Drawdown Duration': kpis['Max Drawdown Duration'],
+        'Calmar Ratio': kpis['Calmar Ratio'],
+        'Number of Trades': int(kpis['Number of Trades']),
+        'Average trade duration': kpis['Average Trade Duration'],
+        'In long': kpis['In Long'],
+        'In short': kpis['In Short'],
+        'In out of the market': kpis['In Out of the Market'],
+        'Win Rate': kpis['Win Rate'] if strategy_column is not None else 0,
+        'Annual Return': kpis['Annual Return'],
+        'Annual Std': kpis['Annual Std'],
     }
     return metrics
 
 
 def calculate_profitable_trades(df, strategy_column, balance_column, initial_capital=10000):
-    # Append a row with the initial balance at the beginning of the dataframe
-    initial_row = pd.DataFrame({balance_column: [initial_capital], strategy_column: [None]})
-    df = pd.concat([initial_row, df], ignore_index=True)
-
-    # Drop consecutive duplicates in the strategy column
-    filtered_df = df.loc[(df[strategy_column] != df[strategy_column].shift())]
-
-    # Calculate profitable trades where the balance has increased from the last trade
-    profitable_trades = (filtered_df[balance_column].diff() > 0).sum()
-
-    return profitable_trades
+    # Trades where the balance at the change of the strategy increased from the balance at the previous change
+    positions = as_positions(df[strategy_column])
+    kpis = kpis_to_dict(calculate_kpis(df[balance_column].values, positions, initial_capital))
+    return int(kpis['Profitable Trades'])
 
 
 def test_calculate_profitable_trades():
@@ -350,8 +286,63 @@ def test_calculate_profitable_trades():
     print("All tests passed!")
 
 
+def test_batched_backtest_matches_environment():
+    # the batched engine has to reproduce the environment loop exactly, on synthetic prices with a fixed random policy
+    from trading_environment.environment import Trading_Environment_Basic
+
+    class LinearSoftmaxAgent:
+        def __init__(self, input_dims, seed=0):
+            rng = np.random.default_rng(seed)
+            self.weights = rng.normal(scale=0.5, size=(input_dims, 3))
+            self.position_weights = rng.normal(size=3)
+
+        def get_action_probabilities_batch(self, observations, static_inputs):
+            positions = np.asarray(static_inputs, dtype=np.float64)[:, None]
+            logits = np.asarray(observations) @ self.weights + positions * self.position_weights
+            exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+            return exp_logits / exp_logits.sum(axis=1, keepdims=True)
+
+        def get_action_probabilities(self, observation, current_position):
+            return self.get_action_probabilities_batch(np.asarray(observation).reshape(1, -1),
+                                                       np.array([current_position]))[0]
+
+    def reward_function(previous_close, current_close, previous_position, current_position, leverage, provision):
+        return (current_close - previous_close) / previous_close * current_position * leverage
+
+    rng = np.random.default_rng(42)
+    n_rows, look_back = 400, 10
+    df = pd.DataFrame({('Close', 'EURUSD'): 1.1 * np.exp(np.cumsum(rng.normal(0, 0.005, n_rows))),
+                       ('Close', 'USDJPY'): 110 * np.exp(np.cumsum(rng.normal(0, 0.005, n_rows))),
+                       ('Volume', 'EURUSD'): rng.normal(size=n_rows)},
+                      index=pd.date_range('2020-01-01', periods=n_rows, freq='D'))
+    df.columns.names = ['Price', 'Currency']
+    variables = [{'variable': ('Close', 'EURUSD'), 'edit': 'standardize'},
+                 {'variable': ('Close', 'USDJPY'), 'edit': 'normalize'},
+                 {'variable': ('Volume', 'EURUSD'), 'edit': None}]
+    agent = LinearSoftmaxAgent(len(variables) * look_back)
+
+    for leverage in (1, 3):
+        environment_result = generate_predictions_and_backtest('TEST', df, agent, 'EURUSD', look_back, variables,
+                                                               0.0001, 10000, leverage, Trading_Environment_Basic,
+                                                               reward_function)
+        batched_result = generate_predictions_and_backtest_batched('TEST', df, agent, 'EURUSD', look_back, variables,
+                                                                   0.0001, 10000, leverage,
+                                                                   Trading_Environment_Basic, reward_function)
+        assert len(environment_result) == len(batched_result) == 20
+        for field, (expected, result) in enumerate(zip(environment_result, batched_result)):
+            if isinstance(expected, (np.ndarray, pd.Series)):
+                assert np.allclose(np.asarray(expected), np.asarray(result), rtol=1e-6, equal_nan=True), \
+                    f"Field {field} differs at leverage {leverage}"
+            else:
+                assert expected == result or (np.isnan(expected) and np.isnan(result)), \
+                    f"Field {field} differs at leverage {leverage}: {expected} != {result}"
+
+    print("Batched backtest matches the environment loop!")
+
+
 if __name__ == '__main__':
     test_calculate_profitable_trades()
+    test_batched_backtest_matches_environment()
 
     # test average trade duration
     actions = pd.Series(['Long', 'Short'] * 5)
@@ -0,0 +1,189 @@
+"""
+Bounded retention of the backtest traces of the generations
+
+The walk-forward scripts only use the probabilities and balances of the best generation of a step, but every
+generation is backtested on every window. GenerationTraceSelector keeps the full traces (probabilities, balances)
+only for the current top_k generations by a metric of backtest_results (e.g. the validation Sharpe Ratio, the
+scalar metrics of all generations stay in backtest_results), the traces of the other generations are dropped or
+spilled to compressed .npz files. Its probabilities and balances views are drop-in replacements of the probs_dfs
+and balances_dfs dicts of BacktestExecutor.collect / EvaluationService (keys (generation, label)).
+
+The generations are collected in the order of submission, so a generation is complete once the first trace of a newer
+generation arrives. The newest generation is always kept, the completed ones are ranked and evicted.
+"""
+import math
+import os
+from collections.abc import MutableMapping
+
+import numpy as np
+
+TRACE_KINDS = ('probabilities', 'balances')
+
+
+class TraceView(MutableMapping):
+    """
+    Dict-like view of one kind of traces of a GenerationTraceSelector, keyed by (generation, label).
+    """
+    def __init__(self, selector, kind):
+        self.selector = selector
+        self.kind = kind
+
+    def __getitem__(self, key):
+        return self.selector.get_trace(self.kind, *key)
+
+    def __setitem__(self, key, value):
+        self.selector.store_trace(self.kind, *key, value)
+
+    def __delitem__(self, key):
+        generation, label = key
+        del self.selector.traces[generation][self.kind][label]
+
+    def __iter__(self):
+        for generation in sorted(set(self.selector.traces) | set(self.selector.spilled)):
+            for label in self.selector.trace_labels(self.kind, generation):
+                yield generation, label
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class GenerationTraceSelector:
+    """
+    Streaming top-k selection of the generations whose traces are kept.
+
+    Usage:
+        backtest_results = {}
+        trace_selector = GenerationTraceSelector(backtest_results, top_k=3, metric='Sharpe Ratio')
+        probs_dfs, balances_dfs = trace_selector.probabilities, trace_selector.balances
+        evaluation_service = EvaluationService(executor, 'PPO', backtest_results, probs_dfs, balances_dfs)
+    """
+    def __init__(self, backtest_results, top_k=3, metric='Sharpe Ratio', label_prefix='validation',
+                 higher_is_better=True, spill_dir=None):
+        """
+        Parameters:
+            backtest_results (dict): The (generation, label) -> metrics dicts the traces belong to, filled by the
+                executor before the traces of the same backtest.
+            top_k (int): Number of completed generations whose traces are kept.
+            metric (str): The metric of backtest_result_data ranking the generations, the best value over the windows
+                with label_prefix (NaN values are ignored, generations without a valid value rank last).
+            label_prefix (str): Windows used for the ranking, None for all.
+            higher_is_better (bool): Direction of the metric.
+            spill_dir (str): Directory for the compressed traces of the evicted generations, None drops them.
+        """
+        self.backtest_results = backtest_results
+        self.top_k = top_k
+        self.metric = metric
+        self.label_prefix = label_prefix
+        self.higher_is_better = higher_is_better
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self.traces = {}  # generation -> {kind: {label: array}}, the retained generations
+        self.spilled = {}  # generation -> (path, {kind: labels})
+        self.newest_generation = None
+        self.probabilities = TraceView(self, 'probabilities')
+        self.balances = TraceView(self, 'balances')
+
+    def score(self, generation, labels=None):
+        """
+        The ranking value of a generation, NaN if it has no valid metric.
+
+        Parameters:
+            labels (iterable): The windows of the generation, looked up directly instead of scanning backtest_results.
+        """
+        if labels is None:
+            keys = [key for key in self.backtest_results if key[0] == generation]
+        else:
+            keys = [(generation, label) for label in labels if (generation, label) in self.backtest_results]
+        values = [result.get(self.metric, math.nan)
+                  for key in keys if self.label_prefix is None or str(key[1]).startswith(self.label_prefix)
+                  for result in self.backtest_results[key]]
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return math.nan
+        return values.max() if self.higher_is_better else values.min()
+
+    def _rank_key(self, generation, scores):
+        score = scores[generation]
+        if math.isnan(score):
+            return 1, 0.0, generation
+        return 0, -score if self.higher_is_better else score, generation
+
+    def scores(self, generations=None):
+        """
+        Ranking values of the given (retained) generations, of all evaluated generations by default.
+        """
+        if generations is not None:
+            return {generation: self.score(generation, self.trace_labels('probabilities', generation))
+                    for generation in generations}
+        labels = {}
+        for generation, label in self.backtest_results:
+            labels.setdefault(generation, []).append(label)
+        return {generation: self.score(generation, generation_labels) for generation, generation_labels in labels.items()}
+
+    def ranked_generations(self, generations=None):
+        """
+        Generations from the best to the worst (ties by the older generation), all evaluated ones by default.
+        """
+        scores = self.scores(generations)
+        return sorted(scores, key=lambda generation: self._rank_key(generation, scores))
+
+    def best_generation(self):
+        """
+        The best generation by the metric, the newest one if no generation has a valid metric.
+        """
+        scores = self.scores()
+        valid = [generation for generation, score in scores.items() if not math.isnan(score)]
+        if valid:
+            return min(valid, key=lambda generation: self._rank_key(generation, scores))
+        return self.newest_generation
+
+    def store_trace(self, kind, generation, label, value):
+        if self.newest_generation is None or generation > self.newest_generation:
+            self.newest_generation = generation
+            self.evict()
+        self.traces.setdefault(generation, {trace_kind: {} for trace_kind in TRACE_KINDS})[kind][label] = value
+
+    def evict(self):
+        """
+        Drops or spills the traces of the completed generations outside the top_k.
+        """
+        completed = [generation for generation in self.traces if generation != self.newest_generation]
+        for generation in self.ranked_generations(completed)[self.top_k:]:
+            traces = self.traces.pop(generation)
+            if self.spill_dir is not None:
+                self._spill(generation, traces)
+
+    def _spill(self, generation, traces):
+        path = os.path.join(self.spill_dir, f'generation_{generation}.npz')
+        arrays = {f'{kind}_{i}': np.asarray(value)
+                  for kind in TRACE_KINDS for i, value in enumerate(traces[kind].values())}
+        np.savez_compressed(path, **arrays)
+        self.spilled[generation] = (path, {kind: list(traces[kind]) for kind in TRACE_KINDS})
+
+    def trace_labels(self, kind, generation):
+        if generation in self.traces:
+            return list(self.traces[generation][kind])
+        if generation in self.spilled:
+            return list(self.spilled[generation][1][kind])
+        return []
+
+    def get_trace(self, kind, generation, label):
+        if generation in self.traces and label in self.traces[generation][kind]:
+            return self.traces[generation][kind][label]
+        if generation in self.spilled:
+            path, labels = self.spilled[generation]
+            if label in labels[kind]:
+                with np.load(path) as arrays:
+                    return arrays[f'{kind}_{labels[kind].index(label)}']
+        raise KeyError((generation, label))
+
+    def clear(self):
+        for path, _ in self.spilled.values():
+            if os.path.exists(path):
+                os.remove(path)
+        self.traces.clear()
+        self.spilled.clear()
+        self.newest_generation = None
@@ -0,0 +1,211 @@
+"""
+KPI engine for backtest statistics
+
+All metrics of a backtest are computed from the balance array (and optionally the position array, -1 short,
+0 neutral, 1 long) in a single numba pass. Many series can be evaluated at once, the result is a
+(n_series, n_metrics) array with the columns in KPI_NAMES.
+Trades and their durations are counted with run-length encoding of the positions.
+Actions are kept as int8 position codes everywhere, the 'Short' / 'Neutral' / 'Long' labels are only used for
+presentation (positions_to_labels).
+"""
+import numpy as np
+from numba import jit, prange
+
+KPI_NAMES = ['Final Balance', 'Annual Return', 'Annual Std', 'Sharpe Ratio', 'Sortino Ratio', 'Max Drawdown',
+             'Max Drawdown Duration', 'Calmar Ratio', 'Number of Trades', 'Average Trade Duration',
+             'Profitable Trades', 'Win Rate', 'In Long', 'In Short', 'In Out of the Market']
+KPI_INDEX = {name: i for i, name in enumerate(KPI_NAMES)}
+N_KPIS = len(KPI_NAMES)
+
+NO_POSITION = 2  # marks the position "before" the first step, differs from every real position
+ACTION_LABELS = ['Short', 'Neutral', 'Long']  # label of position p is ACTION_LABELS[p + 1]
+LABEL_POSITIONS = {label: position - 1 for position, label in enumerate(ACTION_LABELS)}
+
+
+@jit(nopython=True, error_model='numpy', cache=True)
+def _series_kpis(balances, positions, has_positions, starting_balance, annualization_factor, out):
+    n = len(balances)
+
+    # returns, Welford mean / variance for all and for negative returns
+    count, mean, m2 = 0, 0.0, 0.0
+    negative_count, negative_mean, negative_m2 = 0, 0.0, 0.0
+
+    # drawdown
+    cumulative, peak = 1.0, -np.inf
+    max_drawdown = np.inf
+    drawdown_run, max_drawdown_run = 0, 0
+
+    # positions, run-length encoding of the non-neutral positions
+    previous_position = NO_POSITION
+    num_trades, run_length, run_position, runs, total_run_length = 0, 0, 0, 0, 0
+    profitable_trades, last_balance = 0, starting_balance
+    in_long, in_short, in_out_of_market = 0, 0, 0
+
+    previous_balance = starting_balance
+    for t in range(n):
+        balance = balances[t]
+        r = balance / previous_balance - 1
+        previous_balance = balance
+
+        if not np.isnan(r):
+            count += 1
+            delta = r - mean
+            mean += delta / count
+            m2 += delta * (r - mean)
+
+            if r < 0:
+                negative_count += 1
+                delta = r - negative_mean
+                negative_mean += delta / negative_count
+                negative_m2 += delta * (r - negative_mean)
+
+            cumulative *= 1 + r
+            peak = max(peak, cumulative)
+            drawdown = (cumulative - peak) / peak
+            max_drawdown = min(max_drawdown, drawdown)
+            if drawdown < 0:
+                drawdown_run += 1
+                max_drawdown_run = max(max_drawdown_run, drawdown_run)
+            else:
+                drawdown_run = 0
+
+        if has_positions:
+            position = positions[t]
+            if position != previous_position:
+                if position != 0:
+                    num_trades += 1
+                # balance at every change of the position compared to the previous change
+                if balance - last_balance > 0:
+                    profitable_trades += 1
+                last_balance = balance
+
+            if position != 0:
+                if position == run_position:
+                    run_length += 1
+                else:
+                    if run_length > 0:
+                        runs += 1
+                        total_run_length += run_length
+                    run_position = position
+                    run_length = 1
+            else:
+                if run_length > 0:
+                    runs += 1
+                    total_run_length += run_length
+                run_length = 0
+                run_position = 0
+
+            if position == 1:
+                in_long += 1
+            elif position == -1:
+                in_short += 1
+            else:
+                in_out_of_market += 1
+            previous_position = position
+
+    if run_length > 0:
+        runs += 1
+        total_run_length += run_length
+
+    std = np.sqrt(m2 / (count - 1)) if count > 1 else np.nan
+    negative_std = np.sqrt(negative_m2 / (negative_count - 1)) if negative_count > 1 else np.nan
+    annual_return = (balances[n - 1] / starting_balance) ** (annualization_factor / count) - 1
+    annual_std = std * np.sqrt(annualization_factor)
+    negative_volatility = negative_std * np.sqrt(annualization_factor)
+    if count == 0:
+        max_drawdown = np.nan
+
+    out[0] = balances[n - 1]
+    out[1] = annual_return
+    out[2] = annual_std
+    out[3] = annual_return / annual_std if std > 1e-6 else np.nan
+    out[4] = annual_return / negative_volatility if negative_volatility > 1e-6 else np.nan
+    out[5] = max_drawdown
+    out[6] = max_drawdown_run if max_drawdown_run > 0 else np.nan
+    out[7] = annual_return / abs(max_drawdown) if abs(max_drawdown) > 1e-6 else np.nan
+    out[8] = num_trades
+    out[9] = total_run_length / runs if runs > 0 else 0.0
+    out[10] = profitable_trades
+    out[11] = profitable_trades / num_trades if num_trades > 0 else np.nan
+    out[12] = in_long / n
+    out[13] = in_short / n
+    out[14] = in_out_of_market / n
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _kpi_matrix(balances, positions, has_positions, starting_balances, annualization_factor):
+    n_series = balances.shape[0]
+    out = np.empty((n_series, N_KPIS))
+    for i in prange(n_series):
+        _series_kpis(balances[i], positions[i], has_positions, starting_balances[i], annualization_factor, out[i])
+    return out
+
+
+def calculate_kpis(balances, positions=None, starting_balance=10000, annualization_factor=365):
+    """
+    Calculate all KPIs of one or many backtests.
+
+    Parameters:
+        balances (array): Balances after every step, shape (steps,) or (n_series, steps).
+        positions (array): Positions (-1, 0, 1) held in every step, same shape as balances, optional.
+        starting_balance (float or array): Balance before the first step, one value or one per series.
+        annualization_factor (int): The factor for annualizing metrics.
+
+    Returns:
+        np.ndarray: (n_series, n_metrics) array, columns as in KPI_NAMES. Without positions the trade metrics are 0.
+    """
+    balances = np.atleast_2d(np.asarray(balances, dtype=np.float64))
+    has_positions = positions is not None
+    if has_positions:
+        positions = np.atleast_2d(np.asarray(positions, dtype=np.int64))
+    else:
+        positions = np.zeros(balances.shape, dtype=np.int64)
+    starting_balances = np.broadcast_to(np.asarray(starting_balance, dtype=np.float64), balances.shape[:1]).copy()
+
+    kpis = _kpi_matrix(balances, positions, has_positions, starting_balances, float(annualization_factor))
+    if not has_positions:
+        kpis[:, KPI_INDEX['Number of Trades']:] = 0
+    return kpis
+
+
+def labels_to_positions(labels):
+    """
+    'Short' / 'Neutral' / 'Long' labels to positions -1 / 0 / 1.
+    """
+    return np.array([LABEL_POSITIONS[label] for label in labels], dtype=np.int8)
+
+
+def positions_to_labels(positions):
+    """
+    Positions -1 / 0 / 1 to 'Short' / 'Neutral' / 'Long' labels.
+    """
+    return np.array(ACTION_LABELS, dtype=object)[np.asarray(positions, dtype=np.int64) + 1]
+
+
+def as_positions(actions):
+    """
+    int8 positions of an action trace given either as position codes or as labels.
+    """
+    actions = np.asarray(actions)
+    if actions.dtype.kind in 'iuf':
+        return actions.astype(np.int8)
+    return labels_to_positions(actions)
+
+
+@jit(nopython=True, cache=True)
+def longest_run(mask):
+    """
+    Length of the longest run of True values, NaN if there is none.
+    """
+    run, longest = 0, 0
+    for value in mask:
+        run = run + 1 if value else 0
+        longest = max(longest, run)
+    return longest if longest > 0 else np.nan
+
+
+def kpis_to_dict(kpis):
+    """
+    Metrics of a single series as a dictionary.
+    """
+    return dict(zip(KPI_NAMES, np.asarray(kpis).reshape(-1, len(KPI_NAMES))[0].tolist()))
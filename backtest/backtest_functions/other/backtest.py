@@ -1,278 +1,426 @@
+"""
+Array based event-driven multi-asset backtester
+
+- prices, proposed positions and the account state are 2D arrays (bars, markets), every bar is processed by the
+  numba kernel _process_bars: mark to market, exits (take profit, stop loss, trailing stop, time stop), new positions
+- positions are capital amounts (negative - short), every opened position is a trade of the trade log, positions are
+  reduced first in first out
+- the trade log is a preallocated structured array (TRADE_DTYPE), doubled when it gets full
+Strategies implement calculate_new_positions(df, current_index) (called every bar, the account state is available
+as self.available_capital / self.capital_in) or, for strategies that do not depend on the account state,
+calculate_position_signals(df) returning all proposed positions at once, which runs the whole backtest in numba.
+"""
 # import libraries
 import numpy as np
 import pandas as pd
+from numba import jit
 from tqdm import tqdm
 import warnings
 
 # Ignore all FutureWarnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+TRADE_DTYPE = np.dtype([
+    ('Trade_ID', np.int64),
+    ('Parent_ID', np.int64),
+    ('Currency', np.int64),  # position of the market in tradable_markets
+    ('Position_Size', np.float64),
+    ('Unit_Size', np.float64),
+    ('Open_Price', np.float64),
+    ('Close_Price', np.float64),
+    ('Open_Date', np.int64),  # bar number
+    ('Close_Date', np.int64),
+    ('Take_Profit', np.float64),  # price levels
+    ('Stop_Loss', np.float64),
+    ('Trailing_stop_loss', np.float64),
+    ('Time_stop_loss', np.int64),  # maximal number of bars
+    ('Best_Price', np.float64),
+    ('Provisions', np.float64),
+    ('PnL', np.float64),
+    ('Exit_Reason', np.int8),
+    ('Status', np.int8),  # 0 - open, 1 - closed
+])
+
+EXIT_REASONS = ['New Position', 'Close Position', 'Partial Close', 'Take Profit', 'Stop Loss', 'Trailing Stop Loss',
+                'Time Stop Loss']
+NEW_POSITION, CLOSE_POSITION, PARTIAL_CLOSE, TAKE_PROFIT, STOP_LOSS, TRAILING_STOP_LOSS, TIME_STOP_LOSS = range(7)
+OPEN, CLOSED = 0, 1
+
+# account state of the markets, rows of the state array
+CAPITAL_IN, UNITS, OPEN_NOTIONAL, OPEN_TRADES, FIRST_OPEN = range(5)
+
+
+@jit(nopython=True)
+def _open_trade(trades, counters, state, market, position, price, bar, parent_id, provision, exits):
+    direction = 1.0 if position > 0 else -1.0
+    k = counters[0]
+    counters[0] += 1
+    counters[1] += 1
+
+    trade = trades[k]
+    trade['Trade_ID'] = counters[1]
+    trade['Parent_ID'] = counters[1] if parent_id < 0 else parent_id
+    trade['Currency'] = market
+    trade['Position_Size'] = position
+    trade['Unit_Size'] = abs(position) / price
+    trade['Open_Price'] = price
+    trade['Close_Price'] = np.nan
+    trade['Open_Date'] = bar
+    trade['Close_Date'] = -1
+    # exits (take profit, stop loss, trailing stop as fractions of the price, time stop in bars), NaN - disabled
+    trade['Take_Profit'] = price * (1 + direction * exits[0])
+    trade['Stop_Loss'] = price * (1 - direction * exits[1])
+    trade['Trailing_stop_loss'] = price * (1 - direction * exits[2])
+    trade['Time_stop_loss'] = int(exits[3]) if not np.isnan(exits[3]) else -1
+    trade['Best_Price'] = price
+    trade['Provisions'] = abs(position) * provision
+    trade['PnL'] = np.nan
+    trade['Exit_Reason'] = NEW_POSITION
+    trade['Status'] = OPEN
+
+    if state[OPEN_TRADES, market] == 0:
+        state[FIRST_OPEN, market] = k
+    state[CAPITAL_IN, market] += position
+    state[UNITS, market] += abs(position) / price
+    state[OPEN_NOTIONAL, market] += abs(position) * price
+    state[OPEN_TRADES, market] += 1
+
+
+@jit(nopython=True)
+def _close_trade(trades, counters, state, k, amount, price, bar, reason, provision, leverage):
+    """
+    Closes amount (absolute capital) of the open trade k, a partial close is logged as a new closed trade.
+    """
+    trade = trades[k]
+    market = trade['Currency']
+    position = trade['Position_Size']
+    open_price = trade['Open_Price']
+    closed = position if amount >= abs(position) * (1 - 1e-12) else np.sign(position) * amount
+
+    if closed == position:
+        record = trade
+        trade['Status'] = CLOSED
+        trade['Exit_Reason'] = reason
+        state[OPEN_TRADES, market] -= 1
+    else:
+        # the remaining position stays open in the same record, which keeps the first in first out order
+        record = trades[counters[0]]
+        counters[0] += 1
+        counters[1] += 1
+        record['Trade_ID'] = counters[1]
+        record['Parent_ID'] = trade['Parent_ID']
+        record['Currency'] = market
+        record['Position_Size'] = closed
+        record['Unit_Size'] = abs(closed) / open_price
+        record['Open_Price'] = open_price
+        record['Open_Date'] = trade['Open_Date']
+        record['Take_Profit'] = trade['Take_Profit']
+        record['Stop_Loss'] = trade['Stop_Loss']
+        record['Trailing_stop_loss'] = trade['Trailing_stop_loss']
+        record['Time_stop_loss'] = trade['Time_stop_loss']
+        record['Best_Price'] = trade['Best_Price']
+        record['Provisions'] = 0.0
+        record['Exit_Reason'] = PARTIAL_CLOSE
+        record['Status'] = CLOSED
+        trade['Position_Size'] = position - closed
+        trade['Unit_Size'] = abs(position - closed) / open_price
+
+    record['Close_Price'] = price
+    record['Close_Date'] = bar
+    record['PnL'] = closed / open_price * (price - open_price) * leverage
+    record['Provisions'] += abs(closed) * provision
+
+    if state[OPEN_TRADES, market] == 0:
+        state[CAPITAL_IN, market] = 0.0
+        state[UNITS, market] = 0.0
+        state[OPEN_NOTIONAL, market] = 0.0
+    else:
+        state[CAPITAL_IN, market] -= closed
+        state[UNITS, market] -= abs(closed) / open_price
+        state[OPEN_NOTIONAL, market] -= abs(closed) * open_price
+    return abs(closed)
+
+
+@jit(nopython=True)
+def _close_position(trades, counters, state, market, amount, price, bar, provision, leverage):
+    """
+    Reduces the position of the market by amount (absolute capital), first in first out.
+    """
+    if amount >= abs(state[CAPITAL_IN, market]) * (1 - 1e-12):
+        amount = np.inf  # the whole position, independent of the rounding of the sum of the trades
+
+    k = int(state[FIRST_OPEN, market])
+    while amount > 0 and state[OPEN_TRADES, market] > 0 and k < counters[0]:
+        trade = trades[k]
+        if trade['Currency'] == market and trade['Status'] == OPEN:
+            amount -= _close_trade(trades, counters, state, k, amount, price, bar, CLOSE_POSITION, provision,
+                                   leverage)
+        k += 1
+    _advance_first_open(trades, counters, state, market)
+
+
+@jit(nopython=True)
+def _advance_first_open(trades, counters, state, market):
+    k = int(state[FIRST_OPEN, market])
+    while k < counters[0] and not (trades[k]['Currency'] == market and trades[k]['Status'] == OPEN):
+        k += 1
+    state[FIRST_OPEN, market] = k
+
+
+@jit(nopython=True)
+def _check_exits(trades, counters, state, market, price, bar, provision, leverage):
+    """
+    Take profit, stop loss, trailing stop and time stop of the open trades of the market at the close of the bar.
+    """
+    closed_capital = 0.0
+    k = int(state[FIRST_OPEN, market])
+    while state[OPEN_TRADES, market] > 0 and k < counters[0]:
+        trade = trades[k]
+        if trade['Currency'] == market and trade['Status'] == OPEN:
+            direction = 1.0 if trade['Position_Size'] > 0 else -1.0
+            if direction * (price - trade['Best_Price']) > 0:
+                if not np.isnan(trade['Trailing_stop_loss']):
+                    distance = abs(trade['Best_Price'] - trade['Trailing_stop_loss']) / trade['Best_Price']
+                    trade['Trailing_stop_loss'] = price * (1 - direction * distance)
+                trade['Best_Price'] = price
+
+            reason = -1
+            if direction * (price - trade['Take_Profit']) >= 0:
+                reason = TAKE_PROFIT
+            elif direction * (price - trade['Stop_Loss']) <= 0:
+                reason = STOP_LOSS
+            elif direction * (price - trade['Trailing_stop_loss']) <= 0:
+                reason = TRAILING_STOP_LOSS
+            elif 0 <= trade['Time_stop_loss'] <= bar - trade['Open_Date']:
+                reason = TIME_STOP_LOSS
+
+            if reason >= 0:
+                closed_capital += _close_trade(trades, counters, state, k, abs(trade['Position_Size']), price, bar,
+                                               reason, provision, leverage)
+        k += 1
+    _advance_first_open(trades, counters, state, market)
+    return closed_capital
+
+
+@jit(nopython=True)
+def _process_bars(close, signals, start, stop, trades, counters, state, capital, available_capital, provisions,
+                  capital_in, average_open, units, pnl, leverage, provision, exits):
+    """
+    Processes the bars [start, stop), returns the next bar to process (earlier than stop if the trade log is full).
+    """
+    n_markets = close.shape[1]
+    has_exits = not (np.isnan(exits[0]) and np.isnan(exits[1]) and np.isnan(exits[2]) and np.isnan(exits[3]))
+
+    for i in range(start, stop):
+        if counters[0] + n_markets > len(trades):
+            return i
+
+        previous_capital = capital[i - 1]
+
+        # mark to market with the units held since the previous bar
+        total_pnl = 0.0
+        exposure = 0.0
+        for m in range(n_markets):
+            market_pnl = (close[i, m] - close[i - 1, m]) * state[UNITS, m] * leverage * np.sign(state[CAPITAL_IN, m])
+            if np.isnan(market_pnl):
+                market_pnl = 0.0
+            pnl[i, m] = market_pnl
+            total_pnl += market_pnl
+            exposure += abs(state[CAPITAL_IN, m])
+        available_capital[i] = previous_capital - exposure
+
+        # exits
+        total_provisions = 0.0
+        if has_exits:
+            for m in range(n_markets):
+                if state[OPEN_TRADES, m] > 0:
+                    total_provisions += _check_exits(trades, counters, state, m, close[i, m], i, provision,
+                                                     leverage) * provision
+
+        # new positions
+        required_capital = 0.0
+        for m in range(n_markets):
+            required_capital += abs(state[CAPITAL_IN, m] + signals[i, m])
+
+        for m in range(n_markets):
+            proposed = signals[i, m]
+            current = state[CAPITAL_IN, m]
+            if proposed == 0 or np.isnan(proposed):
+                continue
+
+            if required_capital <= previous_capital:
+                total_provisions += abs(proposed) * provision
+                if current == 0 or np.sign(proposed) == np.sign(current):
+                    _open_trade(trades, counters, state, m, proposed, close[i, m], i, -1, provision, exits)
+                elif abs(proposed) > abs(current):
+                    _close_position(trades, counters, state, m, abs(current), close[i, m], i, provision, leverage)
+                    _open_trade(trades, counters, state, m, proposed + current, close[i, m], i, -1, provision, exits)
+                else:
+                    _close_position(trades, counters, state, m, abs(proposed), close[i, m], i, provision, leverage)
+            elif current != 0 and np.sign(proposed) != np.sign(current):
+                # not enough capital, only the reductions of the positions are executed
+                amount = min(abs(proposed), abs(current))
+                total_provisions += amount * provision
+                _close_position(trades, counters, state, m, amount, close[i, m], i, provision, leverage)
+
+        provisions[i] = total_provisions
+        capital[i] = previous_capital - total_provisions + total_pnl
+        for m in range(n_markets):
+            capital_in[i, m] = state[CAPITAL_IN, m]
+            units[i, m] = state[UNITS, m]
+            average_open[i, m] = state[OPEN_NOTIONAL, m] / abs(state[CAPITAL_IN, m]) \
+                if state[CAPITAL_IN, m] != 0 else 0.0
+
+    return stop
+
+
+@jit(nopython=True)
+def _close_all(trades, counters, state, close, bar, leverage):
+    # positions still open at the end are closed at the last close price, without provision
+    for m in range(close.shape[1]):
+        _close_position(trades, counters, state, m, np.inf, close[bar, m], bar, 0.0, leverage)
+
 
 class Strategy:
-    def __init__(self, df, tradable_markets, leverage=1.0, provision=0.0001, starting_capital=10000):
+    def __init__(self, df, tradable_markets, leverage=1.0, provision=0.0001, starting_capital=10000,
+                 take_profit=None, stop_loss=None, trailing_stop_loss=None, time_stop_loss=None):
+        """
+        Parameters:
+            df (pd.DataFrame): Market data with ('Close', market) columns.
+            tradable_markets (str or list): Traded markets.
+            take_profit, stop_loss, trailing_stop_loss (float): Exits as a fraction of the open (best) price, optional.
+            time_stop_loss (int): Maximal number of bars a trade is held, optional.
+        """
         self.trade_counter = 0
         self.leverage = leverage
         self.provision = provision
         self.starting_capital = starting_capital
-        self.tradable_markets = tradable_markets
+        self.tradable_markets = [tradable_markets] if isinstance(tradable_markets, str) else list(tradable_markets)
+        self.currencies = self.tradable_markets
         self.df = df
-        self.trade_history = pd.DataFrame(columns=['Trade_ID',
-                                                   'Parent_ID',
-                                                   'Currency',
-                                                   'Position_Size',
-                                                   'Unit_Size',
-                                                   'Open_Price',
-                                                   'Close_Price',
-                                                   'Open_Date',
-                                                   'Close_Date',
-                                                   'Take_Profit',
-                                                   'Stop_Loss',
-                                                   'Trailing_stop_loss',
-                                                   'Time_stop_loss',
-                                                   'Provisions',
-                                                   'PnL',
-                                                   'Exit Reason'])
-
-    def calculate_new_positions(self, current_index):
+        self.exits = np.array([np.nan if value is None else value
+                               for value in (take_profit, stop_loss, trailing_stop_loss, time_stop_loss)],
+                              dtype=np.float64)
+        self.trades = np.zeros(0, dtype=TRADE_DTYPE)
+        self.available_capital = starting_capital
+        self.capital_in = np.zeros(len(self.tradable_markets))
+
+    def calculate_new_positions(self, df, current_index):
+        """
+        Proposed change of the position (capital, negative - short) of every market at the bar current_index,
+        returns a dictionary {market: change}.
+        """
         raise NotImplementedError("Subclasses should implement this method")
 
-    def backtest(self):
-        current_index = self.df.index[0]
-        self.df['Capital'] = 0
-        self.df.loc[current_index, 'Capital'] = self.starting_capital
-        self.df['Available_Capital'] = 0
-        self.df.loc[current_index, 'Available_Capital'] = self.starting_capital
-        self.df['Margin'] = 1
-        self.df['Provisions'] = 0
-
-        for market in self.tradable_markets:
-            self.df[('Position_proposition', currency)] = 0
-            self.df[('Capital_in', currency)] = 0
-            self.df[('Average_Open_Position', currency)] = 0
-            self.df[('Unit_size'), currency] = 0
-            self.df[('PnL', currency)] = 0
-
-        for i in tqdm(range(1, len(df))):
-            previous_index = current_index
-            current_index = df.index[i]
-
-            capital_in_previous = df.loc[previous_index, ('Capital_in', self.currencies)]
-            df.loc[current_index, 'Available_Capital'] = df.loc[previous_index, 'Capital'][0] - abs(
-                capital_in_previous).sum()
-
-            new_positions = self.calculate_new_positions(df, current_index)
-
-            ordered_positions = [new_positions.get(currency, 0) for currency in self.currencies]
-            df.loc[current_index, ('Position_proposition', self.currencies)] = ordered_positions
-
-            new_positions_series = pd.Series(new_positions).reindex(capital_in_previous.index.get_level_values(1))
-            required_capital_series = abs(new_positions_series + capital_in_previous)
-            total_required_capital = required_capital_series.sum()
-
-            new_provisions_series = pd.Series(new_positions).reindex(capital_in_previous.index.get_level_values(1))
-            provisions_series = abs(new_provisions_series) * self.provision
-            total_provisions = provisions_series.sum()
-
-            current_close_prices = df.loc[current_index, ('Close', self.currencies)]
-            previous_close_prices = df.loc[previous_index, ('Close', self.currencies)]
-            current_units = df.loc[previous_index, ('Unit_size', self.currencies)]
-
-            average_open_position = df.loc[previous_index, ('Average_Open_Position', self.currencies)]
-            df.loc[current_index, ('Average_Open_Position', self.currencies)] = average_open_position
-
-            current_returns = (current_close_prices.reset_index(drop=True) - previous_close_prices.reset_index(drop=True))
-            current_capital_in = df.loc[previous_index, ('Capital_in', self.currencies)].reset_index(drop=True)
-            current_capital_in.index = current_units.index
-            current_returns.index = current_units.index
-
-            PnL_series = (current_returns * current_units * self.leverage).fillna(0) * np.sign(current_capital_in)
-            total_PnL = PnL_series.loc['Unit_size'].sum()
-
-            df.loc[current_index, ('PnL', self.currencies)] = PnL_series.loc['Unit_size'].values
-            df.loc[current_index, ('Capital_in', self.currencies)] = df.loc[previous_index, ('Capital_in', self.currencies)]
-            df.loc[current_index, ('Unit_size', self.currencies)] = df.loc[previous_index, ('Unit_size', self.currencies)]
-
-            if total_required_capital <= df.loc[previous_index, 'Capital'][0]:
-                df.loc[current_index, 'Provisions'] = total_provisions
-
-                # editing position log
-                for currency in self.currencies:
-                    proposed_position = df.loc[current_index, ('Position_proposition', currency)]
-                    current_position = df.loc[previous_index, ('Capital_in', currency)]
-
-                    # If there's a change in position
-                    if proposed_position != 0:
-                        if np.sign(proposed_position) == np.sign(current_position) or current_position == 0:
-                            self.record_trade(currency, proposed_position, current_index, df)
-                            df.loc[current_index, ('Average_Open_Position', currency)] = (df.loc[previous_index, ('Average_Open_Position', currency)] * abs(current_position) + abs(proposed_position) * current_close_prices['Close', currency]) / (abs(current_position) + abs(proposed_position))
-                            df.loc[current_index, ('Unit_size', currency)] = current_units['Unit_size', currency] + abs(proposed_position) / current_close_prices['Close', currency]
-                        elif np.sign(proposed_position) != np.sign(current_position) and abs(proposed_position) > abs(
-                                current_position):
-                            self.close_trade(currency, current_position, current_index, df)
-                            self.record_trade(currency, proposed_position + current_position, current_index, df)
-                            df.loc[current_index, ('Average_Open_Position', currency)] = current_close_prices['Close', currency]
-                            df.loc[current_index, ('Unit_size', currency)] = abs(proposed_position + current_position) / current_close_prices['Close', currency]
-                        else:
-                            self.close_trade(currency, proposed_position, current_index, df)
-
-                df.loc[current_index, ('Capital_in', self.currencies)] = new_positions_series + capital_in_previous
-
-
-            else:
-                net_change_positions = abs(capital_in_previous + new_positions_series) - abs(capital_in_previous)
-                net_change_positions_flat = net_change_positions.reset_index(level=0, drop=True)
-                net_change_positions_flat = net_change_positions_flat.reindex(new_positions_series.index)
-
-                closing_positions = new_positions_series.where(net_change_positions_flat < 0, 0)
-                smaller_abs_values = pd.Series(
-                    np.minimum(np.abs(closing_positions.values), np.abs(capital_in_previous.values)),
-                    index=closing_positions.index) * np.sign(new_positions_series)
-
-                total_closing_capital = abs(smaller_abs_values).sum()
-
-                if total_closing_capital > 0:
-                    total_provisions = abs(closing_positions).sum() * self.provision
-                    df.loc[current_index, 'Provisions'] = total_provisions
-
-                    for currency in self.currencies:
-                        closing = closing_positions[currency]
-                        if closing != 0:
-                            self.close_trade(currency, closing, current_index, df)
-                else:
-                    total_provisions = 0
-
-                df.loc[current_index, ('Capital_in', self.currencies)] = capital_in_previous + smaller_abs_values
-
-            df.loc[current_index, 'Capital'] = df.loc[previous_index, 'Capital'][0] - total_provisions + total_PnL
-
-        for currency in self.currencies:
-            end_closing = df.loc[current_index, ('Capital_in', currency)]
-            if end_closing != 0:
-                self.close_trade(currency, end_closing, current_index, df)
-
-        return df
-
-    def record_trade(self, currency, position, current_index, df, parent_id=None):
-        open_price = df.loc[current_index, ('Close', currency)]
-        open_date = current_index
-
-        self.trade_counter += 1
-        trade_id = self.trade_counter
-
-        if parent_id is None:
-            parent_id = trade_id
-
-        trade_info = {
-            'Trade_ID': trade_id,
-            'Parent_ID': parent_id,  # Add the unique trade ID here
-            'Currency': currency,
-            'Position_Size': position,
-            'Unit_Size': abs(position) / open_price,
-            'Open_Price': open_price,
-            'Close_Price': None,  # to be filled when the position is closed
-            'Open_Date': open_date,
-            'Close_Date': None,  # to be filled when the position is closed
-            'PnL': None,  # to be filled when the position is closed
-            'Exit Reason': 'New Position',  # Exit Reason for the trade (open/close/etc.)
-            'Status': 'open'  # we need to track the status of each trade
-        }
-
-        # Append the trade to the history DataFrame
-        self.trade_history = pd.concat([self.trade_history, pd.DataFrame([trade_info])], ignore_index=True)
-
-
-    def close_trade(self, currency, proposed_position, current_index, df):
-        # Find all open trades for the given currency
-        open_trades = self.trade_history[
-            (self.trade_history['Currency'] == currency) &
-            (self.trade_history['Status'] == 'open')]
-
-        open_trades = open_trades.sort_values(by=['Open_Date'], ascending=True)
-
-        if not open_trades.empty:
-            remaining_position_to_close = proposed_position
-
-            open_trades_sum = open_trades['Position_Size'].sum()
-            current_capital_in = df.loc[current_index, ('Capital_in', currency)]
-            current_unit_size = df.loc[current_index, ('Unit_size', currency)]
-
-            if current_capital_in != open_trades_sum:
-                print(f"Current capital: {current_capital_in}, Open trades sum: {open_trades_sum}")
-                print('wrong')
-
-            # Update each open trade
-            for index, trade in open_trades.iterrows():
-                current_position_size = trade['Position_Size']
-
-                # If the remaining position to close is zero, we stop processing
-                if remaining_position_to_close == 0:
-                    break
-
-                # Determine the size of the position we are going to close
-                position_to_close = min(abs(current_position_size), abs(remaining_position_to_close)) * np.sign(current_position_size)
-
-                # Adjust the remaining position size to close
-                remaining_position_to_close += position_to_close
-
-                # Update the record in the trade history
-                close_price = df.loc[current_index, ('Close', currency)]
-                pnl = position_to_close / trade['Open_Price'] * (close_price - trade['Open_Price']) * self.leverage
-
-                average_open_position = df.loc[current_index, ('Average_Open_Position', currency)]
-
-                if position_to_close == current_position_size:
-                    # If we're closing the entire position, update the status to 'closed'
-                    self.trade_history.at[index, 'Status'] = 'closed'
-                    self.trade_history.at[index, 'Close_Price'] = close_price
-                    self.trade_history.at[index, 'Close_Date'] = current_index
-                    self.trade_history.at[index, 'PnL'] = pnl
-                    self.trade_history.at[index, 'Exit Reason'] = 'Close Position'
-
-                    # add editing average open position
-                    current_capital_in -= position_to_close
-                    current_unit_size -= abs(position_to_close) / trade['Open_Price']
-                    if current_capital_in == 0:
-                        df.loc[current_index, ('Average_Open_Position', currency)] = 0
-                        df.loc[current_index, ('Unit_size', currency)] = 0
-                    else:
-                        df.loc[current_index, ('Average_Open_Position', currency)] = (average_open_position * (abs(current_capital_in) + abs(position_to_close)) - abs(position_to_close) *self.trade_history.at[index, 'Open_Price']) / abs(current_capital_in)
-                        df.loc[current_index, ('Unit_size', currency)] = current_unit_size
-
-                else:
-                    # We're partially closing the position, so we need to update the position size
-                    # Create a new record for the remaining position
-                    remaining_position = current_position_size - position_to_close
-                    new_trade_record = trade.copy()
-                    new_trade_record['Position_Size'] = remaining_position
-                    new_trade_record['Unit_Size'] = abs(remaining_position) / trade['Open_Price']
-                    new_trade_record['Trade_ID'] = self.trade_counter + 1  # unique new ID
-                    self.trade_counter += 1
-
-                    # Update the original record to reflect the partial close
-                    self.trade_history.at[index, 'Status'] = 'closed'
-                    self.trade_history.at[index, 'Position_Size'] = position_to_close
-                    self.trade_history.at[index, 'Unit_Size'] = abs(position_to_close) / trade['Open_Price']
-                    self.trade_history.at[index, 'Close_Price'] = close_price
-                    self.trade_history.at[index, 'Close_Date'] = current_index
-                    self.trade_history.at[index, 'PnL'] = pnl
-                    self.trade_history.at[index, 'Exit Reason'] = 'Partial Close'
-
-                    # Add the new record for the remaining open position to the history
-                    self.trade_history = pd.concat([self.trade_history, pd.DataFrame([new_trade_record])],ignore_index=True)
-
-                    current_capital_in -= position_to_close
-                    current_unit_size -= abs(position_to_close) / trade['Open_Price']
-
-                    if current_capital_in == 0:
-                        print('dupa')
-
-                    # add editing average open position
-                    df.loc[current_index, ('Average_Open_Position', currency)] = (average_open_position * (abs(current_capital_in) + abs(position_to_close)) - abs(position_to_close) *self.trade_history.at[index, 'Open_Price']) / abs(current_capital_in)
-                    df.loc[current_index, ('Unit_size', currency)] = current_unit_size
+    def calculate_position_signals(self, df):
+        """
+        Optional vectorized hook, (bars, markets) array of the proposed changes of the positions for strategies that do
+        not depend on the account state. None - calculate_new_positions is called for every bar.
+        """
+        return None
+
+    def backtest(self, df=None):
+        df = self.df if df is None else df
+        n_bars, n_markets = len(df), len(self.tradable_markets)
+        close = np.ascontiguousarray(df.loc[:, [('Close', market) for market in self.tradable_markets]].to_numpy(
+            dtype=np.float64))
+
+        capital = np.zeros(n_bars)
+        available_capital = np.zeros(n_bars)
+        provisions = np.zeros(n_bars)
+        capital_in, average_open, units, pnl = (np.zeros((n_bars, n_markets)) for _ in range(4))
+        capital[0] = available_capital[0] = self.starting_capital
+        state = np.zeros((5, n_markets))
+        counters = np.zeros(2, dtype=np.int64)  # trades in the log, last trade id
+        trades = np.zeros(max(1024, 4 * n_markets), dtype=TRADE_DTYPE)
+
+        signals = self.calculate_position_signals(df)
+        vectorized = signals is not None
+        if vectorized:
+            signals = np.ascontiguousarray(np.asarray(signals, dtype=np.float64).reshape(n_bars, n_markets))
+        else:
+            signals = np.zeros((n_bars, n_markets))
+
+        i = 1
+        progress = None if vectorized else tqdm(total=n_bars - 1)
+        while i < n_bars:
+            if not vectorized:
+                self.available_capital = capital[i - 1] - np.abs(state[CAPITAL_IN]).sum()
+                self.capital_in = state[CAPITAL_IN].copy()
+                new_positions = self.calculate_new_positions(df, df.index[i])
+                signals[i] = [new_positions.get(market, 0) for market in self.tradable_markets]
+
+            stop = n_bars if vectorized else i + 1
+            next_bar = _process_bars(close, signals, i, stop, trades, counters, state, capital, available_capital,
+                                     provisions, capital_in, average_open, units, pnl, self.leverage, self.provision,
+                                     self.exits)
+            if next_bar < stop:
+                trades = np.concatenate((trades, np.zeros(len(trades), dtype=TRADE_DTYPE)))  # trade log is full
+            elif progress is not None:
+                progress.update(next_bar - i)
+            i = next_bar
+        if progress is not None:
+            progress.close()
+
+        _close_all(trades, counters, state, close, n_bars - 1, self.leverage)
+
+        self.trades = trades[:counters[0]]
+        self.trade_counter = int(counters[1])
+        self.index = df.index
+
+        # account state as columns of the data frame, added at once
+        columns = {('Capital', ''): capital, ('Available_Capital', ''): available_capital,
+                   ('Margin', ''): np.ones(n_bars), ('Provisions', ''): provisions}
+        for name, values in (('Position_proposition', signals), ('Capital_in', capital_in),
+                             ('Average_Open_Position', average_open), ('Unit_size', units), ('PnL', pnl)):
+            for m, market in enumerate(self.tradable_markets):
+                columns[(name, market)] = values[:, m]
+        results = pd.DataFrame(columns, index=df.index)
+        if df.columns.nlevels == 1:
+            results.columns = [name if market == '' else (name, market) for name, market in results.columns]
+
+        self.df = pd.concat([df.drop(columns=[column for column in results.columns if column in df.columns]),
+                             results], axis=1)
+        return self.df
+
+    @property
+    def trade_history(self):
+        """
+        Trade log as a DataFrame, with market names, dates and exit reasons.
+        """
+        trades = self.trades
+        index = getattr(self, 'index', None)
+        dates = (lambda bars: bars) if index is None else (lambda bars: index[bars])
+
+        history = pd.DataFrame({
+            'Trade_ID': trades['Trade_ID'],
+            'Parent_ID': trades['Parent_ID'],
+            'Currency': np.array(self.tradable_markets, dtype=object)[trades['Currency']],
+            'Position_Size': trades['Position_Size'],
+            'Unit_Size': trades['Unit_Size'],
+            'Open_Price': trades['Open_Price'],
+            'Close_Price': trades['Close_Price'],
+            'Open_Date': dates(trades['Open_Date']),
+            'Close_Date': dates(trades['Close_Date']),
+            'Take_Profit': trades['Take_Profit'],
+            'Stop_Loss': trades['Stop_Loss'],
+            'Trailing_stop_loss': trades['Trailing_stop_loss'],
+            'Time_stop_loss': trades['Time_stop_loss'],
+            'Provisions': trades['Provisions'],
+            'PnL': trades['PnL'],
+            'Exit Reason': np.array(EXIT_REASONS, dtype=object)[trades['Exit_Reason']],
+            'Status': np.where(trades['Status'] == OPEN, 'open', 'closed'),
+        })
+        return history.sort_values(['Open_Date', 'Trade_ID'], kind='stable').reset_index(drop=True)
+
+    @staticmethod
+    def _series(df, name):
+        column = df[name]
+        return column.iloc[:, 0] if isinstance(column, pd.DataFrame) else column
 
     def calculate_sortino_ratio(self, df, target_return=0):
         # Total returns are the increases in capital over time
-        total_returns = df['Capital'].pct_change().fillna(0)
+        total_returns = self._series(df, 'Capital').pct_change().fillna(0)
 
         # Downside deviation
         negative_returns = total_returns[total_returns < target_return]
@@ -287,7 +435,7 @@ class Strategy:
         return sortino_ratio
 
     def calculate_max_drawdown(self, df):
-        capital = df['Capital']
+        capital = self._series(df, 'Capital')
         peak = capital.expanding(min_periods=1).max()
         drawdown = (capital - peak) / peak
 
@@ -310,12 +458,13 @@ class Strategy:
             report['Start Date'] = df.index[0]
             report['End Date'] = df.index[-1]
             report['Total PnL'] = df['PnL'].sum().sum()
-            report['Total Return'] = df['Capital'].iloc[-1] / df['Capital'].iloc[0] - 1
-            report['Total Provisions'] = df['Provisions'].sum().sum()
+            capital = self._series(df, 'Capital')
+            report['Total Return'] = capital.iloc[-1] / capital.iloc[0] - 1
+            report['Total Provisions'] = self._series(df, 'Provisions').sum()
             report['Sortino Ratio'] = self.calculate_sortino_ratio(df)
             report['Sharpe Ratio'] = total_pnl.mean() / total_pnl.std() if total_pnl.std() != 0 else 0
             report['Max Drawdown'] = self.calculate_max_drawdown(df)
-            report['Max Drawdown Duration'] = df['Capital'].idxmin() - df['Capital'].idxmax()
+            report['Max Drawdown Duration'] = capital.idxmin() - capital.idxmax()
             report['Total Trades'] = total_trades
             report['Winning Trades'] = winning_trades
             report['Losing Trades'] = losing_trades
@@ -366,8 +515,8 @@ class Strategy:
                 total_pnl_before_provision = df_currency_log['PnL'].sum()
 
                 # Ensure the provision column exists, if not consider it as 0.
-                if 'Provision' in df_currency_log.columns:
-                    total_provision_for_currency = df_currency_log['Provision'].sum()
+                if 'Provisions' in df_currency_log.columns:
+                    total_provision_for_currency = df_currency_log['Provisions'].sum()
                 else:
                     total_provision_for_currency = 0
 
@@ -5,12 +5,14 @@ import time
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from tqdm import tqdm
 import random
 import math
 import gym
 from gym import spaces
 
+from backtest.backtest_functions.batched_backtest import build_observations, EDIT_CODES
+from data.function.market_frame import MarketFrame
+
 class BacktestShort:
     def __init__(self, df, look_back=20, variables=None, current_positions=True, tradable_markets='EURUSD',
                  provision=0.0001, agent=None, initial_balance=10000, environment=None):
@@ -36,113 +38,100 @@ class BacktestShort:
 
         self.reset()
 
-    def backtest_short(self):
-        self.df[('Capital_in', self.tradable_markets)] = 0.0
-        self.df[('Capital', 'Strategy')] = 0.0
-        self.df[('PnL', self.tradable_markets)] = 0.0
-        self.df[('Provision', self.tradable_markets)] = 0.0
-        self.df.loc[self.df.index[self.look_back - 1], ('Capital_in', self.tradable_markets)] = self.initial_balance
-        self.df.loc[self.df.index[self.look_back - 1], ('Capital', 'Strategy')] = self.initial_balance
-        self.df.loc[self.df.index[self.look_back - 1], ('PnL', self.tradable_markets)] = 0.0
-        self.df.loc[self.df.index[self.look_back - 1], ('Provision', self.tradable_markets)] = 0.0
-        self.df.loc[self.df.index[self.look_back - 1], ('Action', self.tradable_markets)] = 0
-
-        for obs in tqdm(range(len(self.df) - self.look_back)):
-            observation = self.environment.reset(obs)
-            print(f"Shape of observation in backtest_short: {observation.shape}")
-            if obs == 399:
-                print(f"Observation in backtest_short: {observation}")
-            action = self.agent.choose_best_action(observation)
-            self.df.loc[self.df.index[obs + self.look_back], ('Action', self.tradable_markets)] = action - 1
-            self.df.loc[self.df.index[obs + self.look_back], ('PnL', self.tradable_markets)] = self.df.loc[
-                                                                                                   self.df.index[
-                                                                                                       obs + self.look_back - 1], (
-                                                                                                   'Action',
-                                                                                                   self.tradable_markets)] * \
-                                                                                               self.df.loc[
-                                                                                                   self.df.index[
-                                                                                                       obs + self.look_back - 1], (
-                                                                                                   'Capital_in',
-                                                                                                   self.tradable_markets)] * (
-                                                                                                           self.df.loc[
-                                                                                                               self.df.index[
-                                                                                                                   obs + self.look_back], (
-                                                                                                               'Close',
-                                                                                                               self.tradable_markets)] /
-                                                                                                           self.df.loc[
-                                                                                                               self.df.index[
-                                                                                                                   obs + self.look_back - 1], (
-                                                                                                               'Close',
-                                                                                                               self.tradable_markets)] - 1) - \
-                                                                                               self.df.loc[
-                                                                                                   self.df.index[
-                                                                                                       obs + self.look_back], (
-                                                                                                   'Provision',
-                                                                                                   self.tradable_markets)]
-            self.df.loc[self.df.index[obs + self.look_back], ('Capital', 'Strategy')] = self.df.loc[self.df.index[
-                obs + self.look_back - 1], ('Capital', 'Strategy')] + self.df.loc[self.df.index[obs + self.look_back], (
-            'PnL', self.tradable_markets)]
-
-            if self.df.loc[self.df.index[obs + self.look_back], ('Action', self.tradable_markets)] == self.df.loc[
-                self.df.index[obs + self.look_back - 1], ('Action', self.tradable_markets)]:
-                self.df.loc[self.df.index[obs + self.look_back], ('Capital_in', self.tradable_markets)] = self.df.loc[
-                    self.df.index[obs + self.look_back - 1], ('Capital_in', self.tradable_markets)]
-
-            else:
-                if self.df.loc[self.df.index[obs + self.look_back], ('Action', self.tradable_markets)] == 0:
-                    self.df.loc[self.df.index[obs + self.look_back], ('Capital_in', self.tradable_markets)] = 0
-                    self.df.loc[self.df.index[obs + self.look_back], ('Provision', self.tradable_markets)] = \
-                    self.df.loc[
-                        self.df.index[obs + self.look_back - 1], ('Capital_in', self.tradable_markets)] * self.provision
-                    self.df.loc[self.df.index[obs + self.look_back], ('Capital', 'Strategy')] = self.df.loc[
-                                                                                                    self.df.index[
-                                                                                                        obs + self.look_back], (
-                                                                                                    'Capital',
-                                                                                                    'Strategy')] - \
-                                                                                                self.df.loc[
-                                                                                                    self.df.index[
-                                                                                                        obs + self.look_back], (
-                                                                                                    'Provision',
-                                                                                                    self.tradable_markets)]
-
+    def predict_actions(self, batch_size=4096):
+        """
+        Actions (-1, 0, 1) of every bar from look_back on. Agents implementing get_action_probabilities_batch are
+        evaluated in batched forward passes on the observations of all bars (the environment is reset for every bar,
+        so the current position in the observation is always neutral), other agents step through environment.reset.
+        """
+        n_steps = len(self.df) - self.look_back
+        if hasattr(self.agent, 'get_action_probabilities_batch') and self.variables is not None:
+            market_frame = MarketFrame.from_dataframe(self.df)
+            values = np.asfortranarray(market_frame.values[:, market_frame.column_numbers(
+                [variable['variable'] for variable in self.variables])])
+            edit_codes = np.array([EDIT_CODES.get(variable['edit'], 0) for variable in self.variables], dtype=np.int64)
+            observations = build_observations(values, edit_codes, self.look_back, n_steps)
+            probabilities = np.concatenate([
+                self.agent.get_action_probabilities_batch(observations[start:start + batch_size],
+                                                          np.zeros(len(observations[start:start + batch_size])))
+                for start in range(0, n_steps, batch_size)])
+            return np.argmax(probabilities, axis=1) - 1
+
+        return np.array([self.agent.choose_best_action(self.environment.reset(obs)) for obs in range(n_steps)]) - 1
+
+    def backtest_short(self, actions=None):
+        """
+        Backtest of the actions (-1, 0, 1) taken from bar look_back on, predicted by the agent if not given.
+        The capital is reinvested at every change of the position, the PnL and the capital of the bars are computed
+        with array operations, only the capital at the changes of the position is carried over in a loop.
+        """
+        if actions is None:
+            actions = self.predict_actions()
+        first = self.look_back - 1
+        close = self.df[('Close', self.tradable_markets)].to_numpy(dtype=np.float64)[first:]
+
+        # bar first is the starting state (neutral, whole balance as capital in), the actions follow
+        action = np.concatenate(([0.0], np.asarray(actions, dtype=np.float64)))
+        returns = np.zeros(len(close))
+        returns[1:] = close[1:] / close[:-1] - 1
+
+        changes = np.flatnonzero(action[1:] != action[:-1]) + 1
+        segment_starts = np.concatenate(([0], changes))
+        segment_ends = np.concatenate((changes, [len(close)]))
+
+        capital_in = np.empty(len(close))
+        capital = np.empty(len(close))
+        pnl = np.zeros(len(close))
+        provision = np.zeros(len(close))
+        capital_in_start, capital_start, previous_capital_in = float(self.initial_balance), \
+            float(self.initial_balance), float(self.initial_balance)
+
+        for start, end in zip(segment_starts, segment_ends):
+            if start > 0:
+                # change of the position, PnL of the previous position then the provision of the change
+                pnl[start] = action[start - 1] * previous_capital_in * returns[start]
+                capital_before_provision = capital[start - 1] + pnl[start]
+                if action[start] == 0:
+                    capital_in_start = 0.0
+                    provision[start] = previous_capital_in * self.provision
                 else:
-                    self.df.loc[self.df.index[obs + self.look_back], ('Capital_in', self.tradable_markets)] = \
-                    self.df.loc[self.df.index[obs + self.look_back], ('Capital', 'Strategy')]
-                    self.df.loc[self.df.index[obs + self.look_back], ('Provision', self.tradable_markets)] = \
-                    self.df.loc[self.df.index[obs + self.look_back - 1], (
-                    'Capital_in', self.tradable_markets)] * self.provision * abs(
-                        self.df.loc[self.df.index[obs + self.look_back], ('Action', self.tradable_markets)] -
-                        self.df.loc[self.df.index[obs + self.look_back - 1], ('Action', self.tradable_markets)])
-                    self.df.loc[self.df.index[obs + self.look_back], ('Capital', 'Strategy')] = self.df.loc[
-                                                                                                    self.df.index[
-                                                                                                        obs + self.look_back], (
-                                                                                                    'Capital',
-                                                                                                    'Strategy')] - \
-                                                                                                self.df.loc[
-                                                                                                    self.df.index[
-                                                                                                        obs + self.look_back], (
-                                                                                                    'Provision',
-                                                                                                    self.tradable_markets)]
+                    capital_in_start = capital_before_provision
+                    provision[start] = previous_capital_in * self.provision * abs(action[start] - action[start - 1])
+                capital_start = capital_before_provision - provision[start]
+
+            pnl[start + 1:end] = action[start] * capital_in_start * returns[start + 1:end]
+            capital[start] = capital_start
+            capital[start + 1:end] = np.cumsum(np.concatenate(([capital_start], pnl[start + 1:end])))[1:]
+            capital_in[start:end] = capital_in_start
+            previous_capital_in = capital_in_start
+
+        # the bars before look_back - 1 are empty, like the columns initialized before the backtest
+        def column(values, fill=0.0):
+            return np.concatenate((np.full(first, fill), values))
+
+        self.df[('Capital_in', self.tradable_markets)] = column(capital_in)
+        self.df[('Capital', 'Strategy')] = column(capital)
+        self.df[('PnL', self.tradable_markets)] = column(pnl)
+        self.df[('Provision', self.tradable_markets)] = column(provision)
+        self.df[('Action', self.tradable_markets)] = column(action, np.nan)
         return self.df
 
     def calculate_trade_outcomes(self, actions, pnl):
-        trade_outcomes = []
-        current_trade_pnl = 0
-        previous_action = None
-
-        for action, pnl_value in zip(actions, pnl):
-            if action != previous_action and action != 0:
-                if previous_action is not None:  # End of a trade
-                    trade_outcomes.append(current_trade_pnl)
-                    current_trade_pnl = 0
-            current_trade_pnl += pnl_value
-            previous_action = action
-
-        # Add the last trade if it's still open
-        if current_trade_pnl != 0:
-            trade_outcomes.append(current_trade_pnl)
-
-        return trade_outcomes
+        """
+        Summed PnL of every trade, a trade starts at every change to a non-neutral action.
+        """
+        actions = np.asarray(actions, dtype=np.float64)
+        pnl = np.asarray(pnl, dtype=np.float64)
+        if len(actions) == 0:
+            return []
+
+        starts = np.concatenate(([0], np.flatnonzero((actions[1:] != actions[:-1]) & (actions[1:] != 0)) + 1))
+        trade_outcomes = np.add.reduceat(pnl, starts)
+
+        # the last trade is added if it's still open
+        if trade_outcomes[-1] == 0:
+            trade_outcomes = trade_outcomes[:-1]
+        return trade_outcomes.tolist()
 
     def report_short(self):
         report = {}
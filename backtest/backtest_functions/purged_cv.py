@@ -0,0 +1,247 @@
+"""
+Purged, embargoed k-fold and combinatorial purged cross-validation
+
+The rows of the dataset are cut into contiguous groups. A split tests one (k-fold) or several (combinatorial purged
+CV) groups and trains on the rest, without the rows next to the test groups whose information overlaps them:
+- purge: the rows before a test group (by default its look_back observation history)
+- embargo: the rows after a test group (serial correlation of the features with the end of the test period)
+The plans are integer [start, stop) row ranges as the split plans of functions/walk_forward.py. Combinatorial purged
+CV tests every group in several splits, their test groups form the backtest paths (cpcv_paths, stitch_cv_path).
+
+run_purged_cv trains and evaluates the splits in parallel processes. The dataset and its observations (built once
+for all rows with the observation builder of the batched backtest engine, the observation of a step only depends on
+its look_back rows) are shared read-only in shared memory, the test groups are evaluated with the batched backtest
+engine on slices of the shared observations.
+"""
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from backtest.backtest_functions.batched_backtest import EDIT_CODES, build_observations, \
+    enumerate_position_probabilities, greedy_position_walk, report_negative_balances
+from backtest.backtest_functions.kpi import calculate_kpis, kpis_to_dict
+from data.function.prefetch import SharedFrames
+
+
+def group_bounds(n_rows, n_groups):
+    """
+    [start, stop) rows of n_groups contiguous groups of (almost) equal size.
+    """
+    if not 1 < n_groups <= n_rows:
+        raise ValueError(f'{n_groups} groups for {n_rows} rows')
+    edges = np.linspace(0, n_rows, n_groups + 1).astype(np.int64)
+    return np.stack([edges[:-1], edges[1:]], axis=1)
+
+
+def _train_ranges(n_rows, test_ranges, purge, embargo, min_train_rows):
+    excluded = np.zeros(n_rows + 1, dtype=np.int64)
+    for start, stop in test_ranges:
+        excluded[max(0, start - purge)] += 1
+        excluded[min(n_rows, stop + embargo)] -= 1
+    kept = np.cumsum(excluded[:-1]) == 0
+
+    # [start, stop) of the runs of kept rows
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], kept.astype(np.int8), [0]))))
+    ranges = edges.reshape(-1, 2)
+    return ranges[ranges[:, 1] - ranges[:, 0] >= min_train_rows]
+
+
+def _as_rows(data):
+    return int(data) if isinstance(data, (int, np.integer)) else len(data)
+
+
+def combinatorial_purged_plan(data, n_groups, n_test_groups=2, look_back=0, purge=None, embargo=0.01,
+                              min_train_rows=None):
+    """
+    Splits of combinatorial purged CV, every combination of n_test_groups of the n_groups groups is tested once.
+
+    Parameters:
+        data (int, pd.DataFrame, pd.Index or MarketFrame): The dataset or its number of rows.
+        n_groups (int): Number of contiguous groups.
+        n_test_groups (int): Test groups per split, 1 is the purged k-fold.
+        look_back (int): The look-back period of the observations.
+        purge (int): Rows before every test group left out of the training, look_back by default.
+        embargo (int or float): Rows after every test group left out of the training, a float as a fraction of the
+            rows.
+        min_train_rows (int): Shorter training segments are dropped, look_back + 2 by default (one step).
+
+    Returns:
+        list: One dict per split with 'groups' (the test groups), 'test' and 'train' (int64 (segments, 2) arrays of
+        [start, stop) rows).
+    """
+    n_rows = _as_rows(data)
+    purge = look_back if purge is None else purge
+    embargo = int(np.ceil(embargo * n_rows)) if isinstance(embargo, float) else int(embargo)
+    min_train_rows = look_back + 2 if min_train_rows is None else min_train_rows
+    if not 0 < n_test_groups < n_groups:
+        raise ValueError(f'{n_test_groups} test groups of {n_groups} groups')
+
+    bounds = group_bounds(n_rows, n_groups)
+    plan = []
+    for groups in itertools.combinations(range(n_groups), n_test_groups):
+        test = bounds[list(groups)]
+        plan.append({'groups': groups, 'test': test,
+                     'train': _train_ranges(n_rows, test, purge, embargo, min_train_rows)})
+    return plan
+
+
+def purged_kfold_plan(data, n_splits=5, look_back=0, purge=None, embargo=0.01, min_train_rows=None):
+    """
+    Splits of the purged, embargoed k-fold, every group of n_splits is tested once (see combinatorial_purged_plan).
+    """
+    return combinatorial_purged_plan(data, n_splits, 1, look_back, purge, embargo, min_train_rows)
+
+
+def cpcv_paths(plan):
+    """
+    Backtest paths of a (combinatorial) purged plan, every path tests each group once.
+
+    Returns:
+        list: One list per path of (split, group) in the order of the groups.
+    """
+    testing = {}
+    for split, fold in enumerate(plan):
+        for group in fold['groups']:
+            testing.setdefault(group, []).append(split)
+    n_paths = min(len(splits) for splits in testing.values())
+    return [[(testing[group][path], group) for group in sorted(testing)] for path in range(n_paths)]
+
+
+def stitch_cv_path(split_results, path, starting_balance=10000, annualization_factor=365):
+    """
+    Chains the test groups of a path, as if every group started with the final balance of the previous one (the
+    balance accounting is linear in the starting balance, as in stitch_walk_forward).
+
+    Parameters:
+        split_results (dict): Split -> result of run_purged_cv.
+        path (list): (split, group) of the path, see cpcv_paths.
+
+    Returns:
+        dict: 'balances', 'actions' and 'provision_sum' of the path and its KPIs ('kpis').
+    """
+    balances, actions, provision_sum, balance = [], [], 0.0, starting_balance
+    for split, group in path:
+        result = split_results[split]['groups'][group]
+        scale = balance / result['starting_balance']
+        balances.append(result['balances'] * scale)
+        actions.append(result['actions'])
+        provision_sum += result['provision_sum'] * scale
+        if len(result['balances']):
+            balance = balances[-1][-1]
+
+    balances, actions = np.concatenate(balances), np.concatenate(actions)
+    kpis = kpis_to_dict(calculate_kpis(balances, actions, starting_balance, annualization_factor))
+    return {'balances': balances, 'actions': actions, 'provision_sum': provision_sum, 'kpis': kpis}
+
+
+_cv_data = None  # the shared dataset, observations and settings in the worker processes
+
+
+def _attach_cv_data(shared_data, settings):
+    import numba
+    import torch
+
+    global _cv_data
+    torch.set_num_threads(settings['threads'])
+    numba.set_num_threads(min(settings['threads'], numba.config.NUMBA_NUM_THREADS))
+    frames = shared_data.load(read_only=True)
+    close_prices = np.ascontiguousarray(frames['data'][('Close', settings['mkf'])], dtype=np.float64)
+    _cv_data = (shared_data, frames['data'], frames['observations'].to_numpy(), close_prices, settings)
+
+
+def _evaluate_group(agent, observations, close_prices, start, stop, settings):
+    look_back = settings['look_back']
+    # decisions of the rows [start, stop), the last one closes on the first price of the next group
+    start, stop = max(start, look_back), min(stop, len(close_prices) - 1)
+    probabilities = enumerate_position_probabilities(agent, observations[start - look_back:stop - look_back],
+                                                     settings['batch_size'])
+    walk = greedy_position_walk(probabilities, close_prices[start - look_back:stop + 1], look_back,
+                                settings['provision'], float(settings['starting_balance']), settings['leverage'])
+    actions, balances, balance, num_trades, profitable_trades, provision_sum, negative_balances = walk
+    report_negative_balances(negative_balances)
+    return {'start': start, 'stop': stop, 'actions': actions.astype(np.int8), 'balances': balances,
+            'starting_balance': settings['starting_balance'], 'final_balance': balance, 'num_trades': num_trades,
+            'profitable_trades': profitable_trades, 'provision_sum': provision_sum,
+            'kpis': kpis_to_dict(calculate_kpis(balances, actions, settings['starting_balance'],
+                                                settings['annualization_factor']))}
+
+
+def _run_split(fit_function, fit_kwargs, split, fold):
+    _, df, observations, close_prices, settings = _cv_data
+    train_frames = [df.iloc[start:stop] for start, stop in fold['train']]
+    agent = fit_function(train_frames, **fit_kwargs)
+    groups = {group: _evaluate_group(agent, observations, close_prices, start, stop, settings)
+              for group, (start, stop) in zip(fold['groups'], fold['test'])}
+    return split, {'groups': groups}
+
+
+def iter_purged_cv(df, plan, fit_function, mkf, look_back, variables, provision=0.0001, starting_balance=10000,
+                   leverage=1, fit_kwargs=None, workers=None, threads_per_split=1, batch_size=4096,
+                   annualization_factor=365, mp_context=None):
+    """
+    Trains and evaluates the splits of a purged plan in a process pool, yielding (split, result) in the order of
+    completion (see run_purged_cv).
+    """
+    edit_codes = np.array([EDIT_CODES.get(variable['edit'], 0) for variable in variables], dtype=np.int64)
+    columns = [df.columns.get_loc(variable['variable']) for variable in variables]
+    values = np.asfortranarray(df.iloc[:, columns].to_numpy(dtype=np.float64))
+    n_steps = len(df) - look_back - 1
+    observations = build_observations(values, edit_codes, look_back, n_steps)
+
+    shared_data = SharedFrames.share({
+        'data': df,
+        'observations': pd.DataFrame(observations, index=df.index[look_back:look_back + n_steps]),
+    })
+    settings = {'mkf': mkf, 'look_back': look_back, 'provision': provision, 'starting_balance': starting_balance,
+                'leverage': leverage, 'batch_size': batch_size, 'annualization_factor': annualization_factor,
+                'threads': threads_per_split}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context or multiprocessing.get_context('spawn'),
+                                 initializer=_attach_cv_data, initargs=(shared_data, settings)) as pool:
+            futures = [pool.submit(_run_split, fit_function, fit_kwargs or {}, split, fold)
+                       for split, fold in enumerate(plan)]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        shared_data.unlink()
+
+
+def run_purged_cv(df, plan, fit_function, mkf, look_back, variables, provision=0.0001, starting_balance=10000,
+                  leverage=1, fit_kwargs=None, workers=None, threads_per_split=1, batch_size=4096,
+                  annualization_factor=365, mp_context=None, on_result=None):
+    """
+    Trains an agent on the training segments of every split and backtests it on the test groups, the splits run in
+    parallel processes.
+
+    Parameters:
+        df (pd.DataFrame): The dataset (numeric, with the variables and ('Close', mkf)).
+        plan (list): Splits of purged_kfold_plan / combinatorial_purged_plan.
+        fit_function (function): Module level function fit_function(train_frames, **fit_kwargs) returning an agent
+            with get_action_probabilities_batch, train_frames are the (read-only) training segments as DataFrames.
+        mkf (str): The traded market.
+        look_back (int): The look-back period of the observations.
+        variables (list): The variables of the observations ({'variable': ..., 'edit': ...}).
+        provision, starting_balance, leverage: Settings of the backtests.
+        workers (int): Number of processes, os.cpu_count() by default.
+        threads_per_split (int): torch / numba threads of every process.
+        on_result (function): Called with (split, result) as soon as a split is finished.
+
+    Returns:
+        dict: Split -> {'groups': {group: backtest of the test group (rows, actions, balances, KPIs)}}, in the order
+        of the plan.
+    """
+    results = {}
+    for split, result in iter_purged_cv(df, plan, fit_function, mkf, look_back, variables, provision,
+                                        starting_balance, leverage, fit_kwargs, workers, threads_per_split, batch_size,
+                                        annualization_factor, mp_context):
+        results[split] = result
+        if on_result is not None:
+            on_result(split, result)
+    return dict(sorted(results.items()))
@@ -0,0 +1,196 @@
+"""
+Indexed store of backtest results backed by SQLite
+
+One row per backtest (run, walk-forward step, generation, label, agent type) with the metrics of
+backtest_result_data as columns, written in bulk per walk-forward step. The composite indexes serve the queries of
+the walk-forward loop (best generation of a step, benchmarks of a window) without loading the results of the other
+steps, the window queries (best_per_window) run in SQLite. Replaces prepare_backtest_results and the merges of the
+agent and benchmark DataFrames for the analysis, query and to_parquet return flat DataFrames.
+"""
+import math
+import numbers
+
+import pandas as pd
+from sqlalchemy import (Column, Float, Index, Integer, MetaData, String, Table, create_engine, delete, event, func,
+                        insert, select)
+
+RESULT_METRICS = ('Provision_sum', 'Final Balance', 'Total Reward', 'Number of Trades', 'Sharpe Ratio', 'Max Drawdown',
+                  'Sortino Ratio', 'Calmar Ratio', 'Max Drawdown Duration', 'Average Trade Duration', 'In Long',
+                  'In Short', 'In Out of the Market', 'Win Rate', 'Average Yearly Return', 'Average Yearly std')
+
+metadata = MetaData()
+
+backtest_results_table = Table(
+    'backtest_results', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('run', String, nullable=False),
+    Column('step', Integer, nullable=False),
+    Column('generation', Integer),  # NULL for the benchmark agents
+    Column('label', String, nullable=False),
+    Column('agent_type', String, nullable=False),
+    *(Column(metric, Float) for metric in RESULT_METRICS),
+    Index('ix_backtest_results_run_step_generation', 'run', 'step', 'generation', 'label', 'agent_type'),
+    Index('ix_backtest_results_run_step_agent_type', 'run', 'step', 'agent_type', 'label'),
+)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def _as_float(value):
+    # numpy scalars to float, NaN / inf to NULL (SQLite has no NaN)
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+class BacktestResultsStore:
+    """
+    Backtest results of one or many runs in a SQLite database.
+
+    Usage:
+        results_store = BacktestResultsStore('backtest_results.sqlite', run='PPO_T_20240101_120000')
+        results_store.insert(backtest_results, step=move_forward)
+        best_generation = results_store.best_generation('Sharpe Ratio', step=move_forward, agent_type='PPO')
+    """
+    def __init__(self, path=':memory:', run=None):
+        """
+        Parameters:
+            path (str): The database file, ':memory:' for a database of the process.
+            run (str): The default run of insert and the queries.
+        """
+        self.path = path
+        self.run = run
+        # the walk forward steps of a run write to the same database from their own processes
+        self.engine = create_engine(f'sqlite:///{path}', connect_args={'timeout': 60})
+        event.listen(self.engine, 'connect', _set_sqlite_pragmas)
+        metadata.create_all(self.engine)
+
+    def insert(self, backtest_results, step, run=None, replace_step=False):
+        """
+        Bulk insert of the results of run_backtesting / EvaluationService.
+
+        Parameters:
+            backtest_results (dict): (generation, label) -> list of backtest_result_data dicts.
+            step (int): The walk-forward step.
+            run (str): The run, the default run of the store if None.
+            replace_step (bool): Deletes the rows of the step with the agent types of the results in the same
+                transaction first, a rerun of a step (resume after a crash) replaces its rows instead of duplicating
+                them.
+
+        Returns:
+            int: Number of inserted rows.
+        """
+        run = run or self.run
+        rows = []
+        for (generation, label), results in backtest_results.items():
+            for result in results:
+                row = {'run': run, 'step': step, 'label': label, 'agent_type': result['Agent Type'],
+                       'generation': int(generation) if isinstance(generation, numbers.Integral) else None}
+                row.update({metric: _as_float(result.get(metric, math.nan)) for metric in RESULT_METRICS})
+                rows.append(row)
+
+        if rows:
+            with self.engine.begin() as connection:
+                if replace_step:
+                    table = backtest_results_table.c
+                    agent_types = sorted({row['agent_type'] for row in rows})
+                    connection.execute(delete(backtest_results_table)
+                                       .where(table.run == run, table.step == step, table.agent_type.in_(agent_types)))
+                connection.execute(insert(backtest_results_table), rows)
+        return len(rows)
+
+    def _filters(self, run=None, step=None, agent_type=None, generation=None, label=None, label_prefix=None):
+        table = backtest_results_table.c
+        conditions = []
+        for column, value in ((table.run, run or self.run), (table.step, step), (table.agent_type, agent_type),
+                              (table.generation, generation), (table.label, label)):
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                conditions.append(column.in_(list(value)))
+            else:
+                conditions.append(column == value)
+        if label_prefix is not None:
+            conditions.append(table.label.startswith(label_prefix, autoescape=True))
+        return conditions
+
+    def _read(self, statement):
+        with self.engine.connect() as connection:
+            results = pd.read_sql(statement, connection)
+        # NULL metrics back to NaN, generations of the benchmarks as <NA>
+        metrics = [metric for metric in RESULT_METRICS if metric in results.columns]
+        results[metrics] = results[metrics].astype(float)
+        if 'generation' in results.columns:
+            results['generation'] = results['generation'].astype('Int64')
+        return results.drop(columns='id', errors='ignore')
+
+    def query(self, run=None, step=None, agent_type=None, generation=None, label=None, label_prefix=None,
+              columns=None):
+        """
+        Results matching all given filters (a value or a list of values), ordered by step, generation and label.
+        The run defaults to the run of the store.
+
+        Returns:
+            pd.DataFrame: One row per backtest, the metric columns named as in backtest_result_data.
+        """
+        table = backtest_results_table
+        selected = [table.c[column] for column in columns] if columns else [table]
+        statement = (select(*selected)
+                     .where(*self._filters(run, step, agent_type, generation, label, label_prefix))
+                     .order_by(table.c.run, table.c.step, table.c.generation, table.c.label, table.c.id))
+        return self._read(statement)
+
+    def best_per_window(self, metric='Sharpe Ratio', run=None, step=None, agent_type=None, label_prefix=None,
+                        top=1):
+        """
+        The best generations of every window (run, step, label) by a metric, NULL (NaN) metrics last.
+
+        Returns:
+            pd.DataFrame: top rows per window with their rank.
+        """
+        table = backtest_results_table
+        metric_column = table.c[metric]
+        rank = func.row_number().over(partition_by=(table.c.run, table.c.step, table.c.label),
+                                      order_by=(metric_column.is_(None), metric_column.desc(), table.c.generation))
+        ranked = (select(table, rank.label('rank'))
+                  .where(*self._filters(run, step, agent_type, label_prefix=label_prefix))
+                  .subquery())
+        statement = (select(ranked)
+                     .where(ranked.c.rank <= top)
+                     .order_by(ranked.c.run, ranked.c.step, ranked.c.label, ranked.c.rank))
+        return self._read(statement)
+
+    def best_generation(self, metric='Sharpe Ratio', run=None, step=None, agent_type=None, label_prefix=None):
+        """
+        Generation of the single best backtest by a metric (over all matching windows).
+
+        Returns:
+            int: The generation, None if there is no result with a valid metric.
+        """
+        table = backtest_results_table
+        metric_column = table.c[metric]
+        statement = (select(table.c.generation)
+                     .where(*self._filters(run, step, agent_type, label_prefix=label_prefix),
+                            table.c.generation.is_not(None), metric_column.is_not(None))
+                     .order_by(metric_column.desc(), table.c.generation)
+                     .limit(1))
+        with self.engine.connect() as connection:
+            return connection.execute(statement).scalar()
+
+    def to_parquet(self, path, **filters):
+        """
+        Writes the results matching the filters of query to a Parquet file.
+
+        Returns:
+            pd.DataFrame: The written results.
+        """
+        results = self.query(**filters)
+        results.to_parquet(path, index=False)
+        return results
+
+    def close(self):
+        self.engine.dispose()
@@ -0,0 +1,81 @@
+"""
+Cost and leverage sensitivity of a fixed action trace
+
+The positions taken by an agent do not depend on the provision, leverage or starting balance of the backtest, so the
+policy runs once and the trace is re-walked for a whole grid of settings. The walk (the accounting of
+Trading_Environment_Basic.step, batched_backtest.walk_positions) runs in numba in parallel over the grid, the KPIs
+of all settings are evaluated at once by the KPI engine.
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+from numba import jit, prange
+
+from backtest.backtest_functions.batched_backtest import walk_positions
+from backtest.backtest_functions.kpi import calculate_kpis, KPI_NAMES, as_positions
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def walk_position_grid(close_prices, positions, look_back, provisions, leverages, starting_balances):
+    """
+    Balances of the position trace for every setting of the grid.
+
+    Returns:
+        balances (settings, steps), num_trades, profitable_trades, provision_sum, negative_balances (settings,)
+    """
+    n_settings = len(provisions)
+    balances = np.empty((n_settings, len(positions)))
+    num_trades = np.zeros(n_settings, dtype=np.int64)
+    profitable_trades = np.zeros(n_settings, dtype=np.int64)
+    provision_sums = np.zeros(n_settings)
+    negative_balances = np.zeros(n_settings, dtype=np.int64)
+
+    for g in prange(n_settings):
+        balances[g], _, num_trades[g], profitable_trades[g], provision_sums[g], negative_balances[g] = walk_positions(
+            close_prices, positions, look_back, provisions[g], starting_balances[g], leverages[g])
+
+    return balances, num_trades, profitable_trades, provision_sums, negative_balances
+
+
+def sensitivity_grid(df, actions, mkf, look_back, provisions=(0.0001, 0.001), leverages=(1,),
+                     starting_balances=(10000,), annualization_factor=365):
+    """
+    KPIs of one action trace for every combination of provision, leverage and starting balance.
+
+    Parameters:
+        df (pd.DataFrame or MarketFrame): The backtested dataset (the actions start at look_back).
+        actions (array): Positions (-1, 0, 1) or 'Short' / 'Neutral' / 'Long' labels of every step, e.g. the
+            actions returned by backtest_wrapper.
+        mkf (str): The traded market.
+        look_back (int): The look-back period of the backtest.
+        provisions, leverages, starting_balances (iterable): Values of the grid.
+        annualization_factor (int): The factor for annualizing metrics.
+
+    Returns:
+        pd.DataFrame: One row per (Provision, Leverage, Starting Balance), the KPIs of KPI_NAMES with the trades, win
+        rate and provision sum as counted by the environment, the total return and the number of steps whose
+        negative balance was set to 0.
+    """
+    close_prices = np.ascontiguousarray(df[('Close', mkf)], dtype=np.float64)
+    positions = as_positions(actions).astype(np.int64)
+    if len(positions) > len(close_prices) - look_back - 1:
+        raise ValueError(f'{len(positions)} actions for {len(close_prices) - look_back - 1} steps of the dataset')
+
+    settings = np.array(list(itertools.product(provisions, leverages, starting_balances)), dtype=np.float64)
+    balances, num_trades, profitable_trades, provision_sums, negative_balances = walk_position_grid(
+        close_prices, positions, look_back, settings[:, 0].copy(), settings[:, 1].copy(), settings[:, 2].copy())
+
+    kpis = calculate_kpis(balances, np.broadcast_to(positions, balances.shape), settings[:, 2], annualization_factor)
+    grid = pd.DataFrame(kpis, columns=KPI_NAMES,
+                        index=pd.MultiIndex.from_arrays(settings.T, names=['Provision', 'Leverage',
+                                                                           'Starting Balance']))
+    grid['Number of Trades'] = num_trades
+    grid['Profitable Trades'] = profitable_trades
+    grid['Win Rate'] = np.where(num_trades > 0, profitable_trades / np.maximum(num_trades, 1), np.nan)
+    grid['Provision Sum'] = provision_sums
+    grid['Total Return'] = grid['Final Balance'] / settings[:, 2] - 1
+    grid['Negative Balances'] = negative_balances
+    if negative_balances.any():
+        print(f'Negative balance in {np.count_nonzero(negative_balances)} of {len(grid)} settings, set to 0')
+    return grid
@@ -0,0 +1,247 @@
+"""
+Parallel walk-forward orchestration with checkpoints
+
+The steps of a walk-forward run (train a fresh agent, select the best generation, backtest it on the test year) are
+independent except for the starting balance carried from one test year to the next. The balance accounting of the
+environment is linear in the starting balance (the trades invest the whole balance, the provisions are a fraction of
+it, the reward functions do not depend on it), so every step runs with the same nominal starting balance in its own
+process and the test balances are rescaled afterwards (stitch_walk_forward).
+
+- the steps run as separate (spawned, non-daemonic, so a step can start its own backtest pool) processes, as many
+  at once as fit into the core budget
+- every finished step is checkpointed atomically (pickle of its result and arguments), a crashed or interrupted run
+  resumes with the steps that have no checkpoint (or were checkpointed with other arguments)
+- with a prepare_function, the data of the next steps is prepared in the background while the current steps train
+  (data/function/prefetch.py) and passed to the step as step_data (SharedFrames, zero-copy)
+"""
+import multiprocessing
+import os
+import pickle
+from datetime import datetime
+from multiprocessing.connection import wait
+
+import pandas as pd
+
+from data.function.prefetch import StepDataPrefetcher
+
+
+def _run_step(step_function, step_kwargs, checkpoint_path, threads, arguments, step_data=None):
+    import numba
+    import torch
+
+    # the core budget of the step, the backtest pool of the step sets its own workers to 1 thread
+    torch.set_num_threads(threads)
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+    result = step_function(**step_kwargs) if step_data is None else step_function(**step_kwargs, step_data=step_data)
+
+    temporary_path = f'{checkpoint_path}.tmp'
+    with open(temporary_path, 'wb') as file:
+        pickle.dump({'arguments': arguments, 'result': result}, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, checkpoint_path)
+
+
+class WalkForwardOrchestrator:
+    """
+    Runs the steps of a walk-forward in parallel processes under a core budget, with checkpoint / resume.
+
+    Usage:
+        orchestrator = WalkForwardOrchestrator(walk_forward_step, 'walk_forward_checkpoints/PPO_T', cores_per_step=5)
+        step_results = orchestrator.run({move_forward: {...} for move_forward in range(1, 6)})
+        final_test_results, provision_sum, final_balance = stitch_walk_forward(step_results, 'Balances', 10000)
+    """
+    def __init__(self, step_function, checkpoint_dir, core_budget=None, cores_per_step=4, resume=True,
+                 prepare_function=None, mp_context=None):
+        """
+        Parameters:
+            step_function (function): Module level function running one step, called with the keyword arguments of
+                the step, returns a picklable result.
+            checkpoint_dir (str): Directory of the checkpoints (and of the run id) of this walk-forward.
+            core_budget (int): Cores available for all steps, os.cpu_count() by default.
+            cores_per_step (int): Cores used by one step (its training and backtest processes).
+            resume (bool): Reuse the checkpoints of a previous run, False starts from scratch.
+            prepare_function (function): Module level function preparing the data of a step (e.g.
+                prepare_walk_forward_data), run in the background, its result is passed to step_function as step_data.
+        """
+        self.step_function = step_function
+        self.checkpoint_dir = checkpoint_dir
+        self.core_budget = core_budget or os.cpu_count() or 1
+        self.cores_per_step = max(1, min(cores_per_step, self.core_budget))
+        self.mp_context = mp_context or multiprocessing.get_context('spawn')
+        self.prepare_function = prepare_function
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        if not resume:
+            for name in os.listdir(checkpoint_dir):
+                if name.startswith('step_') or name == 'run_id':
+                    os.remove(os.path.join(checkpoint_dir, name))
+
+        # the id of the run survives a resume, e.g. for the run of the BacktestResultsStore
+        run_id_path = os.path.join(checkpoint_dir, 'run_id')
+        if not os.path.exists(run_id_path):
+            with open(run_id_path, 'w') as file:
+                file.write(f'{datetime.now():%Y%m%d_%H%M%S}')
+        with open(run_id_path) as file:
+            self.run_id = file.read().strip()
+
+    def checkpoint_path(self, step):
+        return os.path.join(self.checkpoint_dir, f'step_{step}.pkl')
+
+    def load_checkpoint(self, step, arguments=None):
+        """
+        The checkpointed result of a step, None if the step has no checkpoint or ran with other arguments (keyword
+        arguments of the step and of its data preparation).
+        """
+        path = self.checkpoint_path(step)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            checkpoint = pickle.load(file)
+        if arguments is not None and checkpoint['arguments'] != arguments:
+            return None
+        return checkpoint['result']
+
+    def run(self, steps, prepare_steps=None):
+        """
+        Runs the steps without a matching checkpoint.
+
+        Parameters:
+            steps (dict): Step (e.g. move_forward) -> keyword arguments of step_function.
+            prepare_steps (dict): Step -> keyword arguments of prepare_function, the data of the next steps is
+                prepared while the current ones run.
+
+        Returns:
+            dict: Step -> result, in the order of steps.
+        """
+        prepare_steps = prepare_steps or {}
+        arguments = {step: {'step': step_kwargs, 'prepare': prepare_steps.get(step)}
+                     for step, step_kwargs in steps.items()}
+        pending = [step for step in steps if self.load_checkpoint(step, arguments[step]) is None]
+        for step in steps:
+            if step not in pending:
+                print(f'Walk forward step {step}: resumed from checkpoint')
+
+        parallel_steps = max(1, self.core_budget // self.cores_per_step)
+        prefetcher = None
+        if self.prepare_function is not None and pending:
+            prefetcher = StepDataPrefetcher(self.prepare_function, workers=parallel_steps, mp_context=self.mp_context)
+
+        running, failed = {}, []
+        try:
+            while pending or running:
+                while pending and len(running) < parallel_steps:
+                    step = pending[0]
+                    step_data = None
+                    if prefetcher is not None:
+                        prefetcher.submit(step, **prepare_steps[step])
+                        if running and not prefetcher.ready(step):
+                            break  # launched once its data is ready, checked again after the timeout below
+                        try:
+                            step_data = prefetcher.get(step)
+                        except Exception as error:
+                            pending.pop(0)
+                            failed.append(step)
+                            print(f'Walk forward step {step}: data preparation failed: {error!r}')
+                            continue
+                    pending.pop(0)
+                    process = self.mp_context.Process(
+                        target=_run_step, name=f'walk_forward_step_{step}',
+                        args=(self.step_function, steps[step], self.checkpoint_path(step), self.cores_per_step,
+                              arguments[step], step_data))
+                    process.start()
+                    running[process.sentinel] = (step, process)
+                    print(f'Walk forward step {step}: started')
+
+                if prefetcher is not None:
+                    # the data of the next steps is prepared while the running steps train
+                    for step in pending[:parallel_steps]:
+                        prefetcher.submit(step, **prepare_steps[step])
+
+                if not running:
+                    continue  # the data preparation of the pending steps failed, nothing to wait for
+
+                waiting_for_data = prefetcher is not None and pending and len(running) < parallel_steps
+                for sentinel in wait(list(running), timeout=1.0 if waiting_for_data else None):
+                    step, process = running.pop(sentinel)
+                    process.join()
+                    if prefetcher is not None:
+                        prefetcher.release(step)
+                    if process.exitcode != 0:
+                        failed.append(step)
+                    print(f'Walk forward step {step}: ' + ('finished' if process.exitcode == 0 else
+                                                            f'failed with exit code {process.exitcode}'))
+        finally:
+            if prefetcher is not None:
+                prefetcher.shutdown()
+
+        if failed:
+            raise RuntimeError(f'Walk forward steps {failed} failed, run again to resume from the finished steps')
+
+        return {step: self.load_checkpoint(step) for step in steps}
+
+
+def stitch_walk_forward(step_results, balance_column, starting_balance=10000):
+    """
+    Chains the test results of the steps, as if every step started with the final balance of the previous one.
+
+    Parameters:
+        step_results (dict or list): Results of the steps in their order, dicts with 'final_test_results' (DataFrame
+            with balance_column), 'starting_balance' and 'provision_sum'.
+        balance_column (str): The balance column of final_test_results.
+        starting_balance (float): The starting balance of the first step.
+
+    Returns:
+        tuple: final_test_results (concatenated, rescaled balances), provision_sum, final_balance
+    """
+    step_results = list(step_results.values()) if isinstance(step_results, dict) else list(step_results)
+    final_test_results, provision_sum, balance = [], 0.0, starting_balance
+    for result in step_results:
+        scale = balance / result['starting_balance']
+        test_results = result['final_test_results'].copy()
+        test_results[balance_column] = test_results[balance_column] * scale
+        provision_sum += result['provision_sum'] * scale
+
+        balances = test_results[balance_column].dropna()
+        if len(balances):
+            balance = balances.iloc[-1]
+        final_test_results.append(test_results)
+
+    final_test_results = pd.concat(final_test_results) if final_test_results else pd.DataFrame()
+    return final_test_results, provision_sum, balance
+
+
+def _failing_step(**step_kwargs):
+    raise AssertionError('the step must not start without its data')
+
+
+def _failing_prepare(**prepare_kwargs):
+    raise ValueError('no data')
+
+
+def test_failed_data_preparation():
+    # the run raises (instead of waiting forever) when the data preparation of every step fails
+    import tempfile
+    import threading
+
+    outcome = {}
+
+    def run():
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            orchestrator = WalkForwardOrchestrator(_failing_step, checkpoint_dir, core_budget=2, cores_per_step=1,
+                                                   prepare_function=_failing_prepare)
+            try:
+                orchestrator.run({step: {} for step in (1, 2, 3)}, {step: {} for step in (1, 2, 3)})
+            except RuntimeError as error:
+                outcome['error'] = error
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=120)
+    assert not thread.is_alive(), "The run hangs after the failed data preparations"
+    assert 'error' in outcome and '[1, 2, 3]' in str(outcome['error']), f"Expected a RuntimeError, got {outcome}"
+
+    print("All tests passed!")
+
+
+if __name__ == '__main__':
+    test_failed_data_preparation()
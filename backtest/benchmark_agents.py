@@ -1,25 +1,38 @@
 import numpy as np
+from numba import jit
 
 class Buy_and_hold_Agent:
     def __init__(self, action_size=3):
         self.action_size = action_size
         self.generation = 'Buy and Hold'
+        self.constant_position = 1  # closed-form backtest (benchmark_backtest.py)
 
     def get_action_probabilities(self, observation, current_position):
         action_probs = np.zeros(self.action_size)
         action_probs[2] = 1.0
         return action_probs
 
+    def get_action_probabilities_batch(self, observations, current_positions):
+        action_probs = np.zeros((len(observations), self.action_size))
+        action_probs[:, 2] = 1.0
+        return action_probs
+
 class Sell_and_hold_Agent:
     def __init__(self, action_size=3):
         self.action_size = action_size
         self.generation = 'Sell and Hold'
+        self.constant_position = -1  # closed-form backtest (benchmark_backtest.py)
 
     def get_action_probabilities(self, observation, current_position):
         action_probs = np.zeros(self.action_size)
         action_probs[0] = 1.0
         return action_probs
 
+    def get_action_probabilities_batch(self, observations, current_positions):
+        action_probs = np.zeros((len(observations), self.action_size))
+        action_probs[:, 0] = 1.0
+        return action_probs
+
 class Yearly_Perfect_Agent:
     def __init__(self, df, look_back, tradable_markets, action_size=3):
         self.df = df
@@ -60,6 +73,177 @@ class Yearly_Perfect_Agent:
         return action_probs
 
 
+@jit(nopython=True)
+def _segment_at_least(value, factor, other_value, other_factor):
+    # exp(value) * factor >= exp(other_value) * other_factor, the balances of two segments at the same price
+    if factor >= 0 >= other_factor:
+        return True
+    if factor <= 0 <= other_factor:
+        return False
+    if factor > 0:
+        return value + np.log(factor) >= other_value + np.log(other_factor)
+    return value + np.log(-factor) <= other_value + np.log(-other_factor)
+
+
+@jit(nopython=True)
+def _segment_dominates(value, start_price, other_value, other_start_price, low, high, entry_factor, slope):
+    """
+    True if the segment (log balance at its start, opening price) is at least as good as the other one at every
+    closing price of [low, high] at which the other one is not ruined, it then also survives at least as long.
+    slope: position * leverage.
+    """
+    other_low = entry_factor + slope / other_start_price * (low - other_start_price)
+    other_high = entry_factor + slope / other_start_price * (high - other_start_price)
+    if other_low <= 0 and other_high <= 0:
+        return True  # the other segment is ruined at every remaining price
+
+    # the part of the range where the other segment is not ruined, bounded by its ruin price
+    ruin_price = other_start_price * (1.0 - entry_factor / slope)
+    if other_low <= 0:
+        low, other_low = ruin_price, 0.0
+    if other_high <= 0:
+        high, other_high = ruin_price, 0.0
+    return _segment_at_least(value, entry_factor + slope / start_price * (low - start_price), other_value,
+                             other_low) and \
+        _segment_at_least(value, entry_factor + slope / start_price * (high - start_price), other_value, other_high)
+
+
+@jit(nopython=True)
+def optimal_position_path(close_prices, look_back, provision, leverage):
+    """
+    Short / neutral / long path with the highest final balance under the accounting of Trading_Environment_Basic.step
+    (dynamic programming over the hold segments).
+
+    The environment accounts a held position on the balance and the price at its opening: holding p from step s to
+    the end of step e - 1 multiplies the balance by 1 - provision * leverage * |p| + p * leverage * (P_e - P_s) / P_s
+    (opening a long or short position costs provision * leverage of the balance, going neutral is free). A position
+    can only be reopened after another one, a segment whose balance drops to 0 ruins the path. The first position
+    is entered from neutral.
+
+    The balance of a segment is a line in the closing price P_e. A start whose line is below the line of another
+    start over the range of the remaining prices (where it is not ruined) can neither end better nor survive longer
+    and is dropped, only the remaining starts are scanned at every step: O(T x open starts), O(T^2) in the worst
+    case (no start ever dominated, e.g. a series trending for its whole length).
+
+    Returns:
+        np.ndarray: Positions (-1, 0, 1) of every step of the backtest.
+    """
+    n_steps = len(close_prices) - look_back - 1
+    positions = np.zeros(max(n_steps, 0), dtype=np.int64)
+    if n_steps <= 0:
+        return positions
+
+    prices = close_prices[look_back:look_back + n_steps + 1]
+    entry_factor = 1.0 - provision * leverage
+    # log balance at the start of a step by the position held until then (index position + 1)
+    values = np.full((n_steps + 1, 3), -np.inf)
+    values[0, 1] = 0.0
+    segment_starts = np.zeros((n_steps + 1, 3), dtype=np.int64)
+    previous_positions = np.zeros((n_steps + 1, 3), dtype=np.int64)
+
+    # range of the prices after every step, the closing prices of the segments still to come
+    lowest, highest = prices.copy(), prices.copy()
+    for step in range(n_steps - 1, -1, -1):
+        lowest[step] = min(prices[step + 1], lowest[step + 1] if step + 1 < n_steps else prices[step + 1])
+        highest[step] = max(prices[step + 1], highest[step + 1] if step + 1 < n_steps else prices[step + 1])
+
+    # open segment starts of the short (0) and long (1) positions, in the order of the starts
+    open_starts = np.empty((2, n_steps), dtype=np.int64)
+    open_values = np.empty((2, n_steps))
+    open_previous = np.empty((2, n_steps), dtype=np.int64)
+    n_open = np.zeros(2, dtype=np.int64)
+
+    for start in range(n_steps):
+        # one neutral step, longer neutral periods are chains of them
+        for q in range(3):
+            if values[start, q] > values[start + 1, 1]:
+                values[start + 1, 1] = values[start, q]
+                segment_starts[start + 1, 1] = start
+                previous_positions[start + 1, 1] = q
+
+        end = start + 1
+        for k in range(2):
+            p, sign = 2 * k, 2 * k - 1
+            best_value, best_previous = -np.inf, 1
+            for q in range(3):
+                if q != p and values[start, q] > best_value:
+                    best_value, best_previous = values[start, q], q
+
+            if best_value > -np.inf:
+                # compare the new start with the open ones over the remaining price range
+                slope, low, high = sign * leverage, lowest[start], highest[start]
+                dominated, kept = False, 0
+                for i in range(n_open[k]):
+                    open_start, open_value = open_starts[k, i], open_values[k, i]
+                    if not dominated and _segment_dominates(open_value, prices[open_start], best_value,
+                                                            prices[start], low, high, entry_factor, slope):
+                        dominated = True
+                    elif _segment_dominates(best_value, prices[start], open_value, prices[open_start], low, high,
+                                            entry_factor, slope):
+                        continue
+                    open_starts[k, kept], open_values[k, kept] = open_start, open_value
+                    open_previous[k, kept] = open_previous[k, i]
+                    kept += 1
+                if not dominated:
+                    open_starts[k, kept], open_values[k, kept], open_previous[k, kept] = start, best_value, \
+                        best_previous
+                    kept += 1
+                n_open[k] = kept
+
+            # the segments of the open starts ending at the next step
+            kept = 0
+            for i in range(n_open[k]):
+                segment_start = open_starts[k, i]
+                factor = entry_factor + sign * leverage / prices[segment_start] * (prices[end] - prices[segment_start])
+                if factor <= 0:
+                    continue  # ruined, the balance stays 0
+                value = open_values[k, i] + np.log(factor)
+                if value > values[end, p]:
+                    values[end, p] = value
+                    segment_starts[end, p] = segment_start
+                    previous_positions[end, p] = open_previous[k, i]
+                open_starts[k, kept], open_values[k, kept] = segment_start, open_values[k, i]
+                open_previous[k, kept] = open_previous[k, i]
+                kept += 1
+            n_open[k] = kept
+
+    state, end = np.argmax(values[n_steps]), n_steps
+    while end > 0:
+        start = segment_starts[end, state]
+        positions[start:end] = state - 1
+        state, end = previous_positions[end, state], start
+    return positions
+
+
+class Perfect_Foresight_Agent:
+    """
+    Oracle benchmark following the optimal position path of the window (optimal_position_path), the highest final
+    balance any position path reaches in the environment. run_backtesting plans the path of every dataset itself
+    (oracle_positions), in the environment the agent has to be fitted to the backtested data first.
+    """
+    def __init__(self, action_size=3):
+        self.action_size = action_size
+        self.generation = 'Perfect Foresight'
+        self.precomputed_actions = np.empty(0, dtype=np.int64)
+        self.current_step = 0
+
+    def oracle_positions(self, close_prices, look_back, provision, leverage):
+        return optimal_position_path(np.asarray(close_prices, dtype=np.float64), look_back, provision, leverage)
+
+    def fit(self, df, tradable_markets, look_back, provision, leverage):
+        self.precomputed_actions = self.oracle_positions(df[('Close', tradable_markets)], look_back, provision,
+                                                         leverage) + 1
+        self.current_step = 0
+        return self
+
+    def get_action_probabilities(self, observation, current_position):
+        action_probs = np.zeros(self.action_size)
+        precomputed_action = self.precomputed_actions[self.current_step]
+        action_probs[precomputed_action] = 1.0
+        self.current_step += 1
+        return action_probs
+
+
 # tests
 if __name__ == '__main__':
     # test the agents
@@ -180,12 +364,22 @@ if __name__ == '__main__':
 
     ph_results_prepared = prepare_backtest_results(ph_results, 'PH')
 
+    oracle_agent = Perfect_Foresight_Agent()  # PF - perfect foresight
+    pf_results, _, benchmark_pf = BF.run_backtesting(
+        oracle_agent, 'PF', [df_test], ['test'],
+        BF.backtest_wrapper, tradable_markets, look_back, variables, provision, starting_balance, leverage,
+        Trading_Environment_Basic, reward_calculation, workers=4)
+
+    pf_results_prepared = prepare_backtest_results(pf_results, 'PF')
+
     print("Buy and Hold Agent final results:", bah_results_prepared[('BAH', 'Final Balance')][0])
     print("Benchmark Buy and Hold Agent final reward:", bah_results_prepared[('BAH', 'Total Reward')][0])
     print("Sell and Hold Agent final results:", sah_results_prepared[('SAH', 'Final Balance')][0])
     print("Benchmark Sell and Hold Agent final reward:", sah_results_prepared[('SAH', 'Total Reward')][0])
     print("Perfect Hold Agent final results:", ph_results_prepared[('PH', 'Final Balance')][0])
     print("Benchmark Perfect Hold Agent final reward:", ph_results_prepared[('PH', 'Total Reward')][0])
+    print("Perfect Foresight Agent final results:", pf_results_prepared[('PF', 'Final Balance')][0])
+    print("Benchmark Perfect Foresight Agent final reward:", pf_results_prepared[('PF', 'Total Reward')][0])
 
     first_close = df_test.loc[:, ('Close', tradable_markets)].iloc[look_back]
     last_close = df_test.loc[:, ('Close', tradable_markets)].iloc[-1]
@@ -7,6 +7,8 @@ import pandas as pd
 import webbrowser
 from threading import Timer
 
+from backtest.backtest_functions.kpi import ACTION_LABELS
+
 def OHLC_probability_plot(df_train, df_validation, df_test, episode_probabilities, portnumber=8062):
     def get_ohlc_data(selected_dataset, market):
         dataset_mapping = {
@@ -147,7 +149,9 @@ def PnL_generation_plot(balances_dfs, alternative_strategies=None, port_number=8
 def Probability_generation_plot(probs_dfs, port_number=8050):
     # Transforming your data structure into a suitable format for plotting
     records = []
-    for (agent_gen, data_set), df in probs_dfs.items():
+    for (agent_gen, data_set), probabilities in probs_dfs.items():
+        # (steps, 3) probability arrays are labeled only here
+        df = pd.DataFrame(probabilities, columns=ACTION_LABELS)
         df['Agent Generation'] = agent_gen
         df['DATA_SET'] = data_set
         df['Time Step'] = df.index
@@ -0,0 +1,98 @@
+"""
+MarketFrame - array backed replacement of the (price type, Currency) MultiIndex DataFrame for hot loops
+
+- values: contiguous 2D array (time, columns), float64 by default (float32 to halve the memory)
+- columns: map from column key, e.g. ('Close', 'EURUSD'), to the column number
+- index: int64 timestamps (ns) sliced with binary search
+Row slices (by position or by date) are zero-copy views sharing the values of the parent frame.
+"""
+import numpy as np
+import pandas as pd
+
+
+class MarketFrame:
+    def __init__(self, values, columns, index, column_names=None, index_is_datetime=True, index_name=None):
+        self.values = values
+        self.columns = columns if isinstance(columns, dict) else {key: i for i, key in enumerate(columns)}
+        self.index = index
+        self.column_names = column_names
+        self.index_is_datetime = index_is_datetime
+        self.index_name = index_name
+
+    @classmethod
+    def from_dataframe(cls, df, dtype=np.float64):
+        values = np.ascontiguousarray(df.to_numpy(dtype=dtype))
+        index_is_datetime = isinstance(df.index, pd.DatetimeIndex)
+        if index_is_datetime:
+            index = df.index.values.astype('datetime64[ns]').astype(np.int64)
+        else:
+            index = np.asarray(df.index, dtype=np.int64)
+        return cls(values, list(df.columns), index, list(df.columns.names), index_is_datetime, df.index.name)
+
+    def to_dataframe(self):
+        keys = self.column_keys()
+        if all(isinstance(key, tuple) for key in keys):
+            columns = pd.MultiIndex.from_tuples(keys, names=self.column_names)
+        else:
+            columns = pd.Index(keys)
+        index = pd.DatetimeIndex(self.index.astype('datetime64[ns]'), name=self.index_name) \
+            if self.index_is_datetime else pd.Index(self.index, name=self.index_name)
+        return pd.DataFrame(self.values, index=index, columns=columns)
+
+    def column_keys(self):
+        return sorted(self.columns, key=self.columns.get)
+
+    def column_numbers(self, keys):
+        return np.array([self.columns[key] for key in keys], dtype=np.int64)
+
+    def view(self, start, end):
+        """
+        Zero-copy view of the rows [start, end) by position.
+        """
+        return MarketFrame(self.values[start:end], self.columns, self.index[start:end], self.column_names,
+                           self.index_is_datetime, self.index_name)
+
+    def to_timestamp(self, value):
+        if not self.index_is_datetime:
+            return int(value)
+        return pd.Timestamp(value).as_unit('ns').value
+
+    def date_range(self, start=None, end=None):
+        """
+        Positions [start, end) of the rows between two dates, both inclusive like df[start:end].
+        A partial date string as the end includes its whole period at the resolution of the string, e.g. '2020-01'
+        the whole month, '2020' the whole year (pandas partial string indexing).
+        """
+        first = 0 if start is None else int(np.searchsorted(self.index, self.to_timestamp(start), side='left'))
+        if end is None:
+            last = len(self.index)
+        else:
+            if self.index_is_datetime and isinstance(end, str):
+                end_timestamp = pd.Period(end).end_time.as_unit('ns').value
+            else:
+                end_timestamp = self.to_timestamp(end)
+            last = int(np.searchsorted(self.index, end_timestamp, side='right'))
+        return first, max(first, last)
+
+    def loc(self, start=None, end=None):
+        return self.view(*self.date_range(start, end))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if isinstance(key.start, (int, np.integer, type(None))) and isinstance(key.stop, (int, np.integer, type(None))):
+                return self.view(*slice(key.start, key.stop).indices(len(self))[:2])
+            return self.loc(key.start, key.stop)
+        return self.values[:, self.columns[key]]  # column view
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __repr__(self):
+        return f'MarketFrame(rows={len(self)}, columns={len(self.columns)}, dtype={self.values.dtype})'
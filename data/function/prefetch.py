@@ -0,0 +1,180 @@
+"""
+Background preparation of the datasets of the walk-forward steps, handed over in shared memory
+
+The data of a walk-forward step (loading, features, the train / validation / test split and their rolling windows)
+does not depend on the agents of the previous steps. StepDataPrefetcher prepares the data of the next steps in
+background processes while the current steps train. Each prepared step is one shared memory block holding the values
+and the (int64 ns) index of all its frames; the process of the step maps the block and builds its DataFrames on top
+of it without copying (SharedFrames.load).
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from data.function.load_data import load_data_parallel
+from data.function.rolling_window import rolling_window_datasets
+
+ALIGNMENT = 64  # byte alignment of the arrays in the block
+
+
+def prepare_walk_forward_data(tickers, timestamp, feature_spec, start_date, validation_date, test_date, end_date,
+                              look_back, window_size='1Y', evaluation_window_size='2Y'):
+    """
+    Datasets of one walk-forward step, as prepared at the start of every step of the scripts.
+
+    Returns:
+        dict: 'train', 'validation', 'test' frames (validation and test with look_back rows of the previous set) and
+        'train_windows', 'validation_windows', 'test_windows' lists of their rolling windows.
+    """
+    from technical_analysys.feature_pipeline import FeaturePipeline
+
+    df = load_data_parallel(tickers, timestamp)
+    df = FeaturePipeline(feature_spec).transform(df)
+
+    df_train, df_validation, df_test = df[start_date:validation_date], df[validation_date:test_date], \
+        df[test_date:end_date]
+    df_validation = pd.concat([df_train.iloc[-look_back:], df_validation])
+    df_test = pd.concat([df_validation.iloc[-look_back:], df_test])
+
+    return {
+        'train': df_train,
+        'validation': df_validation,
+        'test': df_test,
+        'train_windows': rolling_window_datasets(df_train, window_size=window_size, look_back=look_back),
+        'validation_windows': rolling_window_datasets(df_validation, window_size=evaluation_window_size,
+                                                      look_back=look_back),
+        'test_windows': rolling_window_datasets(df_test, window_size=evaluation_window_size, look_back=look_back),
+    }
+
+
+def _aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def _frame_spec(df, offset):
+    index_is_datetime = isinstance(df.index, pd.DatetimeIndex)
+    spec = {'shape': (len(df), df.shape[1]), 'columns': list(df.columns), 'column_names': list(df.columns.names),
+            'multi_index': isinstance(df.columns, pd.MultiIndex), 'index_is_datetime': index_is_datetime,
+            'index_name': df.index.name, 'values_offset': offset}
+    spec['index_offset'] = offset + _aligned(8 * len(df) * df.shape[1])
+    return spec, spec['index_offset'] + _aligned(8 * len(df))
+
+
+class SharedFrames:
+    """
+    Picklable handle of a shared memory block holding a dict of DataFrames (or lists of DataFrames).
+    """
+    def __init__(self, name, specs):
+        self.name = name
+        self.specs = specs  # key -> frame spec or list of frame specs
+        self._block = None
+
+    @classmethod
+    def share(cls, frames):
+        """
+        Copies the frames (float64 values, int64 index) into a new shared memory block.
+        """
+        specs, offset, flat = {}, 0, []
+        for key, value in frames.items():
+            items = value if isinstance(value, list) else [value]
+            item_specs = []
+            for df in items:
+                spec, offset = _frame_spec(df, offset)
+                item_specs.append(spec)
+                flat.append((df, spec))
+            specs[key] = item_specs if isinstance(value, list) else item_specs[0]
+
+        block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for df, spec in flat:
+            values = np.ndarray(spec['shape'], dtype=np.float64, buffer=block.buf, offset=spec['values_offset'])
+            values[:] = df.to_numpy(dtype=np.float64)
+            index = np.ndarray((spec['shape'][0],), dtype=np.int64, buffer=block.buf, offset=spec['index_offset'])
+            index[:] = df.index.values.astype('datetime64[ns]').astype(np.int64) if spec['index_is_datetime'] \
+                else np.asarray(df.index, dtype=np.int64)
+            del values, index
+        block.close()  # the block lives until unlink
+        return cls(block.name, specs)
+
+    def __getstate__(self):
+        return {'name': self.name, 'specs': self.specs, '_block': None}
+
+    def _frame(self, spec, read_only=False):
+        values = np.ndarray(spec['shape'], dtype=np.float64, buffer=self._block.buf, offset=spec['values_offset'])
+        values.flags.writeable = not read_only
+        index = np.ndarray((spec['shape'][0],), dtype=np.int64, buffer=self._block.buf, offset=spec['index_offset'])
+        index = pd.DatetimeIndex(index.view('datetime64[ns]'), name=spec['index_name']) \
+            if spec['index_is_datetime'] else pd.Index(index, name=spec['index_name'])
+        columns = pd.MultiIndex.from_tuples(spec['columns'], names=spec['column_names']) if spec['multi_index'] \
+            else pd.Index(spec['columns'], name=spec['column_names'][0])
+        return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+    def load(self, read_only=False):
+        """
+        The frames as DataFrames on top of the shared memory block (zero-copy), valid while this handle is alive.
+        read_only protects the values shared by many processes.
+        """
+        if self._block is None:
+            self._block = shared_memory.SharedMemory(name=self.name)
+        return {key: [self._frame(item, read_only) for item in spec] if isinstance(spec, list)
+                else self._frame(spec, read_only)
+                for key, spec in self.specs.items()}
+
+    def unlink(self):
+        """
+        Frees the block, called by the owner once no process uses the frames any more.
+        """
+        block = shared_memory.SharedMemory(name=self.name)
+        block.close()
+        block.unlink()
+
+
+def _prepare_shared(prepare_function, prepare_kwargs):
+    return SharedFrames.share(prepare_function(**prepare_kwargs))
+
+
+def _unlink_prepared(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().unlink()
+
+
+class StepDataPrefetcher:
+    """
+    Prepares the data of walk-forward steps in background processes.
+
+    Usage:
+        prefetcher = StepDataPrefetcher(prepare_walk_forward_data)
+        prefetcher.submit(step, **prepare_kwargs)   # returns immediately
+        step_data = prefetcher.get(step)           # SharedFrames, step_data.load() in the process of the step
+        prefetcher.release(step)                   # once the step finished
+    """
+    def __init__(self, prepare_function=prepare_walk_forward_data, workers=1, mp_context=None):
+        self.prepare_function = prepare_function
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context or get_context('spawn'))
+        self.futures = {}
+
+    def submit(self, step, **prepare_kwargs):
+        if step not in self.futures:
+            self.futures[step] = self.pool.submit(_prepare_shared, self.prepare_function, prepare_kwargs)
+
+    def ready(self, step):
+        return step in self.futures and self.futures[step].done()
+
+    def get(self, step):
+        return self.futures[step].result()
+
+    def release(self, step):
+        """
+        Frees the shared data of a step, once it is prepared if the preparation is still running.
+        """
+        future = self.futures.pop(step, None)
+        if future is not None and not future.cancel():
+            future.add_done_callback(_unlink_prepared)
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.pool.shutdown(wait=True)
+        for step in list(self.futures):
+            self.release(step)
@@ -1,7 +1,15 @@
 # import libraries
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
 import numpy as np
 import pandas as pd
-from datetime import timedelta
+
+from data.function.prefetch import SharedFrames
+
+SPLIT_SETS = ('train', 'test', 'val')
+
 
 def get_week_indices(df, start_week, num_weeks):
     start_date = df.index[0] + timedelta(weeks=start_week)
@@ -11,34 +19,107 @@ def get_week_indices(df, start_week, num_weeks):
 
 def split_data_by_weeks(df, train_weeks, test_weeks, val_weeks, forward_shifts):
     """
-    Splits the dataframe into training, testing, and validation sets based on the number of weeks.
-    The function also shifts forward by a certain number of weeks.
+    Plans the training, testing, and validation sets based on the number of weeks, shifting forward by a certain number
+    of weeks, as integer row ranges instead of copies of the data.
+
+    Every set starts on the last day of the previous one, the shifts go on until the validation set reaches the last
+    date of the dataframe. The ranges select the same rows as the date slices df[start_date:end_date] of the sets.
+
+    Parameters:
+        df (pd.DataFrame or pd.DatetimeIndex): The data (sorted by date) or its index.
+        train_weeks, test_weeks, val_weeks (int): Lengths of the sets in weeks.
+        forward_shifts (int): The shift between two splits in weeks.
+
+    Returns:
+        np.ndarray: int64 array (splits, 3, 2) of the [start, stop) row positions of train, test and val, see
+        iter_splits for the DataFrames.
     """
-    results = []
+    if forward_shifts <= 0:
+        raise ValueError('forward_shifts must be positive')
+    index = df if isinstance(df, pd.DatetimeIndex) else df.index
+    if not len(index):
+        return np.empty((0, len(SPLIT_SETS), 2), dtype=np.int64)
+
+    one_day, shift = pd.Timedelta(days=1), pd.Timedelta(weeks=forward_shifts)
+    lengths = [pd.Timedelta(weeks=weeks) - one_day for weeks in (train_weeks, test_weeks, val_weeks)]
 
-    max_date = df.index[-1]  # Get the date of the last entry
+    # the last split is the first one whose validation set ends on or after the last date
+    first_val_end = index[0] + sum(lengths, pd.Timedelta(0))
+    n_splits = 1 + max(0, int(np.ceil((index[-1] - first_val_end) / shift)))
 
-    shift_date = df.index[0]
-    while True:
-        train_start_date = shift_date
-        train_end_date = train_start_date + pd.Timedelta(weeks=train_weeks) - pd.Timedelta(days=1)
+    starts = index[0] + shift * np.arange(n_splits)
+    plan = np.empty((n_splits, len(SPLIT_SETS), 2), dtype=np.int64)
+    for i, length in enumerate(lengths):
+        ends = starts + length
+        plan[:, i, 0] = index.searchsorted(starts, side='left')
+        plan[:, i, 1] = index.searchsorted(ends, side='right')
+        starts = ends
+    return plan
 
-        test_start_date = train_end_date
-        test_end_date = test_start_date + pd.Timedelta(weeks=test_weeks) - pd.Timedelta(days=1)
 
-        val_start_date = test_end_date
-        val_end_date = val_start_date + pd.Timedelta(weeks=val_weeks) - pd.Timedelta(days=1)
+def iter_splits(df, plan):
+    """
+    Yields the (train, test, val) sets of every split of the plan as row slices (views) of df.
+    """
+    for bounds in plan:
+        yield tuple(df.iloc[start:stop] for start, stop in bounds)
+
 
-        train = df[train_start_date: train_end_date]
-        test = df[test_start_date: test_end_date]
-        val = df[val_start_date: val_end_date]
+_split_data = None  # the shared dataframe in the worker processes
 
-        results.append((train, test, val))
 
-        # Breaking condition
-        if val_end_date >= max_date:
-            break
+def _attach_split_data(shared_data):
+    global _split_data
+    _split_data = (shared_data, shared_data.load(read_only=True)['data'])
 
-        shift_date += pd.Timedelta(weeks=forward_shifts)
 
-    return results
\ No newline at end of file
+def _evaluate_split(callback, split, bounds):
+    df = _split_data[1]
+    return split, callback(*(df.iloc[start:stop] for start, stop in bounds))
+
+
+def iter_split_results(df, plan, callback, workers=None, mp_context=None):
+    """
+    Evaluates callback(train, test, val) for every split of the plan in a process pool, yielding (split, result) in
+    the order of completion.
+
+    The dataframe is copied once into shared memory, the workers build their (read-only) sets on top of it without
+    copying. Stopping the iteration cancels the splits not started yet.
+
+    Parameters:
+        df (pd.DataFrame): The data of the plan, numeric (the values are shared as float64).
+        plan (np.ndarray): Split plan of split_data_by_weeks.
+        callback (function): Module level function of the train, test and val DataFrames, returns a picklable result.
+        workers (int): Number of processes, os.cpu_count() by default.
+    """
+    shared_data = SharedFrames.share({'data': df})
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context or multiprocessing.get_context('spawn'),
+                                 initializer=_attach_split_data, initargs=(shared_data,)) as pool:
+            futures = [pool.submit(_evaluate_split, callback, split, bounds) for split, bounds in enumerate(plan)]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        shared_data.unlink()
+
+
+def run_splits(df, plan, callback, workers=None, mp_context=None, on_result=None):
+    """
+    Evaluates callback(train, test, val) for every split of the plan in parallel (see iter_split_results).
+
+    Parameters:
+        on_result (function): Called with (split, result) as soon as a split is finished, e.g. to save it.
+
+    Returns:
+        list: The results in the order of the plan.
+    """
+    results = [None] * len(plan)
+    for split, result in iter_split_results(df, plan, callback, workers, mp_context):
+        results[split] = result
+        if on_result is not None:
+            on_result(split, result)
+    return results
@@ -24,6 +24,8 @@ from data.function.edit import normalize_data, standardize_data
 from technical_analysys.add_indicators import add_indicators, add_returns, add_log_returns, add_time_sine_cosine
 import backtest.backtest_functions.functions as BF
 from functions.utilis import save_actor_critic_model
+from models.PPO.rollout_buffer import RolloutBuffer
+from models.PPO.advantages import compute_gae
 
 # Set seeds for reproducibility
 torch.manual_seed(0)
@@ -101,53 +103,6 @@ def backtest_wrapper(df, agent, mkf, look_back, variables, provision, initial_ba
     return generate_predictions_and_backtest(df, agent, mkf, look_back, variables, provision, initial_balance, leverage)
 
 
-# TODO use deque instead of list
-class PPOMemory:
-    def __init__(self, batch_size):
-        self.states = []
-        self.probs = []
-        self.vals = []
-        self.actions = []
-        self.rewards = []
-        self.dones = []
-        self.static_inputs = []
-
-        self.batch_size = batch_size
-
-    def generate_batches(self):
-        n_states = len(self.states)
-        batch_start = np.arange(0, n_states, self.batch_size)
-        indices = np.arange(n_states, dtype=np.int64)
-        np.random.shuffle(indices)
-        batches = [indices[i:i + self.batch_size] for i in batch_start]
-
-        states = np.array(self.states)[indices]
-        actions = np.array(self.actions)[indices]
-        probs = np.array(self.probs)[indices]
-        vals = np.array(self.vals)[indices]
-        rewards = np.array(self.rewards)[indices]
-        dones = np.array(self.dones)[indices]
-        static_inputs = np.array(self.static_inputs)[indices]
-
-        return states, actions, probs, vals, rewards, dones, static_inputs, batches
-
-    def store_memory(self, state, action, probs, vals, reward, done, static_input):
-        self.states.append(state)
-        self.actions.append(action)
-        self.probs.append(probs)
-        self.vals.append(vals)
-        self.rewards.append(float(reward))
-        self.dones.append(done)
-        self.static_inputs.append(static_input)
-
-    def clear_memory(self):
-        self.states = []
-        self.probs = []
-        self.actions = []
-        self.rewards = []
-        self.dones = []
-        self.vals = []
-        self.static_inputs = []
 class LSTM_NetworkBase(nn.Module):
     def __init__(self, input_dims, static_dim, hidden_size=1024, n_layers=2):
         super(LSTM_NetworkBase, self).__init__()
@@ -226,51 +181,32 @@ class PPO_Agent:
         self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=alpha, weight_decay=weight_decay)
         self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=alpha, weight_decay=weight_decay)
 
-        self.memory = PPOMemory(batch_size)
+        self.memory = RolloutBuffer(batch_size, self.device)
 
     def store_transition(self, state, action, probs, vals, reward, done, static_input):
         self.memory.store_memory(state, action, probs, vals, reward, done, static_input)
 
     def learn(self):
-        for _ in range(self.n_epochs):
-            # Generating the data for the entire batch
-            state_arr, action_arr, old_prob_arr, vals_arr, reward_arr, dones_arr, static_input_arr, batches = self.memory.generate_batches()
-
-            values = torch.tensor(vals_arr, dtype=torch.float).to(self.device)
-            advantage = np.zeros(len(reward_arr), dtype=np.float32)
-
-            # Calculating Advantage
-            for t in range(len(reward_arr) - 1):
-                discount = 1
-                a_t = 0
-                for k in range(t, len(reward_arr) - 1):
-                    a_t += discount * (reward_arr[k] + self.gamma * values[k + 1] * (1 - int(dones_arr[k])) - values[k])
-                    discount *= self.gamma * self.gae_lambda
-                advantage[t] = a_t
-
-            advantage = torch.tensor(advantage, dtype=torch.float).to(self.device)
-
-            # Creating mini-batches
-            num_samples = len(state_arr)
-            indices = np.arange(num_samples)
-            np.random.shuffle(indices)
-            for start_idx in range(0, num_samples, self.mini_batch_size):
-                # Extract indices for the mini-batch
-                minibatch_indices = indices[start_idx:start_idx + self.mini_batch_size]
-                static_input_batch = static_input_arr[minibatch_indices]
+        # The transitions of the rollout on the device, in the order of the rollout
+        state_arr, action_arr, old_prob_arr, values, reward_arr, dones_arr, static_input_arr = self.memory.tensors()
+        advantage, _ = compute_gae(reward_arr, values, dones_arr, self.gamma, self.gae_lambda)
 
+        for _ in range(self.n_epochs):
+            # Loop through the shuffled mini-batches
+            for minibatch_indices in self.memory.minibatch_indices(self.mini_batch_size):
                 # Extract data for the current mini-batch
-                batch_states = torch.tensor(state_arr[minibatch_indices], dtype=torch.float).to(self.device)
-                batch_actions = torch.tensor(action_arr[minibatch_indices], dtype=torch.long).to(self.device)
-                batch_old_probs = torch.tensor(old_prob_arr[minibatch_indices], dtype=torch.float).to(self.device)
+                batch_states = state_arr[minibatch_indices]
+                batch_actions = action_arr[minibatch_indices]
+                batch_old_probs = old_prob_arr[minibatch_indices]
                 batch_advantages = advantage[minibatch_indices]
                 batch_values = values[minibatch_indices]
+                static_input_batch = static_input_arr[minibatch_indices]
 
                 self.actor_optimizer.zero_grad()
                 self.critic_optimizer.zero_grad()
 
                 # Actor Network Loss with Entropy Regularization
-                probs = self.actor(batch_states, torch.tensor(static_input_batch, dtype=torch.float).to(self.device))
+                probs = self.actor(batch_states, static_input_batch)
                 dist = torch.distributions.Categorical(probs)
                 new_probs = dist.log_prob(batch_actions)
                 prob_ratio = torch.exp(new_probs - batch_old_probs)
@@ -283,7 +219,7 @@ class PPO_Agent:
                 actor_loss += self.l1_lambda * l1_loss_actor
 
                 # Critic Network Loss
-                critic_value = self.critic(batch_states, torch.tensor(static_input_batch, dtype=torch.float).to(self.device)).squeeze()
+                critic_value = self.critic(batch_states, static_input_batch).squeeze()
                 returns = batch_advantages + batch_values
                 critic_loss = nn.functional.mse_loss(critic_value, returns)
                 l1_loss_critic = sum(torch.sum(torch.abs(param)) for param in self.critic.parameters())
@@ -540,7 +476,7 @@ if __name__ == '__main__':
             cumulative_reward += reward
 
             # Check if enough data is collected or if the dataset ends
-            if len(agent.memory.states) >= agent.memory.batch_size or done:
+            if agent.memory.full or done:
                 agent.learn()
                 agent.memory.clear_memory()
 
@@ -0,0 +1,67 @@
+"""
+Generalized advantage estimation of the PPO agents
+
+GAE(lambda) advantages and TD(lambda) returns of a rollout in one reverse scan in numba, instead of one torch op per
+step. The rollout is [T] (one environment) or [T, N_envs], a done step neither bootstraps the value of the next step
+nor carries the advantage over it. The value after the last step is bootstrapped from last_values (0 by default, as
+the agents did at the end of a rollout).
+"""
+import numpy as np
+import torch
+from numba import jit
+
+
+@jit(nopython=True)
+def gae_scan(rewards, values, dones, last_values, gamma, gae_lambda):
+    """
+    Reverse scan over [T, N] float64 arrays (dones as 0 / 1), returns the advantages.
+    """
+    n_steps, n_envs = rewards.shape
+    advantages = np.empty_like(rewards)
+    for env in range(n_envs):
+        last_advantage = 0.0
+        next_value = last_values[env]
+        for t in range(n_steps - 1, -1, -1):
+            not_done = 1.0 - dones[t, env]
+            delta = rewards[t, env] + gamma * next_value * not_done - values[t, env]
+            last_advantage = delta + gamma * gae_lambda * not_done * last_advantage
+            advantages[t, env] = last_advantage
+            next_value = values[t, env]
+    return advantages
+
+
+def _to_numpy(x):
+    return x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+
+
+def _as_2d(x):
+    x = _to_numpy(x).astype(np.float64)
+    return x.reshape(len(x), -1)
+
+
+def compute_gae(rewards, values, dones, gamma=0.95, gae_lambda=0.9, last_values=None):
+    """
+    GAE advantages and returns (advantages + values) of a rollout.
+
+    Parameters:
+        rewards, values, dones (torch.Tensor or np.ndarray): Shape [T] or [T, N_envs].
+        gamma (float): Discount factor.
+        gae_lambda (float): GAE lambda.
+        last_values (float or array): Values of the states after the last step, one per environment, 0 by default.
+
+    Returns:
+        tuple: advantages, returns, of the type, shape, dtype (and device) of values.
+    """
+    values_2d = _as_2d(values)
+    n_envs = values_2d.shape[1]
+    bootstrap = np.zeros(n_envs) if last_values is None else \
+        np.broadcast_to(_to_numpy(last_values).astype(np.float64).ravel(), (n_envs,)).copy()
+
+    advantages = gae_scan(_as_2d(rewards), values_2d, _as_2d(dones), bootstrap, float(gamma), float(gae_lambda))
+    advantages = advantages.reshape(np.shape(values))
+
+    if torch.is_tensor(values):
+        advantages = torch.as_tensor(advantages, dtype=values.dtype, device=values.device)
+    else:
+        advantages = advantages.astype(np.asarray(values).dtype, copy=False)
+    return advantages, advantages + values
@@ -0,0 +1,98 @@
+"""
+Preallocated rollout buffer of the PPO agents
+
+The transitions of a rollout are written in place into contiguous tensors preallocated to batch_size (the rollout
+length) on the first store, instead of one tensor per value concatenated before learning. States, log probabilities,
+values, rewards and static states are float32, actions int64 (for Categorical.log_prob), dones bool. clear only
+resets the write position. The storage stays on the CPU (pinned with CUDA) during the collection and is moved to the
+device once per learn (tensors); the minibatches are index selections of those tensors.
+
+Serves the transformer, NN and LSTM PPO agents, the NN agent stores no static state.
+"""
+import math
+
+import numpy as np
+import torch
+
+
+class RolloutBuffer:
+    def __init__(self, batch_size, device=None):
+        """
+        Parameters:
+            batch_size (int): Number of transitions of a rollout, the capacity of the buffer.
+            device (torch.device): The device of the tensors returned by tensors.
+        """
+        self.batch_size = batch_size
+        self.device = device or torch.device('cpu')
+        self.size = 0
+
+        self.states = None
+        self.actions = None
+        self.probs = None
+        self.vals = None
+        self.rewards = None
+        self.dones = None
+        self.static_states = None
+
+    def _allocate(self, state, static_state):
+        pin_memory = self.device.type == 'cuda'
+
+        def empty(shape, dtype):
+            return torch.empty((self.batch_size, *shape), dtype=dtype, pin_memory=pin_memory)
+
+        self.states = empty(np.shape(state), torch.float32)
+        self.actions = empty((), torch.int64)
+        self.probs = empty((), torch.float32)
+        self.vals = empty((), torch.float32)
+        self.rewards = empty((), torch.float32)
+        self.dones = empty((), torch.bool)
+        self.static_states = None if static_state is None else empty(np.shape(static_state), torch.float32)
+
+    def store_memory(self, state, action, probs, vals, reward, done, static_state=None):
+        if self.states is None:
+            self._allocate(state, static_state)
+        if self.size >= self.batch_size:
+            raise IndexError(f'Rollout buffer is full ({self.batch_size} transitions), learn before storing more')
+
+        i = self.size
+        self.states[i] = torch.as_tensor(np.asarray(state, dtype=np.float32))
+        self.actions[i] = int(action)
+        self.probs[i] = float(probs)
+        self.vals[i] = math.nan if vals is None else float(vals)  # None if the values are estimated in learn
+        self.rewards[i] = float(reward)
+        self.dones[i] = bool(done)
+        if self.static_states is not None:
+            self.static_states[i] = torch.as_tensor(np.asarray(static_state, dtype=np.float32))
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def full(self):
+        return self.size >= self.batch_size
+
+    def clear_memory(self):
+        self.size = 0
+
+    def tensors(self):
+        """
+        The stored transitions on the device, in the order of the rollout.
+
+        Returns:
+            tuple: states, actions, probs, vals, rewards, dones, static_states (None if the agent stores none)
+        """
+        def on_device(tensor):
+            if tensor is None:
+                return None
+            return tensor[:self.size].to(self.device, non_blocking=True)
+
+        return tuple(on_device(tensor) for tensor in (self.states, self.actions, self.probs, self.vals, self.rewards,
+                                                      self.dones, self.static_states))
+
+    def minibatch_indices(self, mini_batch_size, shuffle=True):
+        """
+        Index tensors of the minibatches of one epoch, shuffled by default (with the numpy RNG, as the agents did).
+        """
+        indices = np.random.permutation(self.size) if shuffle else np.arange(self.size)
+        return torch.split(torch.as_tensor(indices, device=self.device), mini_batch_size)
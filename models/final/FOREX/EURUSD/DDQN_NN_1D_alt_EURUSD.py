@@ -564,7 +564,7 @@ if __name__ == '__main__':
                             futures.append((future, label))
 
                         for future, label in futures:
-                            (balance, total_reward, number_of_trades, probs_df, action_df, sharpe_ratio, max_drawdown,
+                            (balance, total_reward, number_of_trades, probs, actions, sharpe_ratio, max_drawdown,
                              sortino_ratio, calmar_ratio, cumulative_returns, balances, provision_sum) = future.result()
                             result_data = {
                                 'Agent generation': agent.generation,
@@ -586,7 +586,7 @@ if __name__ == '__main__':
                             backtest_results[key].append(result_data)
 
                             # Store probabilities and balances for plotting
-                            probs_dfs[(agent.generation, label)] = probs_df
+                            probs_dfs[(agent.generation, label)] = probs
                             balances_dfs[(agent.generation, label)] = balances
 
                         generation = agent.generation
@@ -656,8 +656,8 @@ if __name__ == '__main__':
         best_balances = balances_dfs.get(balances_key, [])
 
         probs_key = (agent_generation, test_labels[0])
-        best_probs_df = probs_dfs.get(probs_key, pd.DataFrame())
-        best_probs_df[f'{agent.get_name()}_Action'] = best_probs_df.idxmax(axis=1)
+        best_probs = probs_dfs.get(probs_key, np.empty((0, 3), dtype=np.float32))
+        best_probs_df = BF.probabilities_to_frame(best_probs, action_column=f'{agent.get_name()}_Action')
         best_balances_df = pd.DataFrame(best_balances, columns=[f'{agent.get_name()}_Balances'])
 
         dates = df_test.iloc[look_back:-1].index
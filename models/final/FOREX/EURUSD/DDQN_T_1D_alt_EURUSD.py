@@ -14,7 +14,6 @@ import time
 from tqdm import tqdm
 import random
 from itertools import cycle
-from concurrent.futures import ThreadPoolExecutor
 import torch.nn.functional as F
 from numba import jit
 import torch
@@ -529,6 +528,13 @@ if __name__ == '__main__':
     dataset_iterator = cycle(rolling_datasets)
 
     backtest_results, probs_dfs, balances_dfs = {}, {}, {}
+    # worker processes keep the validation and test windows loaded for all generations
+    backtest_executor = BF.BacktestExecutor(val_rolling_datasets + test_rolling_datasets,
+                                            val_labels + test_labels, BF.backtest_wrapper, tradable_markets,
+                                            look_back, variables, provision, starting_balance, leverage,
+                                            Trading_Environment_Basic, reward_calculation, workers=4)
+    evaluation_service = BF.EvaluationService(backtest_executor, 'DQN', backtest_results, probs_dfs,
+                                              balances_dfs, max_in_flight=2)
     generation = 0
 
     for episode in tqdm(range(num_episodes)):
@@ -571,42 +577,9 @@ if __name__ == '__main__':
                 agent.memory.clear_memory()
 
             if generation < agent.generation:
-                with ThreadPoolExecutor(max_workers=4) as executor:
-                    futures = []
-                    for df, label in zip(val_rolling_datasets + test_rolling_datasets, val_labels + test_labels):
-                        future = executor.submit(BF.backtest_wrapper, 'DQN', df, agent, tradable_markets, look_back,
-                                                 variables, provision, starting_balance, leverage,
-                                                 Trading_Environment_Basic, reward_calculation)
-                        futures.append((future, label))
-
-                    for future, label in futures:
-                        (balance, total_reward, number_of_trades, probs_df, action_df, sharpe_ratio, max_drawdown,
-                         sortino_ratio, calmar_ratio, cumulative_returns, balances, provision_sum) = future.result()
-                        result_data = {
-                            'Agent generation': agent.generation,
-                            'Label': label,
-                            'Provision_sum': provision_sum,
-                            'Final Balance': balance,
-                            'Total Reward': total_reward,
-                            'Number of Trades': number_of_trades,
-                            'Sharpe Ratio': sharpe_ratio,
-                            'Max Drawdown': max_drawdown,
-                            'Sortino Ratio': sortino_ratio,
-                            'Calmar Ratio': calmar_ratio
-                        }
-                        key = (agent.generation, label)
-
-                        if key not in backtest_results:
-                            backtest_results[key] = []
-
-                        backtest_results[key].append(result_data)
-
-                        # Store probabilities and balances for plotting
-                        probs_dfs[(agent.generation, label)] = probs_df
-                        balances_dfs[(agent.generation, label)] = balances
-
-                    generation = agent.generation
-                    print(f"Backtesting completed for {agent.get_name()} generation {generation}")
+                # the new generation is evaluated in the background, the training continues
+                evaluation_service.submit(agent)
+                generation = agent.generation
 
         # results
         end_time = time.time()
@@ -622,6 +595,10 @@ if __name__ == '__main__':
             look_back]) / window_df[('Close', tradable_markets)].iloc[look_back] * leverage))
         # TODO do this as cached function with benchmark agents and df as input
 
+    # wait for the evaluation of the last generations
+    evaluation_service.drain()
+    backtest_executor.shutdown()
+
     #save_model(agent.q_policy, base_dir="saved models", sub_dir="DDQN", file_name="q_policy")  # TODO repair save_model
     #save_model(agent.q_target, base_dir="saved models", sub_dir="DDQN", file_name="q_target")  # TODO repair save_model
 
@@ -24,8 +24,6 @@ import pandas as pd
 from tqdm import tqdm
 import random
 from itertools import cycle
-from concurrent.futures import ThreadPoolExecutor
-import concurrent.futures
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -611,6 +609,13 @@ if __name__ == '__main__':
         dataset_iterator = cycle(rolling_datasets)
 
         backtest_results, probs_dfs, balances_dfs = {}, {}, {}
+        # worker processes keep the validation and test windows loaded for all generations
+        backtest_executor = BF.BacktestExecutor(val_rolling_datasets + test_rolling_datasets,
+                                                val_labels + test_labels, BF.backtest_wrapper, tradable_markets,
+                                                look_back, variables, provision, starting_balance, leverage,
+                                                Trading_Environment_Basic, reward_calculation, workers=4)
+        evaluation_service = BF.EvaluationService(backtest_executor, 'PPO', backtest_results, probs_dfs,
+                                                  balances_dfs, max_in_flight=2)
         generation = 0
 
         for episode in tqdm(range(num_episodes)):
@@ -645,51 +650,9 @@ if __name__ == '__main__':
 
                 # Backtesting
                 if generation < agent.generation:
-                    with ThreadPoolExecutor(max_workers=4) as executor:
-                        futures = []
-                        # Combine validation and test datasets and labels for processing
-                        for df, label in zip(val_rolling_datasets + test_rolling_datasets, val_labels + test_labels):
-                            future = executor.submit(
-                                BF.backtest_wrapper, 'PPO', df, agent, tradable_markets, look_back,
-                                variables, provision, starting_balance, leverage,
-                                Trading_Environment_Basic, reward_calculation
-                            )
-                            futures.append((future, label))
-
-                        # Process futures as they complete
-                        for future, label in futures:
-                            result = future.result()
-                            balance, total_reward, number_of_trades, probs_df, action_df, sharpe_ratio, max_drawdown, \
-                                sortino_ratio, calmar_ratio, cumulative_returns, balances, provision_sum, max_drawdown_duration, \
-                                average_trade_duration, in_long, in_short, in_out_of_market, win_rate = result
-
-                            # Populate a dictionary with the results
-                            result_data = {
-                                'Agent generation': agent.generation,
-                                'Label': label,
-                                'Provision_sum': provision_sum,
-                                'Final Balance': balance,
-                                'Total Reward': total_reward,
-                                'Number of Trades': number_of_trades,
-                                'Sharpe Ratio': sharpe_ratio,
-                                'Max Drawdown': max_drawdown,
-                                'Sortino Ratio': sortino_ratio,
-                                'Calmar Ratio': calmar_ratio,
-                                'Max Drawdown Duration': max_drawdown_duration,
-                                'Average Trade Duration': average_trade_duration,
-                                'In Long': in_long,
-                                'In Short': in_short,
-                                'In Out of the Market': in_out_of_market,
-                                'Win rate': win_rate,
-                            }
-
-                            key = (agent.generation, label)
-                            backtest_results.setdefault(key, []).append(result_data)
-                            probs_dfs[key] = probs_df
-                            balances_dfs[key] = balances
-
-                        generation = agent.generation
-                        print(f"Backtesting completed for {agent.get_name()} generation {generation}")
+                    # the new generation is evaluated in the background, the training continues
+                    evaluation_service.submit(agent)
+                    generation = agent.generation
 
             # results
             end_time = time.time()
@@ -705,6 +668,10 @@ if __name__ == '__main__':
                     look_back]) / window_df[('Close', tradable_markets)].iloc[look_back] * leverage))
             # TODO do this as cached function with benchmark agents and df as input
 
+        # wait for the evaluation of the last generations
+        evaluation_service.drain()
+        backtest_executor.shutdown()
+
         buy_and_hold_agent = Buy_and_hold_Agent()
         sell_and_hold_agent = Sell_and_hold_Agent()
 
@@ -775,8 +742,8 @@ if __name__ == '__main__':
         best_balances = balances_dfs.get(balances_key, [])
 
         probs_key = (agent_generation, test_labels[0])
-        best_probs_df = probs_dfs.get(probs_key, pd.DataFrame())
-        best_probs_df[f'{agent.get_name()}_Action'] = best_probs_df.idxmax(axis=1)
+        best_probs = probs_dfs.get(probs_key, np.empty((0, 3), dtype=np.float32))
+        best_probs_df = BF.probabilities_to_frame(best_probs, action_column=f'{agent.get_name()}_Action')
         best_balances_df = pd.DataFrame(best_balances, columns=[f'{agent.get_name()}_Balances'])
 
         dates = df_test.iloc[look_back:-1].index
@@ -521,7 +521,7 @@ if __name__ == '__main__':
                         for future, label in futures:
                             result = future.result()
                             # Make sure to update these variables to match the exact structure of the data being returned
-                            balance, total_reward, number_of_trades, probs_df, action_df, sharpe_ratio, max_drawdown, \
+                            balance, total_reward, number_of_trades, probs, actions, sharpe_ratio, max_drawdown, \
                                 sortino_ratio, calmar_ratio, cumulative_returns, balances, provision_sum, max_drawdown_duration, \
                                 average_trade_duration, in_long, in_short, in_out_of_market = result
 
@@ -546,7 +546,7 @@ if __name__ == '__main__':
 
                             key = (agent.generation, label)
                             backtest_results.setdefault(key, []).append(result_data)
-                            probs_dfs[key] = probs_df
+                            probs_dfs[key] = probs
                             balances_dfs[key] = balances
 
                         generation = agent.generation
@@ -647,8 +647,8 @@ if __name__ == '__main__':
         best_balances = balances_dfs.get(balances_key, [])
 
         probs_key = (agent_generation, test_labels[0])
-        best_probs_df = probs_dfs.get(probs_key, pd.DataFrame())
-        best_probs_df[f'{agent.get_name()}_Action'] = best_probs_df.idxmax(axis=1)
+        best_probs = probs_dfs.get(probs_key, np.empty((0, 3), dtype=np.float32))
+        best_probs_df = BF.probabilities_to_frame(best_probs, action_column=f'{agent.get_name()}_Action')
         best_balances_df = pd.DataFrame(best_balances, columns=[f'{agent.get_name()}_Balances'])
 
         dates = df_test.iloc[look_back:-1].index
@@ -4,6 +4,7 @@ import pandas as pd
 
 from technical_analysys.indicators import rsi, simple_moving_average, average_true_range, macd, stochastic_oscillator, parabolic_sar
 from technical_analysys.volatility_functions import close_to_close_volatility, parkinson_volatility, garman_klass_volatility, rogers_satchell_volatility
+from technical_analysys.correlation_functions import rolling_pairwise_statistics, market_pairs
 
 
 def add_returns(df, return_indicators):
@@ -74,6 +75,34 @@ def add_indicators(df, indicators):
     return df
 
 
+def add_cross_asset_features(df, markets, window=20, price_type='Close'):
+    """
+    Adds rolling pairwise covariance, correlation and beta of simple returns for all pairs of markets.
+
+    Parameters:
+    - df: DataFrame with multi-level columns (price type, market identifier).
+    - markets: List of market identifiers, e.g. ['EURUSD', 'USDJPY', 'EURJPY', 'GBPUSD'].
+    - window: Rolling window size.
+    - price_type: Price type used to calculate the returns.
+
+    Columns are named like ('Corr_20', 'EURUSD_USDJPY'), beta is the beta of the second market to the first one.
+    """
+    missing = [mkf for mkf in markets if (price_type, mkf) not in df.columns]
+    if missing:
+        print(f"{price_type} data for markets {missing} not found in DataFrame")
+        return df
+
+    returns = np.column_stack([df[(price_type, mkf)].pct_change(1, fill_method=None).values for mkf in markets])
+    covariance, correlation, beta = rolling_pairwise_statistics(returns.astype(np.float64), window)
+
+    for pair, (first, second) in enumerate(market_pairs(markets)):
+        pair_name = f'{first}_{second}'
+        df[(f'Cov_{window}', pair_name)] = covariance[:, pair]
+        df[(f'Corr_{window}', pair_name)] = correlation[:, pair]
+        df[(f'Beta_{window}', pair_name)] = beta[:, pair]
+    return df
+
+
 def compute_volatility(df, currency, method_func='close_to_close_volatility', n=50):
     """
     Compute rolling volatility for a given currency using the provided method function.
@@ -0,0 +1,85 @@
+# library
+import numpy as np
+from numba import jit
+
+
+@jit(nopython=True)
+def rolling_pairwise_statistics(values, window):
+    """
+    Compute rolling covariance, correlation and beta for all pairs of columns in one pass with running sums.
+
+    Parameters:
+        - values: 2D array (time, markets), e.g. returns of each market.
+        - window: Rolling window size.
+
+    Returns:
+        - covariance, correlation, beta: 2D arrays (time, pairs), pairs ordered as (0, 1), (0, 2), ..., (1, 2), ...
+          beta is the beta of the second market of the pair with respect to the first one.
+          Windows containing NaN give NaN (like pandas rolling with min_periods=window).
+    """
+    n, n_markets = values.shape
+    n_pairs = n_markets * (n_markets - 1) // 2
+
+    first = np.empty(n_pairs, dtype=np.int64)
+    second = np.empty(n_pairs, dtype=np.int64)
+    pair = 0
+    for i in range(n_markets):
+        for j in range(i + 1, n_markets):
+            first[pair] = i
+            second[pair] = j
+            pair += 1
+
+    covariance = np.full((n, n_pairs), np.nan)
+    correlation = np.full((n, n_pairs), np.nan)
+    beta = np.full((n, n_pairs), np.nan)
+
+    # running state, memory grows with the number of pairs, not with the window size
+    sum_x = np.zeros(n_pairs)
+    sum_y = np.zeros(n_pairs)
+    sum_xx = np.zeros(n_pairs)
+    sum_yy = np.zeros(n_pairs)
+    sum_xy = np.zeros(n_pairs)
+    count = np.zeros(n_pairs, dtype=np.int64)
+
+    for t in range(n):
+        for p in range(n_pairs):
+            x = values[t, first[p]]
+            y = values[t, second[p]]
+            if not (np.isnan(x) or np.isnan(y)):
+                sum_x[p] += x
+                sum_y[p] += y
+                sum_xx[p] += x * x
+                sum_yy[p] += y * y
+                sum_xy[p] += x * y
+                count[p] += 1
+
+            # drop the observation leaving the window
+            if t >= window:
+                x_old = values[t - window, first[p]]
+                y_old = values[t - window, second[p]]
+                if not (np.isnan(x_old) or np.isnan(y_old)):
+                    sum_x[p] -= x_old
+                    sum_y[p] -= y_old
+                    sum_xx[p] -= x_old * x_old
+                    sum_yy[p] -= y_old * y_old
+                    sum_xy[p] -= x_old * y_old
+                    count[p] -= 1
+
+            if count[p] == window and window > 1:
+                cov = (sum_xy[p] - sum_x[p] * sum_y[p] / window) / (window - 1)
+                var_x = (sum_xx[p] - sum_x[p] * sum_x[p] / window) / (window - 1)
+                var_y = (sum_yy[p] - sum_y[p] * sum_y[p] / window) / (window - 1)
+                covariance[t, p] = cov
+                if var_x > 0 and var_y > 0:
+                    correlation[t, p] = cov / np.sqrt(var_x * var_y)
+                if var_x > 0:
+                    beta[t, p] = cov / var_x
+
+    return covariance, correlation, beta
+
+
+def market_pairs(markets):
+    """
+    Pairs of markets in the same order as the columns returned by rolling_pairwise_statistics.
+    """
+    return [(markets[i], markets[j]) for i in range(len(markets)) for j in range(i + 1, len(markets))]
@@ -0,0 +1,327 @@
+"""
+Declarative feature pipeline
+
+A feature spec (list of dicts, same style as the `indicators` lists used in the scripts) is compiled into a DAG of
+nodes. Shared intermediates (e.g. the EMAs used by MACD) become a single node, independent nodes of the same level
+are computed in parallel and every node output is cached under a content hash of its inputs and parameters, so
+between experiments only the features that actually changed are recomputed.
+
+Example:
+    feature_spec = [
+        {"feature": "RSI", "mkf": "EURUSD", "length": 14, "scale": 1 / 100},
+        {"feature": "ATR", "mkf": "EURUSD", "length": 36},
+        {"feature": "MACD", "mkf": "EURUSD"},
+        {"feature": "Stochastic", "mkf": "EURUSD"},
+        {"feature": "Returns", "price_type": "Close", "mkf": "EURUSD"},
+        {"feature": "Time", "timestamp": "1W", "scale": 1 / 2, "shift": 0.5},
+        {"feature": "CrossAsset", "markets": ["EURUSD", "USDJPY", "EURJPY", "GBPUSD"], "window": 20},
+    ]
+    pipeline = FeaturePipeline(feature_spec, cache_dir='feature_cache')
+    df = pipeline.transform(df)
+"""
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from technical_analysys.indicators import rsi, simple_moving_average, exponential_moving_average, \
+    average_true_range, stochastic_oscillator, parabolic_sar
+from technical_analysys.add_indicators import add_time_sine_cosine
+from technical_analysys.correlation_functions import rolling_pairwise_statistics, market_pairs
+
+INDEX_NODE = ('__index__',)
+
+
+class FeatureNode:
+    def __init__(self, key, func, deps=(), params=None, column=None):
+        self.key = key  # unique id of the node in the graph
+        self.func = func  # callable(inputs, **params), inputs is a list with outputs of the dependencies
+        self.deps = list(deps)  # keys of the nodes this node depends on
+        self.params = params or {}
+        self.column = column  # column written to the DataFrame, None for intermediate nodes
+
+
+def _source(df, key):
+    return df[key]
+
+
+def _market_frame(inputs, keys):
+    # rebuild a small (price type, Currency) frame so the functions from indicators.py can be reused
+    frame = pd.concat(inputs, axis=1)
+    frame.columns = pd.MultiIndex.from_tuples(keys, names=[None, 'Currency'])
+    return frame
+
+
+def _rsi(inputs, mkf, length):
+    return rsi(_market_frame(inputs, [('Close', mkf)]), mkf, length)
+
+
+def _sma(inputs, mkf, length):
+    return simple_moving_average(_market_frame(inputs, [('Close', mkf)]), mkf, length)
+
+
+def _ema(inputs, mkf, length):
+    return exponential_moving_average(_market_frame(inputs, [('Close', mkf)]), mkf, length)
+
+
+def _atr(inputs, mkf, length):
+    return average_true_range(_market_frame(inputs, [('High', mkf), ('Low', mkf), ('Close', mkf)]), mkf, length)
+
+
+def _difference(inputs):
+    return inputs[0] - inputs[1]
+
+
+def _ewm(inputs, span):
+    return inputs[0].ewm(span=span, adjust=False, min_periods=1).mean()
+
+
+def _rolling_mean(inputs, window):
+    return inputs[0].rolling(window=window, min_periods=1).mean()
+
+
+def _stochastic_k(inputs, mkf, k_window):
+    frame = _market_frame(inputs, [('High', mkf), ('Low', mkf), ('Close', mkf)])
+    k_percent, _ = stochastic_oscillator(frame, mkf, k_window=k_window)
+    return k_percent
+
+
+def _parabolic_sar(inputs, mkf, af, af_max):
+    return parabolic_sar(_market_frame(inputs, [('High', mkf), ('Low', mkf)]), mkf, af, af_max)
+
+
+def _returns(inputs):
+    return inputs[0].pct_change(1, fill_method=None)
+
+
+def _log_returns(inputs):
+    return np.log(inputs[0] / inputs[0].shift(1))
+
+
+def _time_sine_cosine(inputs, timestamp):
+    return add_time_sine_cosine(pd.DataFrame(index=inputs[0]), timestamp)
+
+
+def _cross_asset(inputs, markets, window):
+    returns = np.column_stack([series.values for series in inputs]).astype(np.float64)
+    covariance, correlation, beta = rolling_pairwise_statistics(returns, window)
+    columns = {}
+    for pair, (first, second) in enumerate(market_pairs(markets)):
+        columns[('Cov', first, second)] = covariance[:, pair]
+        columns[('Corr', first, second)] = correlation[:, pair]
+        columns[('Beta', first, second)] = beta[:, pair]
+    return pd.DataFrame(columns, index=inputs[0].index)
+
+
+def _select(inputs, column):
+    return inputs[0][column]
+
+
+def _scale(inputs, scale, shift):
+    return inputs[0] * scale + shift
+
+
+class FeaturePipeline:
+    def __init__(self, feature_spec, cache_dir=None, workers=4, dropna=True):
+        self.feature_spec = feature_spec
+        self.cache_dir = cache_dir  # optional on-disk cache, shared between runs
+        self.workers = workers
+        self.dropna = dropna
+        self.nodes = {}
+        self.cache = {}  # content hash -> node output
+        self.computed_nodes = 0  # nodes actually computed (not taken from the cache) in the last transform
+        self.compile()
+
+    # -------------------------------------------------------------------------------------------------------------
+    # graph construction
+    # -------------------------------------------------------------------------------------------------------------
+    def add_node(self, key, func=None, deps=(), params=None, column=None):
+        if key in self.nodes:  # shared intermediate, already in the graph
+            if column is not None:
+                self.nodes[key].column = column
+            return key
+        if func is None:
+            func, params = _source, {'key': key}
+        self.nodes[key] = FeatureNode(key, func, deps, params, column)
+        return key
+
+    def add_output(self, key, column, feature):
+        # optional rescaling, e.g. RSI / 100 or sin / 2 + 0.5
+        if 'scale' in feature or 'shift' in feature:
+            params = {'scale': feature.get('scale', 1), 'shift': feature.get('shift', 0)}
+            key = self.add_node(key + ('scaled', params['scale'], params['shift']), _scale, [key], params)
+        self.nodes[key].column = column
+
+    def source(self, price_type, mkf):
+        return self.add_node((price_type, mkf))
+
+    def ema(self, mkf, length):
+        return self.add_node(('EMA', mkf, length), _ema, [self.source('Close', mkf)], {'mkf': mkf, 'length': length})
+
+    def compile(self):
+        self.add_node(INDEX_NODE)
+
+        for feature in self.feature_spec:
+            name = feature['feature']
+            mkf = feature.get('mkf', '')
+            length = feature.get('length', 14)
+
+            if name == 'RSI':
+                key = self.add_node(('RSI', mkf, length), _rsi, [self.source('Close', mkf)], {'mkf': mkf, 'length': length})
+                self.add_output(key, ('RSI_' + str(length), mkf), feature)
+            elif name == 'SMA':
+                key = self.add_node(('SMA', mkf, length), _sma, [self.source('Close', mkf)], {'mkf': mkf, 'length': length})
+                self.add_output(key, ('SMA_' + str(length), mkf), feature)
+            elif name == 'EMA':
+                self.add_output(self.ema(mkf, length), ('EMA_' + str(length), mkf), feature)
+            elif name == 'ATR':
+                deps = [self.source('High', mkf), self.source('Low', mkf), self.source('Close', mkf)]
+                key = self.add_node(('ATR', mkf, length), _atr, deps, {'mkf': mkf, 'length': length})
+                self.add_output(key, ('ATR_' + str(length), mkf), feature)
+            elif name == 'MACD':
+                short_window = feature.get('short_window', 12)
+                long_window = feature.get('long_window', 26)
+                signal_window = feature.get('signal_window', 9)
+                macd_line = self.add_node(('MACD_Line', mkf, short_window, long_window), _difference,
+                                          [self.ema(mkf, short_window), self.ema(mkf, long_window)])
+                signal_line = self.add_node(('Signal_Line', mkf, short_window, long_window, signal_window), _ewm,
+                                            [macd_line], {'span': signal_window})
+                self.add_output(macd_line, ('MACD_Line', mkf), feature)
+                self.add_output(signal_line, ('Signal_Line', mkf), feature)
+            elif name == 'Stochastic':
+                k_window = feature.get('k_window', 14)
+                d_window = feature.get('d_window', 3)
+                deps = [self.source('High', mkf), self.source('Low', mkf), self.source('Close', mkf)]
+                k_percent = self.add_node(('K%', mkf, k_window), _stochastic_k, deps, {'mkf': mkf, 'k_window': k_window})
+                d_percent = self.add_node(('D%', mkf, k_window, d_window), _rolling_mean, [k_percent], {'window': d_window})
+                self.add_output(k_percent, ('K%', mkf), feature)
+                self.add_output(d_percent, ('D%', mkf), feature)
+            elif name == 'ParabolicSAR':
+                params = {'mkf': mkf, 'af': feature.get('af', 0.02), 'af_max': feature.get('af_max', 0.2)}
+                key = self.add_node(('Parabolic_SAR', mkf, params['af'], params['af_max']), _parabolic_sar,
+                                    [self.source('High', mkf), self.source('Low', mkf)], params)
+                self.add_output(key, ('Parabolic_SAR', mkf), feature)
+            elif name == 'Returns':
+                price_type = feature.get('price_type', 'Close')
+                key = self.add_node(('Returns', price_type, mkf), _returns, [self.source(price_type, mkf)])
+                self.add_output(key, ('Returns_' + price_type, mkf), feature)
+            elif name == 'LogReturns':
+                price_type = feature.get('price_type', 'Close')
+                key = self.add_node(('Log_Returns', price_type, mkf), _log_returns, [self.source(price_type, mkf)])
+                self.add_output(key, ('Log_Returns_' + price_type, mkf), feature)
+            elif name == 'Time':
+                timestamp = feature['timestamp']
+                time_key = self.add_node(('Time', timestamp), _time_sine_cosine, [INDEX_NODE], {'timestamp': timestamp})
+                for function in ['sin', 'cos']:
+                    column = f'{function}_time_{timestamp}'
+                    key = self.add_node((column,), _select, [time_key], {'column': column})
+                    self.add_output(key, (column, ''), feature)
+            elif name == 'CrossAsset':
+                markets = tuple(feature['markets'])
+                window = feature.get('window', 20)
+                price_type = feature.get('price_type', 'Close')
+                deps = [self.add_node(('Returns', price_type, market), _returns, [self.source(price_type, market)])
+                        for market in markets]
+                cross_key = self.add_node(('CrossAsset', price_type, markets, window), _cross_asset, deps,
+                                          {'markets': markets, 'window': window})
+                for statistic in feature.get('statistics', ['Cov', 'Corr', 'Beta']):
+                    for first, second in market_pairs(markets):
+                        column = (statistic, first, second)
+                        key = self.add_node(cross_key + column, _select, [cross_key], {'column': column})
+                        self.add_output(key, (f'{statistic}_{window}', f'{first}_{second}'), feature)
+            else:
+                raise ValueError(f"Unknown feature '{name}'")
+
+    def levels(self):
+        """
+        Topological levels of the graph, nodes within one level are independent of each other.
+        """
+        depth = {}
+
+        def node_depth(key):
+            if key not in depth:
+                deps = self.nodes[key].deps
+                depth[key] = 1 + max(node_depth(dep) for dep in deps) if deps else 0
+            return depth[key]
+
+        levels = {}
+        for key in self.nodes:
+            levels.setdefault(node_depth(key), []).append(key)
+        return [levels[level] for level in sorted(levels)]
+
+    # -------------------------------------------------------------------------------------------------------------
+    # execution
+    # -------------------------------------------------------------------------------------------------------------
+    def node_hash(self, node, df, hashes):
+        hasher = hashlib.sha1()
+        if node.key == INDEX_NODE:
+            hasher.update(pd.util.hash_pandas_object(df.index.to_series(), index=False).values.tobytes())
+        elif node.func is _source:
+            hasher.update(pd.util.hash_pandas_object(df[node.key], index=True).values.tobytes())
+        else:
+            hasher.update(repr((node.func.__name__, node.key, sorted(node.params.items()))).encode())
+            for dep in node.deps:
+                hasher.update(hashes[dep].encode())
+        return hasher.hexdigest()
+
+    def cache_path(self, content_hash):
+        return os.path.join(self.cache_dir, f'{content_hash}.pkl')
+
+    def load_cached(self, content_hash):
+        if content_hash in self.cache:
+            return self.cache[content_hash]
+        if self.cache_dir is not None and os.path.exists(self.cache_path(content_hash)):
+            output = pd.read_pickle(self.cache_path(content_hash))
+            self.cache[content_hash] = output
+            return output
+        return None
+
+    def store_cached(self, content_hash, output):
+        self.cache[content_hash] = output
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            output.to_pickle(self.cache_path(content_hash))
+
+    def run_node(self, node, df, outputs):
+        if node.key == INDEX_NODE:
+            return df.index
+        if node.func is _source:
+            return df[node.key]
+        return node.func([outputs[dep] for dep in node.deps], **node.params)
+
+    def transform(self, df):
+        """
+        Compute all features of the spec and add them to df (in place, like add_indicators), returns the DataFrame
+        after dropna if the pipeline was created with dropna=True.
+        """
+        outputs, hashes = {}, {}
+        self.computed_nodes = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for level in self.levels():
+                futures = {}
+                for key in level:
+                    node = self.nodes[key]
+                    hashes[key] = self.node_hash(node, df, hashes)
+                    if node.func is _source or key == INDEX_NODE:
+                        outputs[key] = self.run_node(node, df, outputs)
+                        continue
+                    cached = self.load_cached(hashes[key])
+                    if cached is not None:
+                        outputs[key] = cached
+                    else:
+                        futures[key] = executor.submit(self.run_node, node, df, outputs)
+
+                for key, future in futures.items():
+                    outputs[key] = future.result()
+                    self.store_cached(hashes[key], outputs[key])
+                    self.computed_nodes += 1
+
+        for key, node in self.nodes.items():
+            if node.column is not None and node.func is not _source:
+                df[node.column] = outputs[key].values
+
+        if self.dropna:
+            df = df.dropna()
+        return df
@@ -2,16 +2,16 @@ import gym
 from gym import spaces
 import numpy as np
 import pandas as pd
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
 from data.function.edit import normalize_data, standardize_data, process_variable
+from data.function.market_frame import MarketFrame
 
 # Trading environment class for discrete actions
 class Trading_Environment_Basic(gym.Env):
     def __init__(self, df, look_back=20, variables=None, tradable_markets='EURUSD', provision=0.0001,
                  initial_balance=10000, leverage=1, reward_function=None):
         super(Trading_Environment_Basic, self).__init__()
-        self.df = df.reset_index(drop=True)  # Reset the index of the DataFrame
+        # array backed market data, columns are looked up once here instead of through pandas on every step
+        self.df = df if isinstance(df, MarketFrame) else MarketFrame.from_dataframe(df)
         self.look_back = look_back  # Number of time steps to look back
         self.initial_balance = initial_balance  # Initial balance
         self.capital_investment = 0
@@ -28,6 +28,12 @@ class Trading_Environment_Basic(gym.Env):
         self.reward_function = reward_function
         self.provision_sum = 0  # Initialize the provision sum
 
+        self.close_prices = np.ascontiguousarray(self.df[('Close', self.tradable_markets)])
+        # one contiguous column per variable, in the order of self.variables
+        self.observation_values = np.asfortranarray(
+            self.df.values[:, self.df.column_numbers([variable['variable'] for variable in self.variables])])
+        self.edits = [variable['edit'] for variable in self.variables]
+
         # number of trades
         self.num_trades = 0
         self.profitable_trades = 0
@@ -69,23 +75,10 @@ class Trading_Environment_Basic(gym.Env):
         start = max(self.current_step - self.look_back, 0)
         end = self.current_step
 
-        # Create a list of the observation arrays for each variable
-        tasks = [(self.df[variable['variable']].iloc[start:end].values, variable['edit']) for variable in
-                 self.variables]
-
-        # Use ThreadPoolExecutor to parallelize data transformation
-        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
-            # Prepare and execute tasks
-            future_to_variable = {executor.submit(process_variable, data, edit_type): (data, edit_type) for data, edit_type in tasks}
-            results = []
-            for future in concurrent.futures.as_completed(future_to_variable):
-                data, edit_type = future_to_variable[future]  # Get the original data and edit type
-                try:
-                    result = future.result()  # Get the result of the transformation
-                except Exception as exc:
-                    print('%r generated an exception: %s' % ((data, edit_type), exc))  # Print exception
-                else:
-                    results.append(result)  # Append the result to the list of results
+        # Transform each variable in the order of self.variables (a thread pool per step cost more than the work
+        # itself and returned the variables in completion order)
+        results = [process_variable(self.observation_values[start:end, i], edit_type)
+                   for i, edit_type in enumerate(self.edits)]
 
         # Concatenate results to form the scaled observation array
         scaled_observation = np.concatenate(results).flatten()
@@ -95,8 +88,8 @@ class Trading_Environment_Basic(gym.Env):
         action = action - 1  # convert action to -1, 0, 1
 
         # Get the current price and the price of the next time step for the reward calculation and PnL
-        self.current_price = self.df[('Close', self.tradable_markets)].iloc[self.current_step]
-        next_price = self.df[('Close', self.tradable_markets)].iloc[self.current_step + 1]
+        self.current_price = self.close_prices[self.current_step]
+        next_price = self.close_prices[self.current_step + 1]
 
         provision_cost = 0
 
@@ -150,7 +143,7 @@ class Trading_Environment_Basic(gym.Env):
         action = action_mapping[action]
         alternative_position = action_mapping[alternative_position]
 
-        current_price = self.df[('Close', self.tradable_markets)].iloc[self.current_step]
-        next_price = self.df[('Close', self.tradable_markets)].iloc[self.current_step + 1]
+        current_price = self.close_prices[self.current_step]
+        next_price = self.close_prices[self.current_step + 1]
 
         return self.reward_function(current_price, next_price, alternative_position, action, self.leverage, self.provision)